@@ -0,0 +1,53 @@
+"""
+Micro-benchmark for the output spooling of remote commands.
+
+Feeds streams of increasing size through LineSpool and SpoolingProtocol in
+SSH-packet sized chunks and reports the cost per megabyte. With linear-time
+buffering the cost per megabyte stays flat as the stream grows.
+
+    $ python benchmarks/spool.py 32 64 128 256 512
+"""
+
+import sys, time
+
+from plait.spool import LineSpool, SpoolingProtocol
+
+CHUNK = 32 * 1024
+LINE = "x" * 79 + "\n"
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
+def stream(megabytes):
+    chunk = (LINE * (CHUNK // len(LINE) + 1))[:CHUNK]
+    for i in xrange(megabytes * 1024 * 1024 // CHUNK):
+        yield chunk
+
+def bench_linespool(megabytes):
+    spool = LineSpool(NullFile())
+    for chunk in stream(megabytes):
+        spool.write(chunk)
+    spool.flush()
+
+def bench_spooling(megabytes):
+    protocol = SpoolingProtocol()
+    for chunk in stream(megabytes):
+        protocol.dataReceived(chunk)
+    protocol.flush()
+
+def timed(f, megabytes):
+    start = time.time()
+    f(megabytes)
+    return time.time() - start
+
+def main(sizes):
+    print "{:>8} {:>18} {:>18}".format("MB", "LineSpool s/MB", "Spooling s/MB")
+    for megabytes in sizes:
+        lines = timed(bench_linespool, megabytes)
+        spooling = timed(bench_spooling, megabytes)
+        print "{:>8} {:>18.5f} {:>18.5f}".format(
+            megabytes, lines / megabytes, spooling / megabytes)
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [32, 64, 128, 256])
@@ -0,0 +1,70 @@
+"""
+Benchmark of the transports, Twisted Conch against the system `ssh`.
+
+Connects a worker to each host at once and reports the handshake rate,
+then runs commands one after another over the first connection and reports
+their median latency. Options after `--` go to `ssh` with `-o`.
+
+    $ python benchmarks/transport.py -i ~/.ssh/id_rsa -n 50 web1 web2 web3
+"""
+
+import os, sys, time, argparse
+
+from twisted.internet import defer, task
+
+from plait.cli import readKey
+from plait.transport import ConchTransport, OpenSSH
+from plait.worker import PlaitWorker
+
+def makeWorker(transport, key, timeout):
+    return PlaitWorker([], [key], None, None, timeout, transport=transport)
+
+@defer.inlineCallbacks
+def bench_handshakes(transport, key, hosts, timeout):
+    workers = [makeWorker(transport, key, timeout) for host in hosts]
+    start = time.time()
+    yield defer.gatherResults([worker.connect(host)
+                               for worker, host in zip(workers, hosts)])
+    defer.returnValue((workers, time.time() - start))
+
+@defer.inlineCallbacks
+def bench_commands(worker, commands, command="true"):
+    latencies = []
+    for i in xrange(commands):
+        start = time.time()
+        yield worker.execChannel(command)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    defer.returnValue(latencies[len(latencies) // 2])
+
+@defer.inlineCallbacks
+def timed(transport, key, hosts, commands, timeout):
+    workers, elapsed = yield bench_handshakes(transport, key, hosts, timeout)
+    latency = yield bench_commands(workers[0], commands)
+    for worker in workers:
+        worker.transport.disconnect()
+    defer.returnValue((len(hosts) / elapsed, latency))
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    key = readKey(os.path.expanduser(args.identity))
+    openssh = OpenSSH(os.path.expanduser(args.identity), args.options)
+    print "{:>8} {:>18} {:>18}".format("", "handshakes/s", "median cmd ms")
+    for name, transport in [("conch", ConchTransport), ("openssh", openssh)]:
+        rate, latency = yield timed(transport, key, args.hosts,
+                                    args.commands, args.timeout)
+        print "{:>8} {:>18.1f} {:>18.2f}".format(name, rate, latency * 1000)
+    openssh.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', dest='identity', default="~/.ssh/id_rsa")
+    parser.add_argument('-n', dest='commands', type=int, default=50)
+    parser.add_argument('-t', dest='timeout', type=int, default=10)
+    parser.add_argument('hosts', nargs='+')
+    argv, options = sys.argv[1:], []
+    if '--' in argv:
+        argv, options = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.options = options
+    task.react(main, [args])
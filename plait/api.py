@@ -1,29 +1,163 @@
 import inspect
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.python import failure
 from twisted.internet.threads import blockingCallFromThread as blockingCFT
+from twisted.python.threadable import isInIOThread
 
 from plait.task import thread_locals
 
 class RemoteCallError(Exception): pass
 
-def run(cmd, fail=False):
+def check(result, fail, caller):
+    if result.failed and fail:
+        exception = RemoteCallError(result.stderr)
+        exception.result = result
+        exception.error = caller.f_code.co_filename, caller.f_lineno
+        raise exception
+    return result
+
+def run(cmd, fail=False, timeout=None):
     """
     Execute a command on the remote host.
 
     Blocks by calling into the main reactor thread. The result is a CFTResult
     object which will contain the stdout of the operation. It will also have
     a stderr attribute which if not empty indicates the remote command failed.
+
+    When called from a coroutine task, which runs on the reactor thread, a
+    Deferred firing with the result is returned instead and should be
+    yielded: `result = yield run("uptime")`
+
+    A command still running after `timeout` seconds, `--command-timeout` by
+    default, is stopped and its result marked as failed and `timed_out`.
+
+    Within a `batch` the command is only recorded, and a Deferred which fires
+    with the result once the batch has been shipped is returned. Timeouts do
+    not apply to batched commands.
     """
     worker = thread_locals.worker
+    caller = inspect.currentframe().f_back
+    if worker.batch is not None:
+        return worker.batch.add(cmd, fail, caller)
+    if isInIOThread():
+        d = worker.execFromThread(cmd, timeout)
+        return d.addCallback(check, fail, caller)
     # block until result is available or main thread dies
-    result = blockingCFT(reactor, worker.execFromThread, cmd)
-    if result.failed and fail:
-        exception = RemoteCallError(result.stderr)
-        exception.result = result
-        stack = inspect.stack()[1]
-        exception.error = stack[1], stack[2]
-        raise exception
-    return result
+    result = blockingCFT(reactor, worker.execFromThread, cmd, timeout)
+    return check(result, fail, caller)
+
+def run_many(cmds, fail=False, timeout=None):
+    """
+    Execute several commands on the remote host at once, each over its own
+    channel of the host's connection. Returns a list of results in the order
+    of the commands, so a handful of independent commands cost a single round
+    trip of latency.
+
+    Like `run`, returns a Deferred when called from a coroutine task, and
+    stops commands still running after `timeout` seconds.
+    """
+    worker = thread_locals.worker
+    caller = inspect.currentframe().f_back
+    check_all = lambda results: [check(r, fail, caller) for r in results]
+    if isInIOThread():
+        d = worker.execManyFromThread(cmds, timeout)
+        return d.addCallback(check_all)
+    results = blockingCFT(reactor, worker.execManyFromThread, cmds, timeout)
+    return check_all(results)
+
+class batch(object):
+    """
+    Record the commands run within it and ship them to the remote host as a
+    single script over a single channel, so that N commands cost one round
+    trip instead of N. Commands run in order whether or not earlier ones
+    failed, and their results are split back out into the usual result
+    objects:
+
+        with batch() as b:
+            run("apt-get update")
+            run("apt-get -y upgrade")
+        update, upgrade = b.results
+
+    Inside the batch `run` returns a Deferred for each result. Once the
+    block exits, the first command run with `fail=True` that failed raises
+    RemoteCallError.
+
+    From a coroutine task the batch is shipped without blocking. In that case
+    yield the Deferreds returned by `run`, or `b.deferred`, which fires with
+    the list of results.
+
+    May also decorate a function, `@batch`, to batch every command it runs.
+    Coroutine tasks can't be decorated, since the commands they yield would
+    wait on the batch to be shipped. Use the block within them instead, and
+    yield `b.deferred` after it.
+    """
+
+    def __init__(self, func=None):
+        if inspect.isgeneratorfunction(func) or getattr(func, 'is_async', False):
+            raise TypeError("@batch can't decorate a coroutine task, "
+                            "use `with batch()` within it instead.")
+        self.func = func
+        self.commands = []
+        self.pending = []
+        self.results = None
+        self.deferred = None
+
+    def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # used as @batch()
+            return batch(args[0])
+        with batch():
+            return self.func(*args, **kwargs)
+
+    def add(self, cmd, fail, caller):
+        d = defer.Deferred()
+        if isInIOThread():
+            d.addCallback(check, fail, caller)
+        self.commands.append(cmd)
+        self.pending.append((d, fail, caller))
+        return d
+
+    def __enter__(self):
+        self.worker = thread_locals.worker
+        self.worker.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.worker.batch = None
+        if exc_type is not None or not self.commands:
+            return False
+        if isInIOThread():
+            # the batch's Deferred reports the first failure, so the commands'
+            # own Deferreds needn't be yielded
+            pending = [d for d, fail, caller in self.pending]
+            self.deferred = defer.gatherResults(pending, consumeErrors=True)
+            self.deferred.addErrback(lambda failure: failure.value.subFailure)
+            d = self.worker.execBatchFromThread(self.commands)
+            d.addCallbacks(self.resolve, self.reject)
+            return False
+        try:
+            results = blockingCFT(reactor, self.worker.execBatchFromThread,
+                                  self.commands)
+        except Exception:
+            self.reject(failure.Failure())
+            # raised from the block instead
+            for d, fail, caller in self.pending:
+                d.addErrback(lambda failure: None)
+            raise
+        self.resolve(results)
+        for result, (d, fail, caller) in zip(results, self.pending):
+            check(result, fail, caller)
+        return False
+
+    def resolve(self, results):
+        self.results = results
+        for result, (d, fail, caller) in zip(results, self.pending):
+            d.callback(result)
+        return results
+
+    def reject(self, reason):
+        for d, fail, caller in self.pending:
+            d.errback(reason)
 
 def sudo(cmd, *args, **kwargs):
     return run("sudo " + cmd)
@@ -2,6 +2,8 @@
 
 import urwid
 
+from twisted.internet import reactor
+
 from blinker import signal
 
 from plait.app.base import PlaitApp
@@ -49,9 +51,7 @@ class ConsoleApp(PlaitApp):
         super(ConsoleApp, self).__init__()
 
     def run(self, runner):
-        runner.run()
-        for host in runner.hosts:
-            self.tabs.addTab(host, WorkerLog())
+        reactor.callWhenRunning(runner.run)
         self.loop.run()
 
     def stop(self):
@@ -66,46 +66,68 @@ class ConsoleApp(PlaitApp):
     def show(self, w, header_text=""):
         self.root.show(w, header_text=header_text)
 
+    def tabFor(self, worker):
+        """
+        Get the tab for the given worker, which is added if it does not
+        already exist.
+        """
+        tab = self.tabs.tabs.get(worker.label)
+        if tab is None:
+            tab = self.tabs.addTab(worker.label, WorkerLog())
+        return tab
+
+    def on_worker_start(self, worker):
+        self.tabFor(worker)
+        self.loop.draw_screen()
+
     def on_worker_stdout(self, worker, data=None):
-        tab = self.tabs.tabs[worker.label]
+        tab = self.tabFor(worker)
         for line in data.split("\n"):
             tab.content.write(line)
         self.loop.draw_screen()
 
     def on_worker_stderr(self, worker, data=None):
-        tab = self.tabs.tabs[worker.label]
+        tab = self.tabFor(worker)
         tab.content.write(data)
         self.loop.draw_screen()
 
     def on_worker_connect(self, worker):
-        tab = self.tabs.tabs[worker.label]
+        tab = self.tabFor(worker)
         tab.set_cyan()
         self.loop.draw_screen()
 
     def on_worker_finish(self, worker):
-        tab = self.tabs.tabs[worker.label]
+        tab = self.tabFor(worker)
         if worker not in self.failed_workers:
             tab.set_green()
         self.loop.draw_screen()
 
     def on_worker_failure(self, worker, failure=None):
-        if worker.label not in self.tabs.tabs:
-            worker.label = "localhost"
-        tab = self.tabs.tabs[worker.label]
+        tab = self.tabFor(worker)
         tab.content.write(repr(failure))
         tab.set_red()
         self.failed_workers.append(worker)
         self.loop.draw_screen()
 
+    def on_batch_start(self, runner, index=None, size=None):
+        self.root.status(u"Batch {}: starting {} hosts".format(index, size))
+        self.loop.draw_screen()
+
+    def on_batch_finish(self, runner, index=None, size=None, completed=None,
+                        failures=None, duration=None):
+        text = u"Batch {}: {}/{} ok in {:.1f}s"
+        self.root.status(text.format(index, completed - failures, completed, duration))
+        self.loop.draw_screen()
+
     def on_task_start(self, worker, task=None):
-        tab = self.tabs.tabs[worker.label]
+        tab = self.tabFor(worker)
         task_template = u"↪ {task.tag}".format(task=task).encode('utf8')
         task_header = ('reversed', task_template)
         tab.content.write(task_header)
         self.loop.draw_screen()
 
     def on_task_failure(self, worker, task=None, failure=None):
-        tab = self.tabs.tabs[worker.label]
+        tab = self.tabFor(worker)
         tab.content.write(str(failure))
         tab.set_orange()
         self.failed_workers.append(worker)
@@ -113,7 +135,7 @@ class ConsoleApp(PlaitApp):
 
     def on_task_finish(self, worker, task=None, result=None):
         if result:
-            tab = self.tabs.tabs[worker.label]
+            tab = self.tabFor(worker)
             tab.content.write(str(result))
             self.loop.draw_screen()
 
@@ -72,6 +72,8 @@ class TerminalApp(PlaitApp):
         # whether to emit a report
         self.report = report
         self.report_only = report_only
+        # runner whose statistics are included in the report
+        self.runner = None
         # track progress
         self.successes = 0
         self.failures = 0
@@ -90,11 +92,14 @@ class TerminalApp(PlaitApp):
         )
         print t.bold_white("Plait results:")
         print report.encode('utf8')
+        for line in self.runner.stats():
+            print u"{} {}".format(self.task_glyph, line).encode('utf8')
 
     def run(self, runner):
         """
         Start the runner and block on the reactor.
         """
+        self.runner = runner
         @defer.inlineCallbacks
         def _(_):
             yield runner.run()
@@ -122,6 +127,12 @@ class TerminalApp(PlaitApp):
         self.sessions[worker] = session
         return session
 
+    def forgetSession(self, worker):
+        """
+        Drop the session data of a worker whose results have been handled.
+        """
+        self.sessions.pop(worker, None)
+
     def grepSession(self, session):
         if not session.tasks:
             return True
@@ -183,6 +194,44 @@ class TerminalApp(PlaitApp):
             render = self.renderSession(session, self.fail_glyph, failure=failure)
             self.printRender(render)
         self.failures += 1
+        self.forgetSession(worker)
+
+    def on_batch_start(self, runner, index=None, size=None):
+        """
+        A wave of hosts is starting.
+        """
+        msg = u"{}Batch {}: starting {} hosts\n".format(self.task_glyph, index, size)
+        if not self.report_only:
+            print t.bold_white(msg).encode('utf8')
+
+    def on_batch_finish(self, runner, index=None, size=None, completed=None,
+                        failures=None, duration=None):
+        """
+        A wave of hosts has finished.
+        """
+        glyph = self.fail_glyph if failures else self.success_glyph
+        msg = u"{}Batch {}: {}/{} ok in {:.1f}s\n"
+        msg = msg.format(glyph, index, completed - failures, completed, duration)
+        if not self.report_only:
+            print t.bold_white(msg).encode('utf8')
+
+    def on_runner_cancel(self, runner, reason=None):
+        """
+        The run has been cancelled, and the hosts in flight are being torn
+        down.
+        """
+        msg = u"{} Cancelling run: {}\n".format(self.fail_glyph, reason)
+        print t.bold_red(msg).encode('utf8')
+
+    def on_worker_straggler(self, worker, elapsed=None, median=None, action=None):
+        """
+        A worker is taking far longer than the rest. Stragglers which are
+        cancelled or detached are reported as failures, so only warn here.
+        """
+        if action == 'warn' and self.error_filter is not False:
+            msg = u"{} {}\nStill running after {:.1f}s, fleet median {:.1f}s\n"
+            msg = msg.format(self.warn_glyph, worker.host_string, elapsed, median)
+            self.printRender(t.yellow(msg).encode('utf8'))
 
     def on_task_start(self, worker, task=None):
         """
@@ -218,6 +267,7 @@ class TerminalApp(PlaitApp):
             render = self.renderSession(session, self.warn_glyph)
             self.printRender(render)
         self.warnings += 1
+        self.forgetSession(worker)
 
     def on_task_finish(self, worker, task=None, result=None):
         """
@@ -243,4 +293,5 @@ class TerminalApp(PlaitApp):
             self.empties += 1
         else:
             self.results += 1
+        self.forgetSession(worker)
 
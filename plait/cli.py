@@ -1,5 +1,5 @@
 
-import os, imp, getpass, sys, traceback, re
+import os, imp, getpass, sys, traceback, re, itertools, json, tempfile
 from pprint import pprint
 
 from twisted.python.filepath import FilePath
@@ -18,9 +18,13 @@ log = PrintLogger()
 from plait.app.console import ConsoleApp
 from plait.app.terminal import TerminalApp
 from plait.runner import PlaitRunner
+from plait.shard import RelayRunner, ShardApp, ShardedRunner, shareSettings
+from plait.serve import PlaitServer, ServerRunner
 from plait.task import NoSuchTaskError, task
+from plait.group import GroupRule, parse_inventory_line
+from plait.waves import Waves
 from plait.errors import *
-from plait.utils import parse_task_calls, Bag
+from plait.utils import parse_task_calls, parse_size, Bag
 
 def findPlaitfile(path=os.getcwd()):
     files = os.listdir(path)
@@ -52,7 +56,13 @@ def gatherTasks(tasks, pf_module):
         task_func = task(task_func)
         yield task_name, task_func, args, kwargs
 
-def getTasks(tasks, plaitfile, **kwargs):
+def getTasks(tasks, plaitfile, command, **kwargs):
+    if command:
+        if tasks:
+            raise StartupError("Tasks cannot be combined with `-c`.")
+        # an ad-hoc command needs neither plaitfile nor task function
+        return [(command, None, [], {})]
+
     if not tasks:
         raise StartupError("Must specify at least one task to execute.")
 
@@ -75,6 +85,11 @@ def getKeys(identity, **kwargs):
     if os.path.exists(key_path):
         return [readKey(key_path)]
 
+def getIdentity(identity, **kwargs):
+    key_path = os.path.expanduser(identity)
+    if os.path.exists(key_path):
+        return key_path
+
 def getKnownHosts(knownhosts, **kwargs):
     known_hosts_path = FilePath(os.path.expanduser(knownhosts))
     if known_hosts_path.exists():
@@ -85,16 +100,35 @@ def getAgentEndpoint(agent, **kwargs):
         auth_socket = os.environ["SSH_AUTH_SOCK"]
         return UNIXClientEndpoint(reactor, auth_socket)
 
-def getHosts(host, hostfile, **kwargs):
-    hosts = list(host)
+def readLines(fobj):
+    for line in fobj:
+        line = line.strip()
+        if line:
+            yield line
+
+def readHosts(host, hostfile):
+    """
+    Lazily read hosts from the commandline, the hostfile and stdin.
+
+    Each host may be followed by key=value group labels.
+    """
+    for host_string in host:
+        yield parse_inventory_line(host_string)
     if hostfile:
         with open(hostfile, 'r') as fobj:
-            hosts += tuple(l.strip() for l in fobj.readlines())
+            for line in readLines(fobj):
+                yield parse_inventory_line(line)
     if not sys.stdin.isatty():
-        hosts += tuple(l.strip() for l in sys.stdin.readlines())
-    if not len(hosts):
+        for line in readLines(sys.stdin):
+            yield parse_inventory_line(line)
+
+def getHosts(host, hostfile, **kwargs):
+    hosts = readHosts(host, hostfile)
+    try:
+        first = next(hosts)
+    except StopIteration:
         raise StartupError("Must specify at least one host.")
-    return hosts
+    return itertools.chain([first], hosts)
 
 def getErrorFilter(errors, hide_errors, **kwargs):
     if errors and hide_errors:
@@ -133,10 +167,189 @@ def getShowReport(report, **kwargs):
 def getAllTasks(all_tasks, **kwargs):
     return all_tasks
 
-def getConnectSettings(scale, retries, timeout, **kwargs):
-    return Bag(scale=scale,
+def getSpillThreshold(spill, **kwargs):
+    try:
+        return parse_size(spill)
+    except ValueError:
+        raise StartupError("Invalid spill threshold: {}".format(spill))
+
+def getScale(scale):
+    if scale == 'auto':
+        return scale
+    try:
+        return int(scale)
+    except ValueError:
+        raise StartupError("Scale must be a number or `auto`.")
+
+def getConnectRate(rate):
+    """
+    Parse a connection rate such as "50/s" or "600/m" into connections per
+    second. "0" disables the limit.
+    """
+    count, _, unit = rate.partition('/')
+    per = dict(s=1, m=60, h=3600)
+    try:
+        connect_rate = float(count) / per[unit or 's']
+    except (ValueError, KeyError):
+        raise StartupError("Invalid connection rate: {}".format(rate))
+    if connect_rate < 0:
+        raise StartupError("--connect-rate can't be negative.")
+    return connect_rate
+
+def getKeyValues(pairs, name):
+    if not all('=' in pair for pair in pairs):
+        raise StartupError("{} must look like key=value.".format(name))
+    return [pair.split('=', 1) for pair in pairs]
+
+def getGroupSettings(group_by, group_limit, group_window, **kwargs):
+    rules = getKeyValues(group_by, "Group patterns")
+    for key, pattern in rules:
+        try:
+            GroupRule(key, pattern)
+        except (ValueError, re.error):
+            raise StartupError("Invalid group pattern: {}".format(pattern))
+    try:
+        limits = dict((key, int(limit))
+                      for key, limit in getKeyValues(group_limit, "Group limits"))
+    except ValueError:
+        raise StartupError("Group limits must be numbers.")
+    return Bag(rules=rules, limits=limits, window=group_window)
+
+def getFailureRate(rate):
+    """
+    Parse a failure rate given as a fraction, "0.1", or a percentage, "10%".
+    """
+    try:
+        if rate.endswith('%'):
+            return float(rate[:-1]) / 100
+        return float(rate)
+    except ValueError:
+        raise StartupError("Invalid failure rate: {}".format(rate))
+
+def getBatch(batch):
+    if batch:
+        try:
+            Waves(batch, total=0)
+        except ValueError:
+            raise StartupError("Invalid batch sizes: {}".format(batch))
+    return batch
+
+def getHistory(history, schedule, **kwargs):
+    if schedule == 'longest-first' and not history:
+        raise StartupError("`--schedule longest-first` needs a history file.")
+    return os.path.expanduser(history) if history else None
+
+def hostLimits(scale, connect_scale, exec_scale):
+    """
+    The limits given on the number of hosts at once, each of which every
+    shard of the hosts needs a slot of.
+    """
+    limits = [("--connect-scale", connect_scale), ("--exec-scale", exec_scale)]
+    if scale.isdigit():
+        limits.insert(0, ("--scale", int(scale)))
+    return [(name, int(limit)) for name, limit in limits if int(limit)]
+
+def getProcesses(processes, batch, scale, relay, connect_scale, exec_scale,
+                 **kwargs):
+    if processes < 1:
+        raise StartupError("Processes must be at least 1.")
+    if processes > 1 and batch:
+        raise StartupError("`--batch` cannot be combined with `--processes`.")
+    if processes > 1 and relay:
+        raise StartupError("`--relay` cannot be combined with `--processes`.")
+    for name, limit in hostLimits(scale, connect_scale, exec_scale):
+        # every process needs a slot of its own
+        processes = min(processes, limit)
+    return processes
+
+def getRelays(relay, batch, scale, connect_scale, exec_scale, **kwargs):
+    """
+    Parse relays given as "name=user@host:22", or just "user@host:22" to be
+    named after the host string. "local" starts a relay on this machine.
+    """
+    if relay and batch:
+        raise StartupError("`--batch` cannot be combined with `--relay`.")
+    relays = []
+    for spec in relay:
+        name, _, host_string = spec.rpartition('=')
+        relays.append((name or host_string, host_string))
+    names = [name for name, host_string in relays]
+    if len(set(names)) < len(names):
+        raise StartupError("Relays must have different names.")
+    for name, limit in hostLimits(scale, connect_scale, exec_scale):
+        if relays and limit < len(relays):
+            msg = "{} must be at least the number of relays ({})."
+            raise StartupError(msg.format(name, len(relays)))
+    return relays
+
+def getServer(server, processes, relay, batch, **kwargs):
+    if not server:
+        return None
+    if processes > 1 or relay:
+        msg = "`--server` cannot be combined with `--processes` or `--relay`."
+        raise StartupError(msg)
+    if batch:
+        raise StartupError("`--batch` cannot be combined with `--server`.")
+    path = os.path.expanduser(server)
+    if not os.path.exists(path):
+        raise StartupError("No `plait serve` listening on {}.".format(path))
+    return path
+
+def getPlaitfileSource(plaitfile, command, **kwargs):
+    if command:
+        return None
+    with open(plaitfile or findPlaitfile()) as fobj:
+        return fobj.read().decode('utf8')
+
+def getJumpChannels(jump_channels, **kwargs):
+    if jump_channels < 1:
+        raise StartupError("--jump-channels must be at least 1.")
+    return jump_channels
+
+def getConnectSettings(scale, retries, timeout, task_threads, spill_dir, shell,
+                       backoff, backoff_max, preflight, preflight_scale,
+                       preflight_timeout, resolve, resolve_scale,
+                       connect_scale, exec_scale, connect_rate,
+                       connect_burst, **kwargs):
+    groups = getGroupSettings(**kwargs)
+    return Bag(scale=getScale(scale),
+               batch=getBatch(kwargs['batch']),
+               batch_threshold=getFailureRate(kwargs['batch_threshold']),
+               max_failures=kwargs['max_failures'],
+               max_failure_rate=getFailureRate(kwargs['max_failure_rate']),
+               command_timeout=kwargs['command_timeout'],
+               host_timeout=kwargs['host_timeout'],
+               straggler_action=kwargs['straggler_action'],
+               straggler_factor=kwargs['straggler_factor'],
+               straggler_min=kwargs['straggler_min'],
+               connect_rate=getConnectRate(connect_rate),
+               connect_burst=connect_burst,
+               connect_scale=connect_scale,
+               jump=kwargs['jump'],
+               jump_scale=kwargs['jump_scale'],
+               jump_channels=getJumpChannels(**kwargs),
+               transport=kwargs['transport'],
+               ssh_options=kwargs['ssh_option'],
+               identity=getIdentity(**kwargs),
+               exec_scale=exec_scale,
+               resolve=resolve,
+               resolve_scale=resolve_scale,
+               preflight=preflight,
+               preflight_scale=preflight_scale,
+               preflight_timeout=preflight_timeout,
                retries=retries,
+               backoff=backoff,
+               backoff_max=backoff_max,
                timeout=timeout,
+               task_threads=task_threads,
+               spill_threshold=getSpillThreshold(**kwargs),
+               schedule=kwargs['schedule'],
+               history=getHistory(**kwargs),
+               group_rules=groups.rules,
+               group_limits=groups.limits,
+               group_window=groups.window,
+               spill_dir=spill_dir,
+               persistent_shell=shell,
                keys = getKeys(**kwargs),
                known_hosts = getKnownHosts(**kwargs),
                agent_endpoint = getAgentEndpoint(**kwargs))
@@ -152,6 +365,9 @@ def getConnectSettings(scale, retries, timeout, **kwargs):
 @click.option('--plaitfile', '-p',
               default=None, metavar='',
               help="Read tasks from specified file")
+@click.option('--command', '-c',
+              default=None, metavar='',
+              help="Run a shell command instead of tasks")
 @click.option('--interactive', '-I',
               is_flag=True,
               help="Display results graphically")
@@ -180,14 +396,137 @@ def getConnectSettings(scale, retries, timeout, **kwargs):
               default=None, metavar='',
               help="Hide sessions matching a pattern")
 @click.option('--scale', '-s',
+              default="0", metavar='',
+              help="Number of hosts to execute in parallel, or `auto`")
+@click.option('--connect-scale',
               default=0, metavar='',
-              help="Number of hosts to execute in parallel")
+              help="Number of hosts connecting in parallel (0 for unbounded)")
+@click.option('--connect-rate',
+              default="0", metavar='',
+              help="Most new connections per second, e.g. 50/s (0 for no limit)")
+@click.option('--connect-burst',
+              default=1, metavar='',
+              help="Connections allowed at once before --connect-rate applies")
+@click.option('--schedule',
+              default='inventory', metavar='',
+              type=click.Choice(['inventory', 'longest-first']),
+              help="Start hosts in `inventory` order or `longest-first`")
+@click.option('--history',
+              default=None, metavar='',
+              help="Record per-host durations in this file, e.g. ~/.plait_history.json")
+@click.option('--group-by',
+              multiple=True, metavar='*',
+              help="Derive a group label, e.g. rack=/24 or dc='^(\w+)-'")
+@click.option('--group-limit',
+              multiple=True, metavar='*',
+              help="Most hosts running per group, e.g. dc=50")
+@click.option('--group-window',
+              default=1000, metavar='',
+              help="Hosts to look ahead for one whose groups have room")
+@click.option('--exec-scale',
+              default=0, metavar='',
+              help="Number of hosts running tasks in parallel (0 for unbounded)")
+@click.option('--processes', '-n',
+              default=1, metavar='',
+              help="Shard hosts across this many processes")
+@click.option('--shard',
+              default=None, type=int, hidden=True,
+              help="Run as shard N of a --processes or --relay run")
+@click.option('--relay',
+              multiple=True, metavar='*',
+              help="Run hosts through a relay, [name=]user@host[:22] or `local`")
+@click.option('--relay-by',
+              default=None, metavar='',
+              help="Send each host to the relay named by this label")
+@click.option('--relay-command',
+              default="plait relay", metavar='',
+              help="Command which starts a relay on a relay host")
+@click.option('--server',
+              default=None, metavar='',
+              help="Run as a job of the `plait serve` listening on this socket")
 @click.option('--retries', '-r',
               default=1, metavar='',
               help="Times to retry SSH connection")
+@click.option('--backoff',
+              default=1.0, metavar='',
+              help="Base seconds to back off between SSH tries")
+@click.option('--backoff-max',
+              default=60.0, metavar='',
+              help="Most seconds to back off between SSH tries")
 @click.option('--timeout', '-t',
               default=10, metavar='',
               help="Seconds to wait for SSH")
+@click.option('--jump', '-J',
+              default=None, metavar='',
+              help="Jump host to tunnel through, e.g. user@bastion:22")
+@click.option('--jump-scale',
+              default=0, metavar='',
+              help="Max hosts through each jump host at once (0 for unbounded)")
+@click.option('--jump-channels',
+              default=10, metavar='',
+              help="Hosts tunnelled over each jump host connection")
+@click.option('--transport',
+              default='conch', metavar='',
+              type=click.Choice(['conch', 'openssh']),
+              help="Connect with Twisted Conch or the system `ssh`")
+@click.option('--ssh-option', '-o',
+              multiple=True, metavar='*',
+              help="Option for the system `ssh`, e.g. Ciphers=aes128-ctr")
+@click.option('--resolve', '-D',
+              is_flag=True,
+              help="Resolve host names ahead of connecting, with caching")
+@click.option('--resolve-scale',
+              default=100, metavar='',
+              help="Number of DNS lookups in parallel")
+@click.option('--batch', '-b',
+              default=None, metavar='',
+              help="Run hosts in waves, e.g. 5% or 1,10,100")
+@click.option('--batch-threshold',
+              default="0", metavar='',
+              help="Stop after a wave with more failed hosts than this, e.g. 10%")
+@click.option('--max-failures',
+              default=0, metavar='',
+              help="Cancel the run after this many failed hosts (0 for no limit)")
+@click.option('--max-failure-rate',
+              default="0", metavar='',
+              help="Cancel the run past this rate of failed hosts, e.g. 10%")
+@click.option('--command-timeout',
+              default=0.0, metavar='',
+              help="Seconds before a remote command is stopped (0 for none)")
+@click.option('--host-timeout',
+              default=0.0, metavar='',
+              help="Seconds before a host's tasks are cut off (0 for none)")
+@click.option('--straggler-action',
+              default='warn', metavar='',
+              type=click.Choice(['warn', 'cancel', 'detach']),
+              help="What to do with hosts far slower than the rest")
+@click.option('--straggler-factor',
+              default=3.0, metavar='',
+              help="Times the median host time that makes a straggler")
+@click.option('--straggler-min',
+              default=10.0, metavar='',
+              help="Seconds a host must run before it can be a straggler")
+@click.option('--preflight', '-P',
+              is_flag=True,
+              help="Probe SSH ports and skip unreachable hosts")
+@click.option('--preflight-scale',
+              default=200, metavar='',
+              help="Number of hosts to probe in parallel")
+@click.option('--preflight-timeout',
+              default=2.0, metavar='',
+              help="Seconds to wait for a probe")
+@click.option('--task-threads', '-T',
+              default=100, metavar='',
+              help="Max threads running Tasks (0 for unbounded)")
+@click.option('--spill',
+              default="0", metavar='',
+              help="Spill command output past this size to disk, e.g. 64M")
+@click.option('--spill-dir',
+              default=None, metavar='',
+              help="Directory for spilled command output")
+@click.option('--shell',
+              is_flag=True,
+              help="Run commands through one persistent shell per host")
 @click.option('--identity', '-i',
               default="~/.ssh/id_rsa", metavar="*",
               help="Public key to use")
@@ -200,17 +539,40 @@ def getConnectSettings(scale, retries, timeout, **kwargs):
 @click.option('--logging', '-l',
               is_flag=True,
               help="Show twisted logging")
-def run(tasks, interactive, **kwargs):
+def run(tasks, interactive, shard, **kwargs):
     """
     * can be supplied multiple times
     """
     setupLogging(**kwargs)
 
     tasks = getTasks(tasks, **kwargs)
-    hosts = getHosts(**kwargs)
     connect_settings = getConnectSettings(**kwargs)
     all_tasks = getAllTasks(**kwargs)
-    runner = PlaitRunner(hosts, tasks, connect_settings, all_tasks)
+
+    if shard is not None:
+        # a process or relay of a sharded run, taking its hosts from the parent
+        app = ShardApp()
+        settings = shareSettings(connect_settings, shard, kwargs['processes'])
+        app.run(PlaitRunner(app.hosts, tasks, settings, all_tasks))
+        return
+
+    hosts = getHosts(**kwargs)
+    processes = getProcesses(**kwargs)
+    relays = getRelays(**kwargs)
+    server = getServer(**kwargs)
+    if server:
+        plaitfile = getPlaitfileSource(**kwargs)
+        runner = ServerRunner(hosts, connect_settings, server, sys.argv[1:],
+                              plaitfile)
+    elif relays:
+        plaitfile = getPlaitfileSource(**kwargs)
+        runner = RelayRunner(hosts, connect_settings, relays, sys.argv[1:],
+                             plaitfile, kwargs['relay_command'],
+                             kwargs['relay_by'])
+    elif processes > 1:
+        runner = ShardedRunner(hosts, connect_settings, processes, sys.argv[1:])
+    else:
+        runner = PlaitRunner(hosts, tasks, connect_settings, all_tasks)
 
     error_filter = getErrorFilter(**kwargs)
     grep_filter = getGrepFilter(**kwargs)
@@ -227,9 +589,108 @@ def run(tasks, interactive, **kwargs):
 
     app.run(runner)
 
+def readHeader():
+    """
+    Read the header line sent to a relay, without reading any further,
+    as the rest of stdin carries its hosts.
+    """
+    chars = []
+    while True:
+        char = os.read(0, 1)
+        if char in ('\n', ''):
+            return ''.join(chars)
+        chars.append(char)
+
+def relay():
+    """
+    Run a shard of a coordinator's hosts, using the command line and
+    plaitfile it sends first on stdin.
+    """
+    try:
+        header = json.loads(readHeader())
+    except ValueError:
+        raise StartupError("Relays are started by `plait --relay`.")
+    args = [arg.encode('utf8') for arg in header['argv']]
+    args += ['--processes', str(header['count']), '--shard', str(header['index'])]
+    path = savePlaitfile(header['plaitfile'])
+    if path:
+        args += ['--plaitfile', path]
+    try:
+        run(args=args)
+    finally:
+        removePlaitfile(path)
+
+def savePlaitfile(source):
+    """
+    Write a plaitfile sent along with a run to a temporary file, if there
+    is one, and return its path.
+    """
+    if source is None:
+        return None
+    fd, path = tempfile.mkstemp(prefix='plaitfile-', suffix='.py')
+    with os.fdopen(fd, 'w') as fobj:
+        fobj.write(source.encode('utf8'))
+    return path
+
+def removePlaitfile(path):
+    for filename in (path, path and path + 'c'):
+        if filename and os.path.exists(filename):
+            os.remove(filename)
+
+def parseJob(header):
+    """
+    The tasks, settings and all-tasks flag of a job sent to `plait serve`,
+    from its command line and plaitfile.
+    """
+    args = [arg.encode('utf8') for arg in header['argv']]
+    path = savePlaitfile(header['plaitfile'])
+    if path:
+        args += ['--plaitfile', path]
+    try:
+        kwargs = run.make_context('plait', args).params
+        tasks = getTasks(**kwargs)
+        # history and failing fast are left to the client
+        settings = shareSettings(getConnectSettings(**kwargs), 0, 1)
+        return tasks, settings, getAllTasks(**kwargs)
+    except click.ClickException as e:
+        raise StartupError(e.format_message())
+    finally:
+        removePlaitfile(path)
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.option('--socket',
+              default="~/.plait.sock", metavar='',
+              help="Unix socket to listen for jobs on")
+@click.option('--keepalive',
+              default=30.0, metavar='',
+              help="Seconds between keepalives on idle connections")
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def serve(socket, keepalive, args):
+    """
+    Keep connections to hosts open and run the jobs sent by `plait
+    --server`. Any hosts given are connected to up front, with the
+    connection options of a run.
+    """
+    kwargs = run.make_context('plait serve', list(args)).params
+    setupLogging(**kwargs)
+    server = PlaitServer(os.path.expanduser(socket), parseJob, keepalive)
+    hosts = readHosts(kwargs['host'], kwargs['hostfile'])
+    try:
+        first = next(hosts)
+    except StopIteration:
+        server.run()
+        return
+    settings = shareSettings(getConnectSettings(**kwargs), 0, 1)
+    server.run(itertools.chain([first], hosts), settings)
+
 def main():
     try:
-        run()
+        if sys.argv[1:2] == ['relay']:
+            relay()
+        elif sys.argv[1:2] == ['serve']:
+            serve(args=sys.argv[2:])
+        else:
+            run()
     except StartupError as e:
         log.error(" * " + e.message)
         if hasattr(e, 'tb'):
@@ -8,3 +8,16 @@ class TaskError(PlaitError): pass
 
 class TimeoutError(PlaitError): pass
 
+class UnreachableError(PlaitError): pass
+
+class ResolutionError(PlaitError): pass
+
+class HostTimeoutError(PlaitError): pass
+
+class StragglerError(PlaitError): pass
+
+class CancelledRunError(PlaitError): pass
+
+class ShardError(PlaitError): pass
+
+class TransportError(PlaitError): pass
@@ -46,3 +46,6 @@ class ConsoleFrame(BorderBox):
     def show(self, w, header_text=""):
         self._frame.contents['body'] = (BorderBox(w, **horizontalBorder()), None)
         self._frame._header.text = header_text
+
+    def status(self, text):
+        self._frame._header.text = text
@@ -0,0 +1,201 @@
+import re, socket
+
+from twisted.internet import defer
+
+from plait.utils import parse_host_string
+
+class HostString(str):
+    """
+    A host string carrying the group labels given for it in the inventory.
+    """
+    def __new__(cls, host_string, labels=None):
+        self = super(HostString, cls).__new__(cls, host_string)
+        self.labels = labels or {}
+        return self
+
+def parse_inventory_line(line):
+    """
+    Split an inventory line such as "root@web1:22 dc=east rack=r12" into a
+    HostString labelled with its key=value tokens.
+    """
+    tokens = line.split()
+    labels = dict(token.split('=', 1) for token in tokens[1:] if '=' in token)
+    return HostString(tokens[0], labels)
+
+def subnet(address, prefix):
+    """
+    The network of an IP address with the given prefix length, like
+    "10.1.2.0/24".
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address)
+    value = int(packed.encode('hex'), 16)
+    bits = len(packed) * 8
+    mask = ((1 << bits) - 1) ^ ((1 << (bits - prefix)) - 1)
+    network = ("%0*x" % (bits // 4, value & mask)).decode('hex')
+    return "{}/{}".format(socket.inet_ntop(family, network), prefix)
+
+class GroupRule(object):
+    """
+    Derives the `key` label of hosts which don't have one in the inventory.
+
+    A pattern like "/24" groups hosts by the subnet of their address, and
+    anything else is a regular expression matched against the host name,
+    whose first group (or whole match) is the label. Host names are
+    grouped by subnet using the addresses in `resolver`'s cache, if any.
+    """
+
+    def __init__(self, key, pattern, resolver=None):
+        self.key = key
+        self.resolver = resolver
+        self.prefix = None
+        self.regex = None
+        if pattern.startswith('/'):
+            self.prefix = int(pattern[1:])
+        else:
+            self.regex = re.compile(pattern)
+
+    def address(self, host):
+        try:
+            socket.inet_pton(socket.AF_INET6 if ':' in host else socket.AF_INET, host)
+            return host
+        except socket.error:
+            pass
+        cached = self.resolver and self.resolver.cache.get(host)
+        if cached and isinstance(cached[1], list) and cached[1]:
+            return cached[1][0][1]
+
+    def label(self, host):
+        if self.regex:
+            match = self.regex.search(host)
+            if match:
+                return match.group(1) if match.groups() else match.group(0)
+        else:
+            address = self.address(host)
+            if address:
+                return subnet(address, self.prefix)
+
+class GroupLimits(object):
+    """
+    Counts the hosts running in each group, such as each datacenter or
+    rack, against a limit per label key.
+    """
+
+    def __init__(self, limits, rules=()):
+        self.limits = limits # key: most hosts running per group
+        self.rules = rules
+        self.running = dict() # (key, label): hosts running
+        self.peaks = dict() # key: most hosts running in any one group
+
+    def groups(self, host_string):
+        """
+        The (key, label) groups a host belongs to which have a limit.
+        """
+        labels = dict(getattr(host_string, 'labels', {}))
+        user, host, port = parse_host_string(host_string)
+        for rule in self.rules:
+            if rule.key not in labels:
+                label = rule.label(host)
+                if label is not None:
+                    labels[rule.key] = label
+        return [(key, label) for key, label in labels.items() if key in self.limits]
+
+    def admits(self, groups):
+        return all(self.running.get(group, 0) < self.limits[group[0]]
+                   for group in groups)
+
+    def enter(self, groups):
+        for group in groups:
+            self.running[group] = self.running.get(group, 0) + 1
+            self.peaks[group[0]] = max(self.peaks.get(group[0], 0), self.running[group])
+
+    def leave(self, groups):
+        for group in groups:
+            self.running[group] -= 1
+            if not self.running[group]:
+                del self.running[group]
+
+class GroupedQueue(object):
+    """
+    Hands out entries of a HostQueue while keeping each group of hosts
+    under its limit.
+
+    Up to `window` entries are pulled ahead of the runner. The first one
+    whose groups all have room is handed out, so hosts from idle groups
+    overtake those stuck behind a busy one instead of holding up the run.
+    """
+
+    def __init__(self, queue, limits, window):
+        self.queue = queue
+        self.limits = limits
+        self.window = window
+        self.pending = [] # (entry, groups) pulled but not yet handed out
+        self.pulling = False
+        self.done = False
+        self.waiter = None
+        # metrics
+        self.peak_pending = 0
+        self.overtaken = 0
+
+    def pull(self):
+        """
+        Keep a request for the next entry outstanding while the window has
+        room.
+        """
+        if self.pulling or self.done or len(self.pending) >= self.window:
+            return
+        self.pulling = True
+        self.queue.next().addCallback(self.pulled)
+
+    def pulled(self, entry):
+        self.pulling = False
+        if entry is None:
+            self.done = True
+        else:
+            self.pending.append((entry, self.limits.groups(entry[0])))
+            self.peak_pending = max(self.peak_pending, len(self.pending))
+            self.pull()
+        self.wake()
+
+    def next(self):
+        """
+        Fires with the next entry to run, or None once no more can arrive.
+        """
+        self.pull()
+        for index, (entry, groups) in enumerate(self.pending):
+            if self.limits.admits(groups):
+                del self.pending[index]
+                if index:
+                    self.overtaken += 1
+                self.limits.enter(groups)
+                self.pull()
+                return defer.succeed((entry, groups))
+        # hosts still running may yet be requeued for a retry
+        running = self.queue.running or self.queue.delayed
+        if self.done and not self.pending and not running:
+            return defer.succeed(None)
+        self.waiter = defer.Deferred()
+        return self.waiter.addCallback(lambda _: self.next())
+
+    def refill(self, hosts):
+        self.queue.refill(hosts)
+        self.done = False
+
+    def finished(self, groups):
+        self.limits.leave(groups)
+        # the host may have been requeued for a retry
+        if self.done:
+            self.done = False
+            self.pull()
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None:
+            d, self.waiter = self.waiter, None
+            d.callback(None)
+
+    def stats(self):
+        peaks = ", ".join("{} {}/{}".format(key, self.limits.peaks.get(key, 0), limit)
+                          for key, limit in sorted(self.limits.limits.items()))
+        line = "groups: peak running {}, peak lookahead {}, {} hosts overtaken"
+        return line.format(peaks, self.peak_pending, self.overtaken)
@@ -0,0 +1,101 @@
+import heapq, json, os, tempfile
+
+class History(object):
+    """
+    How long each host has taken in previous runs, kept in a JSON file.
+
+    Durations are smoothed across runs with an exponentially weighted
+    average, so one unusual run doesn't decide a host's place for good.
+    """
+
+    # weight of the latest run in a host's average
+    weight = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self.durations = dict() # host_string: seconds
+        self.recorded = dict() # durations from this run
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fobj:
+                self.durations = json.load(fobj)
+        except (IOError, ValueError):
+            self.durations = dict()
+
+    def save(self):
+        """
+        Merge this run's durations into the file.
+        """
+        self.load()
+        for host_string, seconds in self.recorded.items():
+            previous = self.durations.get(host_string)
+            if previous is not None:
+                seconds = self.weight * seconds + (1 - self.weight) * previous
+            self.durations[host_string] = seconds
+        # write a sibling file and swap it in, so the history is never torn
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix=".plait-history-", dir=directory)
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(self.durations, fobj)
+        os.rename(tmp, self.path)
+
+    def record(self, host_string, seconds):
+        self.recorded[str(host_string)] = seconds
+
+    def duration(self, host_string):
+        return self.durations.get(str(host_string))
+
+    def estimates(self, hosts):
+        """
+        Expected duration of each host. Hosts without history are expected
+        to take the median time of those with it.
+        """
+        known = sorted(d for d in map(self.duration, hosts) if d is not None)
+        default = known[len(known) // 2] if known else 0.0
+        estimates = []
+        for host in hosts:
+            duration = self.duration(host)
+            estimates.append((host, default if duration is None else duration))
+        return estimates
+
+def makespan(durations, slots):
+    """
+    Wall time to run jobs of the given durations in order on `slots`
+    parallel slots (0 for unbounded), each job taking the first free slot.
+    """
+    if not slots:
+        return max(durations) if durations else 0.0
+    finishes = [0.0] * min(slots, len(durations))
+    heapq.heapify(finishes)
+    for duration in durations:
+        heapq.heapreplace(finishes, finishes[0] + duration)
+    return max(finishes) if finishes else 0.0
+
+class LongestFirst(object):
+    """
+    Longest-processing-time-first scheduling: orders hosts from the slowest
+    to the fastest according to their history, so that slow hosts don't
+    start last and stretch out the run.
+
+    The whole inventory has to be read before the first host can start.
+    """
+
+    def __init__(self, hosts, history, slots):
+        estimates = history.estimates(list(hosts))
+        self.known = sum(1 for host, d in estimates if history.duration(host) is not None)
+        self.inventory = makespan([d for host, d in estimates], slots)
+        estimates.sort(key=lambda estimate: estimate[1], reverse=True)
+        self.predicted = makespan([d for host, d in estimates], slots)
+        self.hosts = [host for host, d in estimates]
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def stats(self, actual):
+        line = ("schedule longest-first: predicted makespan {:.1f}s "
+                "({:.1f}s in inventory order), actual {:.1f}s, "
+                "{} of {} hosts with history")
+        return line.format(self.predicted, self.inventory, actual,
+                           self.known, len(self.hosts))
@@ -0,0 +1,261 @@
+from twisted.internet import defer, error, reactor
+from twisted.internet.address import IPv4Address
+from twisted.python.failure import Failure
+from twisted.conch.ssh import channel, forwarding
+
+from plait.scale import Stage
+from plait.transport import WorkerConnectionHelper
+from plait.utils import QuietConsoleUI, parse_host_string, timeout
+
+class TunnelChannel(channel.SSHChannel):
+    """
+    A direct-tcpip channel through a jump host to a target host, acting as
+    the transport of the SSH connection to the target.
+    """
+    name = b'direct-tcpip'
+
+    def __init__(self, link, protocol, host, port, opened, *args, **kwargs):
+        channel.SSHChannel.__init__(self, *args, **kwargs)
+        self.link = link
+        self.protocol = protocol
+        self.address = IPv4Address('TCP', host, port)
+        self.opened = opened
+
+    def channelOpen(self, specificData):
+        if self.opened.called:
+            # the connection attempt was cancelled while the channel opened
+            self.loseConnection()
+            return
+        self.protocol.makeConnection(self)
+        self.opened.callback(self.protocol)
+
+    def openFailed(self, reason):
+        self.link.release()
+        if not self.opened.called:
+            self.opened.errback(reason)
+
+    def dataReceived(self, data):
+        self.protocol.dataReceived(data)
+
+    def closed(self):
+        self.link.release()
+        if self.protocol.transport is self:
+            self.protocol.connectionLost(Failure(error.ConnectionDone()))
+
+    def abortConnection(self):
+        self.conn.sendClose(self)
+
+    @property
+    def connected(self):
+        return self.link.alive and self in self.conn.channelsToRemoteChannel
+
+    @property
+    def disconnecting(self):
+        return bool(self.closing)
+
+    def getPeer(self):
+        return self.address
+
+    def getHost(self):
+        return self.conn.transport.transport.getHost()
+
+class JumpLink(object):
+    """
+    One authenticated SSH connection to a jump host, carrying up to
+    `channels` tunnels at once.
+    """
+
+    def __init__(self, jump):
+        self.jump = jump
+        self.connection = None
+        self.tunnels = 0 # tunnels open or reserved
+        self.waiters = []
+
+    def connect(self):
+        jump = self.jump
+        helper = WorkerConnectionHelper(
+            reactor, jump.host, jump.port, b'', jump.user, jump.keys, None,
+            jump.agent, None, QuietConsoleUI())
+        d = timeout(jump.timeout, helper.secureConnection())
+        d.addCallbacks(self.connected, self.failed)
+
+    @property
+    def alive(self):
+        if self.connection is None:
+            return True # still connecting
+        return bool(self.connection.transport.transport.connected)
+
+    def ready(self):
+        """
+        Fires with this link once it is connected.
+        """
+        if self.connection is not None:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
+
+    def connected(self, connection):
+        self.connection = connection
+        self.jump.connections += 1
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(self)
+
+    def failed(self, failure):
+        self.jump.links.remove(self)
+        self.jump.failures += 1
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            self.tunnels -= 1
+            d.errback(failure)
+
+    def tunnel(self, protocol, host, port, opened):
+        """
+        Open a direct-tcpip channel to the target and connect `protocol` to
+        it. `opened` fires with the protocol once it is connected.
+        """
+        chan = TunnelChannel(self, protocol, host, port, opened,
+                             conn=self.connection)
+        data = forwarding.packOpen_direct_tcpip((host, port), ('127.0.0.1', 0))
+        self.connection.openChannel(chan, data)
+        self.jump.tunnelled += 1
+        self.jump.peak_channels = max(self.jump.peak_channels, self.tunnels)
+
+    def release(self):
+        self.tunnels -= 1
+
+    def close(self):
+        if self.connection is not None and self.alive:
+            self.connection.transport.loseConnection()
+
+class JumpEndpoint(object):
+    """
+    Client endpoint which reaches a host by tunnelling through a jump host.
+    """
+
+    def __init__(self, jump, host, port):
+        self.jump = jump
+        self.host = host
+        self.port = port
+
+    def connect(self, protocolFactory):
+        address = IPv4Address('TCP', self.host, self.port)
+        protocol = protocolFactory.buildProtocol(address)
+        opened = defer.Deferred()
+        def tunnel(link):
+            if not opened.called:
+                link.tunnel(protocol, self.host, self.port, opened)
+            else:
+                link.release()
+        def failed(failure):
+            if not opened.called:
+                opened.errback(failure)
+        self.jump.link().addCallbacks(tunnel, failed)
+        return opened
+
+class Jump(object):
+    """
+    A jump host, through which hosts are reached over direct-tcpip
+    channels rather than connections of their own.
+
+    Connections to the jump host are pooled and shared by every worker
+    going through it, each carrying up to `channels` tunnels. Another
+    connection is opened when they are all full. At most `limit` hosts run
+    through the jump host at once: the runner admits them as a `jump` group,
+    and its Stage counts them.
+    """
+
+    def __init__(self, host_string, keys, agent, timeout, channels=10, limit=0):
+        self.host_string = host_string
+        self.user, self.host, self.port = parse_host_string(host_string)
+        self.keys = keys
+        self.agent = agent
+        self.timeout = timeout
+        self.channels = channels
+        self.stage = Stage("jump {}".format(host_string), limit)
+        self.links = []
+        # metrics
+        self.connections = 0
+        self.failures = 0
+        self.tunnelled = 0
+        self.peak_channels = 0
+
+    def endpoint(self, host, port):
+        return JumpEndpoint(self, host, port)
+
+    def link(self):
+        """
+        Reserve a tunnel on a connection with room for one, opening a new
+        connection if there is none. Fires with the connection's link.
+        """
+        self.links = [link for link in self.links if link.alive]
+        for link in self.links:
+            if link.tunnels < self.channels:
+                link.tunnels += 1
+                return link.ready()
+        link = JumpLink(self)
+        self.links.append(link)
+        # reserved and waiting before connecting, which may fail at once
+        link.tunnels += 1
+        d = link.ready()
+        link.connect()
+        return d
+
+    def close(self):
+        for link in self.links:
+            link.close()
+
+    def stats(self):
+        line = ("jump {}: {} connections, {} failed, {} tunnels, "
+                "peak {} tunnels per connection")
+        return line.format(self.host_string, self.connections, self.failures,
+                           self.tunnelled, self.peak_channels)
+
+class JumpRule(object):
+    """
+    Group rule putting hosts without a `jump` label in the group of the
+    default jump host, if any, so that the hosts of each jump host can be
+    limited like a group's.
+    """
+    key = 'jump'
+
+    def __init__(self, default):
+        self.default = default
+
+    def label(self, host):
+        return self.default or None
+
+class JumpPool(object):
+    """
+    The jump hosts of a run. Hosts go through the jump host given by their
+    `jump` label in the inventory, or through `default`.
+    """
+
+    def __init__(self, default, keys, agent, timeout, channels=10, limit=0):
+        self.default = default
+        self.keys = keys
+        self.agent = agent
+        self.timeout = timeout
+        self.channels = channels
+        self.limit = limit
+        self.jumps = dict() # host_string: Jump
+
+    def jumpFor(self, host_string):
+        jump = getattr(host_string, 'labels', {}).get('jump', self.default)
+        if not jump:
+            return None
+        if jump not in self.jumps:
+            self.jumps[jump] = Jump(jump, self.keys, self.agent, self.timeout,
+                                    self.channels, self.limit)
+        return self.jumps[jump]
+
+    def close(self):
+        for jump in self.jumps.values():
+            jump.close()
+
+    def stats(self):
+        lines = []
+        for host_string, jump in sorted(self.jumps.items()):
+            lines += [jump.stats(), jump.stage.stats()]
+        return lines
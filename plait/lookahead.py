@@ -0,0 +1,91 @@
+from collections import deque
+
+from twisted.internet import defer
+
+class Lookahead(object):
+    """
+    Base for stages which check each host of an inventory stream ahead of
+    the runner, such as probing or resolving it. Subclasses define
+    `check(host_string)`, which returns a Deferred that fails if the host
+    should not be run.
+
+    Up to `concurrency` hosts are being checked or waiting to be run at any
+    time. Hosts which pass are handed on in the order their checks finish.
+    Hosts which fail are passed to `rejected` along with the failure and
+    never reach the runner.
+
+    Iterating yields Deferreds which fire with the next host to run, or with
+    None once the stream is exhausted. Stages can be chained by giving one
+    stage another as its hosts.
+    """
+
+    def __init__(self, hosts, concurrency, rejected):
+        self.hosts = iter(hosts)
+        self.concurrency = concurrency
+        self.rejected = rejected
+        self.exhausted = False
+        self.checking = 0
+        self.passed = deque() # hosts waiting to be run
+        self.waiter = None
+        self.filling = False
+        # metrics
+        self.checked = 0
+        self.failed = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.fill()
+        if self.passed:
+            return defer.succeed(self.passed.popleft())
+        if self.exhausted and not self.checking:
+            return defer.succeed(None)
+        self.waiter = defer.Deferred()
+        return self.waiter.addCallback(lambda _: self.next())
+
+    @defer.inlineCallbacks
+    def fill(self):
+        """
+        Start checks until the window is full or the stream runs out.
+        """
+        if self.filling:
+            return
+        self.filling = True
+        try:
+            while not self.exhausted and self.checking + len(self.passed) < self.concurrency:
+                # upstream stages yield Deferreds
+                host_string = yield next(self.hosts, None)
+                if host_string is None:
+                    self.exhausted = True
+                else:
+                    self.start(host_string)
+        finally:
+            self.filling = False
+        self.wake()
+
+    def start(self, host_string):
+        self.checking += 1
+        self.checked += 1
+        d = defer.maybeDeferred(self.check, host_string)
+        d.addCallbacks(self.accept, self.reject,
+                       callbackArgs=(host_string,), errbackArgs=(host_string,))
+
+    def accept(self, result, host_string):
+        self.passed.append(host_string)
+        self.done()
+
+    def reject(self, failure, host_string):
+        self.failed += 1
+        self.rejected(host_string, failure)
+        self.done()
+
+    def done(self):
+        self.checking -= 1
+        self.fill()
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None:
+            d, self.waiter = self.waiter, None
+            d.callback(None)
@@ -0,0 +1,27 @@
+from twisted.internet import reactor
+from twisted.internet.endpoints import HostnameEndpoint, connectProtocol
+from twisted.internet.protocol import Protocol
+
+from plait.lookahead import Lookahead
+from plait.utils import parse_host_string
+
+class Preflight(Lookahead):
+    """
+    Probes the SSH port of each host in an inventory stream before the
+    runner spends a handshake on it. Each probe is given `timeout` seconds
+    to connect, and hosts that don't answer are passed to `unreachable`.
+    """
+
+    def __init__(self, hosts, concurrency, timeout, unreachable):
+        super(Preflight, self).__init__(hosts, concurrency, unreachable)
+        self.timeout = timeout
+
+    def check(self, host_string):
+        user, host, port = parse_host_string(host_string)
+        endpoint = HostnameEndpoint(reactor, host, port, timeout=self.timeout)
+        d = connectProtocol(endpoint, Protocol())
+        return d.addCallback(lambda protocol: protocol.transport.loseConnection())
+
+    def stats(self):
+        line = "preflight: {} probed, {} unreachable"
+        return line.format(self.checked, self.failed)
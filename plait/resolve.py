@@ -0,0 +1,173 @@
+import socket, time
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.interfaces import IHostnameResolver, IHostResolution
+from twisted.python.failure import Failure
+from twisted.names import client, dns, error
+
+from plait.errors import ResolutionError
+from plait.lookahead import Lookahead
+from plait.utils import parse_host_string
+
+def interleave(first, second):
+    """
+    Alternate the items of two lists, starting with the first.
+    """
+    merged = []
+    for i in range(max(len(first), len(second))):
+        merged += first[i:i + 1] + second[i:i + 1]
+    return merged
+
+@implementer(IHostResolution)
+class HostResolution(object):
+    def __init__(self, name):
+        self.name = name
+
+    def cancel(self):
+        pass
+
+@implementer(IHostnameResolver)
+class CachingResolver(object):
+    """
+    Resolves host names asynchronously with twisted.names rather than in
+    the reactor's thread pool.
+
+    The A and AAAA records of each name are looked up together, and the
+    addresses are cached for as long as the shortest TTL among them allows.
+    Lookups of a name already being resolved share its query, and at most
+    `concurrency` queries are in flight at once.
+
+    Installed as the reactor's name resolver it answers every
+    HostnameEndpoint. That endpoint then tries each address in turn,
+    happy-eyeballs style. The addresses alternate between IPv6 and IPv4,
+    starting with IPv6.
+    """
+
+    # seconds to remember names that failed to resolve
+    negative_ttl = 30
+
+    def __init__(self, concurrency=100, resolver=None):
+        self.resolver = resolver or client.createResolver()
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.cache = dict() # name: (expiry, addresses or failure)
+        self.resolving = dict() # name: deferreds waiting on its query
+        # metrics
+        self.lookups = 0
+        self.hits = 0
+        self.failures = 0
+
+    def resolve(self, name):
+        """
+        Fires with a list of (address type, address) tuples for the name, or
+        fails with ResolutionError.
+        """
+        if isIPv6Address(name):
+            return defer.succeed([(IPv6Address, name)])
+        if isIPAddress(name):
+            return defer.succeed([(IPv4Address, name)])
+        cached = self.cache.get(name)
+        if cached and cached[0] > time.time():
+            self.hits += 1
+            return defer.succeed(cached[1])
+        d = defer.Deferred()
+        if name in self.resolving:
+            self.resolving[name].append(d)
+            return d
+        self.resolving[name] = [d]
+        self.lookups += 1
+        lookup = self.semaphore.run(self.lookup, name)
+        lookup.addBoth(self.resolved, name)
+        return d
+
+    def lookup(self, name):
+        lookups = [self.resolver.lookupIPV6Address(name),
+                   self.resolver.lookupAddress(name)]
+        d = defer.DeferredList(lookups, consumeErrors=True)
+        return d.addCallback(self.parse, name)
+
+    def parse(self, results, name):
+        """
+        Pull addresses and their TTL out of the AAAA and A lookup results.
+        """
+        ipv6, ipv4, ttls, errors = [], [], [], []
+        for success, result in results:
+            if not success:
+                if result.check(error.DNSNameError):
+                    errors.append("no such host")
+                else:
+                    errors.append(result.getErrorMessage() or result.type.__name__)
+                continue
+            answers, authority, additional = result
+            for record in answers:
+                if record.type == dns.AAAA:
+                    address = socket.inet_ntop(socket.AF_INET6, record.payload.address)
+                    ipv6.append((IPv6Address, address))
+                elif record.type == dns.A:
+                    ipv4.append((IPv4Address, record.payload.dottedQuad()))
+                else:
+                    continue
+                ttls.append(record.ttl)
+        if not ttls:
+            reason = errors[-1] if errors else "no addresses"
+            msg = "Could not resolve {}: {}".format(name, reason)
+            raise ResolutionError(msg)
+        return interleave(ipv6, ipv4), min(ttls)
+
+    def resolved(self, result, name):
+        waiting = self.resolving.pop(name)
+        if isinstance(result, Failure):
+            self.failures += 1
+            if not result.check(ResolutionError):
+                msg = "Could not resolve {}: {}".format(name, result.getErrorMessage())
+                result = Failure(ResolutionError(msg))
+            self.cache[name] = (time.time() + self.negative_ttl, result)
+        else:
+            addresses, ttl = result
+            self.cache[name] = (time.time() + ttl, addresses)
+            result = addresses
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0,
+                        addressTypes=None, transportSemantics='TCP'):
+        """
+        IHostnameResolver interface, answered from the cache.
+        """
+        resolutionReceiver.resolutionBegan(HostResolution(hostName))
+        def resolved(addresses):
+            for address_type, address in addresses:
+                if addressTypes is None or address_type in addressTypes:
+                    # conch wants the peer's host as a native string
+                    resolutionReceiver.addressResolved(
+                        address_type('TCP', str(address), portNumber))
+        d = self.resolve(hostName)
+        d.addCallback(resolved)
+        d.addErrback(lambda failure: None)
+        d.addCallback(lambda _: resolutionReceiver.resolutionComplete())
+        return resolutionReceiver
+
+    def stats(self):
+        line = "dns: {} lookups, {} cache hits, {} failures"
+        return line.format(self.lookups, self.hits, self.failures)
+
+class Resolution(Lookahead):
+    """
+    Resolves the name of each host in an inventory stream before the runner
+    gets to it, so connections are made from the warmed cache of `resolver`.
+    Hosts which fail to resolve are passed to `unresolved`.
+    """
+
+    def __init__(self, hosts, resolver, concurrency, unresolved):
+        super(Resolution, self).__init__(hosts, concurrency, unresolved)
+        self.resolver = resolver
+
+    def check(self, host_string):
+        user, host, port = parse_host_string(host_string)
+        return self.resolver.resolve(host)
@@ -1,7 +1,9 @@
-import sys
-from functools import partial
+import sys, time, itertools
+import signal as os_signal
+from collections import deque
 
-from twisted.internet import defer, error
+from twisted.internet import defer, error, reactor
+from twisted.python.failure import Failure
 from twisted.conch.error import HostKeyChanged
 
 from blinker import signal
@@ -11,8 +13,19 @@ log = get_logger()
 
 from plait.spool import ThreadedSignalFile
 from plait.worker import PlaitWorker
-from plait.utils import retry
-from plait.errors import TimeoutError, StartupError, TaskError
+from plait.thread import TaskPool
+from plait.scale import ScaleController, Stage, TokenBucket
+from plait.preflight import Preflight
+from plait.resolve import CachingResolver, Resolution
+from plait.group import GroupLimits, GroupRule, GroupedQueue
+from plait.history import History, LongestFirst
+from plait.jump import JumpPool, JumpRule
+from plait.transport import ConchTransport, OpenSSH
+from plait.straggler import Stragglers
+from plait.waves import Waves
+from plait.utils import Backoff, parse_host_string
+from plait.errors import TimeoutError, StartupError, TaskError, UnreachableError
+from plait.errors import CancelledRunError
 
 def flipio():
     sys._stdout, sys.stdout = sys.stdout, sys._stdout
@@ -23,18 +36,167 @@ def write(msg):
     print msg
     flipio()
 
+class HostQueue(object):
+    """
+    Hosts waiting to run: the inventory stream, followed at the back by hosts
+    due another connection attempt once their backoff delay has passed.
+
+    Entries are (host_string, attempt) tuples.
+    """
+
+    def __init__(self, hosts):
+        self.hosts = iter(hosts)
+        self.exhausted = False
+        self.retries = deque() # retries whose delay has passed
+        self.delayed = 0 # retries still waiting out their delay
+        self.running = 0
+        self.waiter = None
+
+    def refill(self, hosts):
+        """
+        Queue another stream of hosts once the current one is done.
+        """
+        self.hosts = iter(hosts)
+        self.exhausted = False
+
+    def retry(self, entry, delay):
+        self.delayed += 1
+        reactor.callLater(delay, self.ready, entry)
+
+    def ready(self, entry):
+        self.delayed -= 1
+        self.retries.append(entry)
+        self.wake()
+
+    def started(self):
+        self.running += 1
+
+    def finished(self):
+        self.running -= 1
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None:
+            d, self.waiter = self.waiter, None
+            d.callback(None)
+
+    @defer.inlineCallbacks
+    def next(self):
+        """
+        Fires with the next entry, or None once no more can arrive.
+        """
+        while True:
+            if not self.exhausted:
+                # sources such as Preflight yield Deferreds
+                host_string = yield next(self.hosts, None)
+                if host_string is not None:
+                    defer.returnValue((host_string, 1))
+                self.exhausted = True
+            if self.retries:
+                defer.returnValue(self.retries.popleft())
+            if not (self.running or self.delayed):
+                defer.returnValue(None)
+            self.waiter = defer.Deferred()
+            yield self.waiter
+
 class PlaitRunner(object):
+    # hosts to finish before --max-failure-rate applies
+    min_failure_samples = 10
+
     def __init__(self, hosts, tasks, settings, all_tasks=False):
         self.workers = {}
+        self.queue = None
         self.hosts = hosts
         self.tasks = tasks
-        self.scale = int(settings.scale)
+        self.scaler = None
+        if settings.scale == 'auto':
+            self.scaler = ScaleController()
+            self.scale = None
+        else:
+            self.scale = int(settings.scale)
+        self.connecting = Stage("connect", int(settings.connect_scale))
+        self.executing = Stage("exec", int(settings.exec_scale))
+        self.bucket = None
+        if settings.connect_rate:
+            self.bucket = TokenBucket(settings.connect_rate,
+                                      int(settings.connect_burst))
         self.retries = int(settings.retries)
+        self.backoff = Backoff(settings.backoff, maximum=settings.backoff_max)
         self.timeout = int(settings.timeout)
         self.keys = settings.keys
         self.agent = settings.agent_endpoint
         self.known_hosts = settings.known_hosts
         self.all_tasks = all_tasks
+        self.pool = TaskPool(int(settings.task_threads))
+        self.spill_threshold = settings.spill_threshold
+        self.spill_dir = settings.spill_dir
+        self.persistent_shell = settings.persistent_shell
+        self.command_timeout = float(settings.command_timeout)
+        self.jumps = JumpPool(settings.jump, self.keys, self.agent, self.timeout,
+                              int(settings.jump_channels), int(settings.jump_scale))
+        self.warm = None
+        self.openssh = None
+        if settings.transport == 'openssh':
+            self.openssh = OpenSSH(settings.identity, settings.ssh_options)
+        self.transport = self.openssh or ConchTransport
+        self.stragglers = Stragglers(settings.straggler_action,
+                                     float(settings.straggler_factor),
+                                     float(settings.straggler_min),
+                                     host_timeout=float(settings.host_timeout))
+        self.history = None
+        if settings.history:
+            self.history = History(settings.history)
+        self.schedule = None
+        if settings.schedule == 'longest-first':
+            limits = [n for n in (self.scale, int(settings.exec_scale)) if n]
+            slots = min(limits) if limits else 0
+            self.schedule = LongestFirst(self.hosts, self.history, slots)
+            self.hosts = self.schedule
+        self.started = self.finished = None
+        self.waves = None
+        self.batches = [] # (hosts, failures, seconds) of each wave
+        if settings.batch:
+            total = None
+            if Waves.isRelative(settings.batch):
+                # a share of the fleet needs the size of the fleet
+                self.hosts = list(self.hosts)
+                total = len(self.hosts)
+            self.waves = Waves(settings.batch, total)
+            self.batch_threshold = float(settings.batch_threshold)
+        # fail-fast
+        self.max_failures = int(settings.max_failures)
+        self.max_failure_rate = float(settings.max_failure_rate)
+        self.completed = 0
+        self.failures = 0
+        self.cancelled = None # reason the run was cancelled
+        self.interruptible = set() # deferreds failed by cancelling the run
+        self.resolver = None
+        self.resolution = None
+        stream = self.hosts
+        if settings.resolve:
+            self.resolver = CachingResolver(int(settings.resolve_scale))
+            stream = self.resolution = Resolution(stream, self.resolver,
+                                                  int(settings.resolve_scale),
+                                                  self.unresolved)
+        self.preflight = None
+        if settings.preflight:
+            stream = self.preflight = Preflight(stream,
+                                       int(settings.preflight_scale),
+                                       float(settings.preflight_timeout),
+                                       self.unreachable)
+        self.stream = stream
+        self.groups = None
+        self.grouped = None
+        limits = dict(settings.group_limits)
+        rules = [GroupRule(key, pattern, self.resolver)
+                 for key, pattern in settings.group_rules]
+        if int(settings.jump_scale):
+            # hosts wait for room at their jump host before taking a slot
+            limits['jump'] = int(settings.jump_scale)
+            rules.append(JumpRule(settings.jump))
+        if limits:
+            self.groups = GroupLimits(limits, rules)
+            self.group_window = int(settings.group_window)
 
     def installThreadIO(self):
         pass
@@ -50,37 +212,360 @@ class PlaitRunner(object):
         return PlaitWorker(self.tasks,
                            self.keys, self.agent,
                            self.known_hosts, self.timeout,
-                           self.all_tasks)
+                           self.all_tasks, pool=self.pool,
+                           spill_threshold=self.spill_threshold,
+                           spill_dir=self.spill_dir,
+                           persistent_shell=self.persistent_shell,
+                           command_timeout=self.command_timeout,
+                           jumps=self.jumps, warm=self.warm,
+                           transport=self.transport)
+
+    def startWorker(self, host_string, attempt=1):
+        """
+        Run a host, once its jump host, if any, has room for it.
+        """
+        jump = self.jumps.jumpFor(host_string)
+        if jump is None:
+            return self.runWorker(host_string, attempt)
+        return jump.stage.run(self.runWorker, host_string, attempt)
 
     @defer.inlineCallbacks
-    def runWorker(self, host_string):
+    def runWorker(self, host_string, attempt=1):
         worker = self.makeWorker()
+        worker.parse_host_string(host_string)
         self.workers[host_string] = worker
+        signal('worker_start').send(worker)
+        started = None # once connected, so waiting in line isn't counted
+        requeued = False
+        failed = True
         try:
             # try to get the worker connected to remote host
-            yield retry(self.retries, lambda: worker.connect(host_string))
+            try:
+                yield self.until(self.connecting.run(self.connectWorker, worker, host_string))
+            except Exception:
+                failure = Failure()
+                retry = not (self.cancelled or self.backoff.isFatal(failure))
+                if attempt < self.retries and retry:
+                    # give up the slot and try again from the back of the queue
+                    delay = self.backoff.delayFor(attempt)
+                    self.queue.retry((host_string, attempt + 1), delay)
+                    requeued = True
+                    signal('worker_retry').send(worker, delay=delay)
+                    return
+                failure.raiseException()
+            started = time.time()
             # run all tasks within the worker
-            yield worker.run()
+            yield self.until(self.executing.run(self.execute, worker))
+            failed = False
             signal('worker_finish').send(worker)
+        except CancelledRunError as e:
+            signal('worker_failure').send(worker, failure=e)
         except TaskError as e:
             signal('task_failure').send(worker, task=e.task, failure=e.failure)
         except (TimeoutError, error.ConnectingCancelledError) as e:
             msg = "Connection timedout after {} {}-second tries."
-            msg = msg.format(self.retries + 1, self.timeout)
+            msg = msg.format(attempt, self.timeout)
             signal('worker_failure').send(worker, failure=TimeoutError(msg))
         except HostKeyChanged as e:
             msg = "Host key has changed: {} lineno {}".format(e.path.path, e.lineno)
             signal('worker_failure').send(worker, failure=StartupError(msg))
         except Exception as e:
             signal('worker_failure').send(worker, failure=e)
+        finally:
+            # release finished workers so memory doesn't grow with the run
+            self.workers.pop(host_string, None)
+            if not (requeued or self.cancelled):
+                if self.history and started:
+                    self.history.record(host_string, time.time() - started)
+                self.tally(failed)
+
+    def execute(self, worker):
+        """
+        Run the worker's tasks, unless it is cut off as a straggler or for
+        running past the host timeout.
+        """
+        if self.cancelled:
+            return defer.fail(CancelledRunError(self.cancelled))
+        return self.stragglers.watch(worker, worker.run())
+
+    def until(self, d):
+        """
+        Fires with the outcome of `d`, or fails with CancelledRunError as
+        soon as the run is cancelled, whichever comes first.
+        """
+        if self.cancelled:
+            return defer.fail(CancelledRunError(self.cancelled))
+        outcome = defer.Deferred()
+        self.interruptible.add(outcome)
+        def settle(result):
+            if outcome in self.interruptible:
+                self.interruptible.remove(outcome)
+                outcome.callback(result)
+            elif isinstance(result, Failure):
+                # the run was cancelled first, so nobody is waiting on it
+                return None
+        d.addBoth(settle)
+        return outcome
+
+    def tally(self, failed):
+        """
+        Count a host's outcome, cancelling the run once there have been too
+        many failures.
+        """
+        self.completed += 1
+        if failed:
+            self.failures += 1
+        if self.max_failures and self.failures >= self.max_failures:
+            self.cancel("{} hosts failed.".format(self.failures))
+        elif self.max_failure_rate and self.completed >= self.min_failure_samples:
+            rate = float(self.failures) / self.completed
+            if rate > self.max_failure_rate:
+                msg = "{:.0%} of {} hosts failed."
+                self.cancel(msg.format(rate, self.completed))
+
+    def cancel(self, reason):
+        """
+        Stop the run: start no more hosts, fail those in flight and drop
+        their connections, which also unblocks their tasks' remote calls.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = reason
+        signal('runner_cancel').send(self, reason=reason)
+        # failing the deferreds releases their workers, so take them first
+        workers = list(self.workers.values())
+        interruptible, self.interruptible = self.interruptible, set()
+        for d in interruptible:
+            d.errback(CancelledRunError("Run cancelled: {}".format(reason)))
+        for worker in workers:
+            worker.abort()
+
+    def interrupt(self, signum, frame):
+        """
+        SIGINT handler which cancels the run, so that a partial report can
+        still be given. A second interrupt stops Plait at once.
+        """
+        if self.cancelled:
+            reactor.sigInt(signum, frame)
+        else:
+            reactor.callFromThread(self.cancel, "Interrupted.")
+
+    def reject(self, host_string, failure):
+        """
+        Report a host turned away before connecting to it.
+        """
+        worker = self.makeWorker()
+        worker.parse_host_string(host_string)
+        signal('worker_start').send(worker)
+        signal('worker_failure').send(worker, failure=failure)
+        self.tally(True)
+
+    def unreachable(self, host_string, failure):
+        """
+        Report a host which failed its preflight probe.
+        """
+        user, host, port = parse_host_string(host_string)
+        msg = "Port {} unreachable: {}".format(port, failure.getErrorMessage())
+        self.reject(host_string, UnreachableError(msg))
+
+    def unresolved(self, host_string, failure):
+        """
+        Report a host whose name failed to resolve.
+        """
+        self.reject(host_string, failure.value)
+
+    def connectWorker(self, worker, host_string):
+        """
+        Connect the worker once the connection rate limit allows.
+        """
+        if self.cancelled:
+            return defer.fail(CancelledRunError(self.cancelled))
+        if not self.bucket:
+            return self.handshake(worker, host_string)
+        d = self.bucket.acquire()
+        return d.addCallback(lambda _: self.handshake(worker, host_string))
+
+    def handshake(self, worker, host_string):
+        """
+        Connect the worker, reporting how it went to the scale controller.
+        """
+        d = worker.connect(host_string)
+        if not self.scaler:
+            return d
+        started = time.time()
+        def connected(result):
+            self.scaler.connected(time.time() - started)
+            return result
+        def failed(failure):
+            if failure.check(TimeoutError, error.ConnectingCancelledError):
+                self.scaler.timedout()
+            return failure
+        return d.addCallbacks(connected, failed)
 
     @defer.inlineCallbacks
     def run(self):
+        """
+        Run every host through a worker, at most `scale` at a time.
+
+        Within those, at most `connect_scale` hosts are connecting and at
+        most `exec_scale` are running their tasks at once. Hosts connect
+        while others execute, and wait connected for an execution slot.
+        With group limits, hosts are also kept under the limit of each group
+        they belong to, and hosts of idle groups may overtake others. The
+        hosts of each jump host are limited the same way, as a `jump` group,
+        so that hosts waiting on a busy jump host don't hold slots.
+
+        Hosts are pulled from `hosts` only as slots free up, so the inventory
+        may be an arbitrarily long iterator, unless hosts are scheduled
+        longest-first from their history, which reads the whole inventory
+        up front. With resolution or preflight
+        enabled, hosts have their names resolved or their ports probed ahead
+        of the runner first. Hosts that fail to connect give their slot up
+        and are retried from the back of the queue after a backoff delay,
+        unless the failure is one retrying won't fix. With `scale` set to
+        'auto' the number of slots is adjusted by a ScaleController as the
+        run goes. With `batch` set, hosts run in waves gated on the failure
+        rate of the wave before.
+        """
         self.installThreadIO()
+        self.started = time.time()
+        if self.resolver:
+            reactor.installNameResolver(self.resolver)
         signal('runner_start').send(self)
-        scale = self.scale or len(self.hosts)
-        semaphore = defer.DeferredSemaphore(scale)
-        consumer = partial(semaphore.run, self.runWorker)
-        workers = map(consumer, self.hosts)
-        yield defer.DeferredList(workers, consumeErrors=False)
+        if self.scaler:
+            semaphore = self.scaler.semaphore
+            self.scaler.start()
+        elif self.scale:
+            semaphore = defer.DeferredSemaphore(self.scale)
+        else:
+            semaphore = None
+        self.queue = HostQueue([])
+        if self.groups:
+            self.grouped = GroupedQueue(self.queue, self.groups, self.group_window)
+        interrupted = os_signal.signal(os_signal.SIGINT, self.interrupt)
+        if self.waves:
+            yield self.runWaves(semaphore)
+        else:
+            yield self.dispatch(self.stream, semaphore)
+        if self.scaler:
+            self.scaler.stop()
+        self.stragglers.stop()
+        self.release()
+        os_signal.signal(os_signal.SIGINT, interrupted)
+        self.finished = time.time()
+        if self.history:
+            self.history.save()
         signal('runner_finish').send(self)
+
+    def release(self):
+        """
+        Close the connections the run kept open for its hosts.
+        """
+        self.jumps.close()
+        if self.openssh is not None:
+            self.openssh.close()
+
+    @defer.inlineCallbacks
+    def dispatch(self, hosts, semaphore, first=None):
+        """
+        Run the given hosts, and the retries they need, to completion.
+        `first` is called before the first host is started. Fires with the
+        number of hosts started.
+        """
+        source = self.grouped or self.queue
+        source.refill(hosts)
+        inflight = set()
+        started = 0
+        def finished(result, d, groups):
+            inflight.discard(d)
+            if semaphore:
+                semaphore.release()
+            self.queue.finished()
+            if self.grouped:
+                self.grouped.finished(groups)
+        while not self.cancelled:
+            if semaphore:
+                yield semaphore.acquire()
+            try:
+                entry = yield self.until(source.next())
+            except CancelledRunError:
+                entry = None
+            groups = None
+            if self.grouped and entry:
+                entry, groups = entry
+            if entry is None:
+                if semaphore:
+                    semaphore.release()
+                break
+            if not started and first:
+                first()
+            if entry[1] == 1:
+                started += 1
+            self.queue.started()
+            d = self.startWorker(*entry)
+            if not d.called:
+                inflight.add(d)
+            d.addBoth(finished, d, groups)
+        # after a cancel, let the hosts in flight report their failures
+        yield defer.DeferredList(list(inflight))
+        defer.returnValue(started)
+
+    @defer.inlineCallbacks
+    def runWaves(self, semaphore):
+        """
+        Run hosts in waves, each starting once the one before it has
+        finished with no more than `batch_threshold` of its hosts failed.
+        Each wave is emitted as `batch_start` and `batch_finish` signals.
+        """
+        hosts = iter(self.stream)
+        for index, size in enumerate(self.waves, 1):
+            completed, failures = self.completed, self.failures
+            began = time.time()
+            start = lambda: signal('batch_start').send(self, index=index, size=size)
+            wave = itertools.islice(hosts, size)
+            started = yield self.dispatch(wave, semaphore, first=start)
+            if not started:
+                break
+            completed = self.completed - completed
+            failures = self.failures - failures
+            rate = float(failures) / completed if completed else 0.0
+            signal('batch_finish').send(self, index=index, size=started,
+                                        completed=completed, failures=failures,
+                                        duration=time.time() - began)
+            self.batches.append((completed, failures, time.time() - began))
+            if rate > self.batch_threshold and not self.cancelled:
+                msg = "{:.0%} of batch {} failed, over the {:.0%} threshold."
+                self.cancel(msg.format(rate, index, self.batch_threshold))
+            if self.cancelled or started < size:
+                break
+
+    def stats(self):
+        """
+        Lines of run statistics suitable for the summary report.
+        """
+        stats = []
+        if self.cancelled:
+            stats.append("cancelled: {}".format(self.cancelled))
+        stats += [self.pool.stats(),
+                 self.connecting.stats(),
+                 self.executing.stats()]
+        if self.bucket:
+            stats.append(self.bucket.stats())
+        if self.grouped:
+            stats.append(self.grouped.stats())
+        stats += self.jumps.stats()
+        stats += self.stragglers.stats()
+        if self.batches:
+            line = "batches: {} ({}), {}"
+            waves = ", ".join("{}/{} ok in {:.1f}s".format(hosts - failures, hosts, duration)
+                              for hosts, failures, duration in self.batches)
+            stats.append(line.format(len(self.batches), self.waves.spec, waves))
+        if self.schedule and self.finished:
+            stats.append(self.schedule.stats(self.finished - self.started))
+        if self.scaler:
+            stats.append(self.scaler.stats())
+        if self.resolver:
+            stats.append(self.resolver.stats())
+        if self.preflight:
+            stats.append(self.preflight.stats())
+        return stats
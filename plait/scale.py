@@ -0,0 +1,286 @@
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor, task
+
+from blinker import signal
+
+class AdjustableSemaphore(defer.DeferredSemaphore):
+    """
+    DeferredSemaphore whose limit can be changed while it is in use.
+
+    Lowering the limit below the number of tokens handed out leaves the
+    semaphore in debt, which is paid back by releases before anyone waiting
+    is woken.
+    """
+
+    def acquire(self):
+        d = defer.Deferred(canceller=self.waiting.remove)
+        if self.tokens <= 0:
+            self.waiting.append(d)
+        else:
+            self.tokens -= 1
+            d.callback(self)
+        return d
+
+    def release(self):
+        self.tokens += 1
+        self.wake()
+
+    def setLimit(self, limit):
+        self.tokens += limit - self.limit
+        self.limit = limit
+        self.wake()
+
+    def wake(self):
+        while self.tokens > 0 and self.waiting:
+            self.tokens -= 1
+            self.waiting.pop(0).callback(self)
+
+class ScaleController(object):
+    """
+    Adjusts the number of hosts in flight with additive-increase,
+    multiplicative-decrease (AIMD), like TCP congestion control.
+
+    Every `interval` seconds the controller looks at what happened since
+    its last decision. The limit is cut by `decrease` when connections time
+    out at more than `max_timeout_rate`, when the reactor falls more than
+    `max_lag` seconds behind, or when the median SSH handshake takes more
+    than `latency_factor` times the baseline. Otherwise, if hosts are
+    waiting for a slot, the limit grows by `increase`.
+
+    The baseline is an exponentially weighted average of the medians, with
+    `baseline_weight` given to the latest, so that it rises again after a
+    burst of unusually fast handshakes rather than holding the limit down.
+
+    Each decision is emitted as a `scale_change` signal.
+    """
+
+    initial = 16
+    minimum = 1
+    maximum = 4096
+    increase = 8
+    decrease = 0.5
+    interval = 1.0
+    max_timeout_rate = 0.05
+    max_lag = 0.25
+    latency_factor = 2.5
+    baseline_weight = 0.25
+
+    def __init__(self):
+        self.semaphore = AdjustableSemaphore(self.initial)
+        self.loop = task.LoopingCall(self.tick)
+        self.last_tick = None
+        # samples since the last decision
+        self.latencies = []
+        self.timeouts = 0
+        # decision history
+        self.baseline = None
+        self.peak = self.initial
+        self.increases = 0
+        self.decreases = dict()
+
+    @property
+    def limit(self):
+        return self.semaphore.limit
+
+    def start(self):
+        self.last_tick = time.time()
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def connected(self, duration):
+        """
+        Record the duration of a successful SSH handshake.
+        """
+        self.latencies.append(duration)
+
+    def timedout(self):
+        """
+        Record an SSH handshake that timed out.
+        """
+        self.timeouts += 1
+
+    def median(self, samples):
+        samples = sorted(samples)
+        return samples[len(samples) // 2]
+
+    def decide(self, lag):
+        """
+        Reason to decrease the limit, if any.
+        """
+        attempts = len(self.latencies) + self.timeouts
+        if attempts and float(self.timeouts) / attempts > self.max_timeout_rate:
+            return "timeouts"
+        if lag > self.max_lag:
+            return "reactor lag"
+        if self.latencies:
+            latency = self.median(self.latencies)
+            baseline, self.baseline = self.baseline, latency
+            if baseline is not None:
+                weight = self.baseline_weight
+                self.baseline = weight * latency + (1 - weight) * baseline
+                if latency > baseline * self.latency_factor:
+                    return "latency"
+
+    def tick(self):
+        now = time.time()
+        lag = max(0.0, now - self.last_tick - self.interval)
+        self.last_tick = now
+        reason = self.decide(lag)
+        self.latencies = []
+        self.timeouts = 0
+        if reason:
+            limit = max(self.minimum, int(self.limit * self.decrease))
+            self.decreases[reason] = self.decreases.get(reason, 0) + 1
+        elif self.semaphore.waiting:
+            limit = min(self.maximum, self.limit + self.increase)
+            reason = "demand"
+            self.increases += 1
+        else:
+            return
+        if limit != self.limit:
+            self.semaphore.setLimit(limit)
+            self.peak = max(self.peak, limit)
+            signal('scale_change').send(self, limit=limit, reason=reason)
+
+    def stats(self):
+        """
+        Summary of the controller's decisions.
+        """
+        decreases = sum(self.decreases.values())
+        reasons = ", ".join("{} {}".format(reason, count)
+                            for reason, count in sorted(self.decreases.items()))
+        line = "scale auto: limit {} (peak {}), {} increases, {} decreases"
+        line = line.format(self.limit, self.peak, self.increases, decreases)
+        if reasons:
+            line += " ({})".format(reasons)
+        if self.baseline is not None:
+            line += ", baseline handshake {:.3f}s".format(self.baseline)
+        return line
+
+class Stage(object):
+    """
+    A step of each host's run, such as connecting or executing its tasks,
+    with its own concurrency limit (0 for unbounded) and queueing metrics.
+    """
+
+    def __init__(self, name, limit=0):
+        self.name = name
+        self.limit = limit
+        self.semaphore = defer.DeferredSemaphore(limit) if limit else None
+        self.waiting = 0
+        self.active = 0
+        # metrics
+        self.entered = 0
+        self.peak_waiting = 0
+        self.peak_active = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @defer.inlineCallbacks
+    def run(self, f, *args, **kwargs):
+        """
+        Call `f` once a slot is free, holding the slot until it finishes.
+        """
+        self.entered += 1
+        if self.semaphore:
+            queued = time.time()
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            try:
+                yield self.semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            wait = time.time() - queued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            result = yield f(*args, **kwargs)
+        finally:
+            self.active -= 1
+            if self.semaphore:
+                self.semaphore.release()
+        defer.returnValue(result)
+
+    def stats(self):
+        """
+        Summary of the stage's queueing metrics.
+        """
+        limit = self.limit or "unbounded"
+        mean_wait = self.total_wait / self.entered if self.entered else 0.0
+        line = ("{} stage: {} hosts ({}), peak active {}, peak waiting {}, "
+                "wait avg {:.3f}s max {:.3f}s")
+        return line.format(self.name, self.entered, limit, self.peak_active,
+                           self.peak_waiting, mean_wait, self.max_wait)
+
+class TokenBucket(object):
+    """
+    Lets at most `rate` callers through per second, after an initial burst
+    of up to `burst`. Callers that arrive while the bucket is empty wait
+    their turn in order.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.waiting = deque() # (deferred, time queued)
+        self.call = None
+        # metrics
+        self.granted = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self):
+        """
+        Fires once a token has been taken from the bucket.
+        """
+        d = defer.Deferred()
+        self.waiting.append((d, time.time()))
+        # with a refill pending, the new caller queues behind the others
+        if self.call is None:
+            self.drain()
+        return d
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def tick(self):
+        self.call = None
+        self.drain()
+
+    def drain(self):
+        self.refill()
+        while self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            d, queued = self.waiting.popleft()
+            wait = time.time() - queued
+            self.granted += 1
+            if wait > 0.001:
+                self.delayed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            d.callback(None)
+        if self.waiting:
+            delay = (1 - self.tokens) / self.rate
+            self.call = reactor.callLater(delay, self.tick)
+
+    def stats(self):
+        """
+        Summary of the waits imposed by the bucket.
+        """
+        mean_wait = self.total_wait / self.granted if self.granted else 0.0
+        line = ("connect rate: {:g}/s (burst {}), {} connections, {} delayed, "
+                "wait avg {:.3f}s max {:.3f}s")
+        return line.format(self.rate, self.burst, self.granted, self.delayed,
+                           mean_wait, self.max_wait)
@@ -0,0 +1,326 @@
+import json, sys
+
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.internet.endpoints import UNIXClientEndpoint, UNIXServerEndpoint
+
+from plait.app.base import PlaitApp
+from plait.runner import PlaitRunner
+from plait.shard import ShardApp, ShardHosts, ShardedRunner, Shard
+from plait.spool import ThreadedSignalFile
+from plait.errors import StartupError
+
+class WarmPool(object):
+    """
+    SSH connections kept open between the jobs of a `plait serve` daemon,
+    so later jobs skip the handshake. Connections are kept under a key of
+    the host string and the settings they were made with, so that a job
+    only reuses those it would have made itself.
+
+    Every `interval` seconds each connection is sent a keepalive request.
+    A connection which hasn't answered the one before is dropped, as are
+    connections found closed, and their hosts connect afresh next time.
+    """
+
+    def __init__(self, interval=30.0):
+        self.interval = interval
+        self.transports = dict() # key: transport of the connection
+        self.pending = set() # transports with a keepalive unanswered
+        self.loop = task.LoopingCall(self.keepalive)
+        # metrics
+        self.reused = 0
+        self.opened = 0
+        self.dropped = 0
+        self.keepalives = 0
+
+    def take(self, key):
+        """
+        The open connection kept under a key, if any.
+        """
+        transport = self.transports.get(key)
+        if transport is None:
+            return None
+        if not transport.alive:
+            self.drop(key)
+            return None
+        self.reused += 1
+        return transport
+
+    def keep(self, key, transport):
+        self.transports[key] = transport
+        self.opened += 1
+
+    def drop(self, key):
+        transport = self.transports.pop(key)
+        self.pending.discard(transport)
+        self.dropped += 1
+        if transport.alive:
+            transport.disconnect()
+
+    def keepalive(self):
+        for key, transport in self.transports.items():
+            if transport in self.pending or not transport.alive:
+                self.drop(key)
+                continue
+            self.pending.add(transport)
+            self.keepalives += 1
+            d = transport.keepalive()
+            d.addBoth(lambda _, transport=transport: self.pending.discard(transport))
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def close(self):
+        if self.loop.running:
+            self.loop.stop()
+        for key in list(self.transports):
+            self.drop(key)
+
+    def stats(self, reused=0, opened=0):
+        """
+        Summary of the pool, counting connections reused and opened since
+        the given totals.
+        """
+        line = ("warm connections: {} open, {} reused, {} opened, "
+                "{} dropped, {} keepalives")
+        return line.format(len(self.transports), self.reused - reused,
+                           self.opened - opened, self.dropped, self.keepalives)
+
+class WarmView(object):
+    """
+    The connections of a WarmPool made with one job's settings: its
+    transport, key file, `ssh` options and the jump host of each host. Workers
+    take and keep connections through it by host string.
+    """
+
+    def __init__(self, warm, settings, jumps):
+        self.warm = warm
+        self.jumps = jumps
+        self.settings = (settings.transport, settings.identity,
+                         tuple(settings.ssh_options))
+
+    def key(self, host_string):
+        jump = self.jumps.jumpFor(host_string)
+        return (str(host_string), jump and jump.host_string) + self.settings
+
+    def take(self, host_string):
+        return self.warm.take(self.key(host_string))
+
+    def keep(self, host_string, transport):
+        self.warm.keep(self.key(host_string), transport)
+
+class ServeRunner(PlaitRunner):
+    """
+    Runs a job of a `plait serve` daemon, over the connections, task
+    threads, jump host connections and `ssh` control sockets it keeps
+    between jobs. Connections are only shared by jobs with the same
+    connection settings. The first job's pool sizes stand for every job
+    after it.
+    """
+
+    def __init__(self, hosts, tasks, settings, server, all_tasks=False):
+        super(ServeRunner, self).__init__(hosts, tasks, settings, all_tasks)
+        if server.pool is None:
+            server.pool = self.pool
+        self.pool = server.pool
+        # jump hosts are connected to with the job's key
+        self.jumps = server.jumps.setdefault(settings.identity, self.jumps)
+        # jobs hold the server's lock while they run, so the pool's default
+        # is this job's until the next one starts
+        self.jumps.default = settings.jump
+        if self.openssh is not None:
+            key = (settings.identity, tuple(settings.ssh_options))
+            self.openssh = server.openssh.setdefault(key, self.openssh)
+            self.transport = self.openssh
+        self.server = server
+        self.warm = WarmView(server.warm, settings, self.jumps)
+        self.reused, self.opened = server.warm.reused, server.warm.opened
+
+    def installThreadIO(self):
+        # only the first job redirects the standard IO
+        if not isinstance(sys.stdout, ThreadedSignalFile):
+            super(ServeRunner, self).installThreadIO()
+
+    def release(self):
+        # kept open for the next job
+        pass
+
+    def stats(self):
+        stats = super(ServeRunner, self).stats()
+        stats.append(self.server.warm.stats(self.reused, self.opened))
+        return stats
+
+class Job(ShardHosts):
+    """
+    A job sent to the daemon: a header line with the command line and
+    plaitfile, followed by its hosts, like the stream of a shard.
+    """
+
+    def __init__(self, server):
+        ShardHosts.__init__(self)
+        self.server = server
+        self.header = None
+        self.cancelled = None # reason given before the job started
+
+    def lineReceived(self, line):
+        if self.header is None:
+            self.header = json.loads(line)
+            self.server.submit(self)
+            return
+        message = json.loads(line)
+        if self.runner is None and 'cancel' in message:
+            self.cancelled = message['cancel']
+        else:
+            ShardHosts.lineReceived(self, line)
+
+    def connectionLost(self, reason):
+        if self.runner is not None and self.runner.finished is None:
+            self.runner.cancel("The client went away.")
+        ShardHosts.connectionLost(self, reason)
+
+class ServeApp(ShardApp):
+    """
+    Streams the events of each job to the client which sent it, as a shard
+    does to its parent, and logs the daemon's progress to stderr.
+    """
+
+    def __init__(self):
+        PlaitApp.__init__(self)
+        self.job = None
+
+    def write(self, line):
+        # events between jobs, such as from warming up, go nowhere
+        if self.job is not None:
+            self.job.transport.write(line)
+
+    def log(self, msg):
+        self._stderr.write(msg + '\n')
+
+class PlaitServer(protocol.Factory):
+    """
+    The `plait serve` daemon. It listens on a Unix socket for jobs, and
+    runs them one at a time over connections kept warm between jobs.
+
+    `parse` turns a job's header into its tasks, settings and all-tasks
+    flag, and raises StartupError if it can't.
+    """
+
+    def __init__(self, path, parse, keepalive=30.0):
+        self.path = path
+        self.parse = parse
+        self.warm = WarmPool(keepalive)
+        self.pool = None
+        self.jumps = dict() # key file: JumpPool
+        self.openssh = dict() # (key file, ssh options): OpenSSH
+        self.lock = defer.DeferredLock()
+        self.app = ServeApp()
+        self.jobs = 0
+
+    def buildProtocol(self, addr):
+        return Job(self)
+
+    @defer.inlineCallbacks
+    def warmUp(self, hosts, settings):
+        """
+        Connect to the inventory ahead of the first job.
+        """
+        runner = ServeRunner(hosts, [], settings, self)
+        yield self.lock.run(runner.run)
+        msg = "Warmed {} of {} hosts."
+        self.app.log(msg.format(runner.completed - runner.failures, runner.completed))
+
+    def close(self):
+        """
+        Close the connections kept warm, along with any jump host
+        connections and `ssh` masters.
+        """
+        self.warm.close()
+        for jumps in self.jumps.values():
+            jumps.close()
+        for openssh in self.openssh.values():
+            openssh.close()
+
+    def submit(self, job):
+        d = self.lock.run(self.runJob, job)
+        d.addErrback(self.failed, job)
+
+    def failed(self, failure, job):
+        self.app.log("Job failed: {}".format(failure.getTraceback()))
+        job.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def runJob(self, job):
+        if job.lost.called:
+            # the client gave up waiting
+            return
+        self.jobs += 1
+        index = self.jobs
+        try:
+            tasks, settings, all_tasks = self.parse(job.header)
+        except StartupError as e:
+            self.app.log("Job {} refused: {}".format(index, e.message))
+            job.transport.write(" * {}\n".format(e.message))
+            job.transport.loseConnection()
+            return
+        runner = ServeRunner(job, tasks, settings, self, all_tasks)
+        job.runner = runner
+        if job.cancelled:
+            runner.cancel(job.cancelled)
+        self.app.job = job
+        try:
+            yield runner.run()
+            self.app.emit('stats', lines=runner.stats())
+        finally:
+            self.app.job = None
+            job.transport.loseConnection()
+        msg = "Job {}: {} hosts, {} failed, in {:.1f}s."
+        self.app.log(msg.format(index, runner.completed, runner.failures,
+                                runner.finished - runner.started))
+
+    def run(self, hosts=None, settings=None):
+        """
+        Listen for jobs, after warming up `hosts` if given, until stopped.
+        """
+        @defer.inlineCallbacks
+        def _(_):
+            # other users mustn't run commands with our keys
+            endpoint = UNIXServerEndpoint(reactor, self.path, mode=0o600,
+                                          wantPID=True)
+            try:
+                yield endpoint.listen(self)
+            except error.CannotListenError as e:
+                self.app.log(" * Can't listen on {}: {}".format(self.path,
+                                                               e.socketError))
+                raise SystemExit(1)
+            self.app.log("Listening on {}.".format(self.path))
+            reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+            # wait for the reactor's signal handlers, which each job puts back
+            yield task.deferLater(reactor, 0, lambda: None)
+            self.warm.start()
+            if hosts is not None:
+                yield self.warmUp(hosts, settings)
+            yield defer.Deferred()
+        task.react(_)
+
+class ServerRunner(ShardedRunner):
+    """
+    Sends the run to a `plait serve` daemon as a job, along with the
+    plaitfile, and emits the job's events as this run's own.
+    """
+
+    kind = "server"
+
+    def __init__(self, hosts, settings, path, argv, plaitfile=None):
+        super(ServerRunner, self).__init__(hosts, settings, 1, argv)
+        self.path = path
+        self.plaitfile = plaitfile
+
+    def makeShard(self, index):
+        return Shard(self, index, "server")
+
+    def endpoint(self, shard):
+        return UNIXClientEndpoint(reactor, self.path)
+
+    def header(self, shard):
+        header = super(ServerRunner, self).header(shard)
+        header['plaitfile'] = self.plaitfile
+        return header
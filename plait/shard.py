@@ -0,0 +1,763 @@
+import json, os, sys, time
+import signal as os_signal
+from collections import Counter, deque
+
+from zope.interface import implementer
+
+from twisted.internet import defer, protocol, reactor, stdio, task
+from twisted.internet.endpoints import ProcessEndpoint, connectProtocol
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.python.threadable import isInIOThread
+from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
+
+from blinker import signal
+
+from plait.app.base import PlaitApp
+from plait.group import GroupLimits, GroupRule, HostString
+from plait.history import History, LongestFirst
+from plait.transport import WorkerEndpoint
+from plait.errors import ShardError, TimeoutError
+from plait.utils import Bag, QuietConsoleUI, parse_host_string, timeout
+
+def pack(data):
+    """
+    Carry output bytes through JSON unchanged, whatever their encoding.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    return str(data).decode('latin-1')
+
+def unpack(data):
+    return data.encode('latin-1')
+
+def text(value):
+    try:
+        return unicode(value)
+    except UnicodeDecodeError:
+        return str(value).decode('utf8', 'replace')
+
+def share(value, index, count):
+    """
+    The part of a limit given to shard `index` of `count`, so the parts add
+    up to the whole. No limit (0) stays no limit, and every shard gets at
+    least one, so limits on hosts at once must be at least `count`.
+    """
+    if not value:
+        return value
+    part = value // count + (1 if index < value % count else 0)
+    return max(part, 1)
+
+def shareSettings(settings, index, count):
+    """
+    The settings of one shard: the parallelism limits split between the
+    shards, and what needs the whole run, such as history and failing fast,
+    left to the parent.
+    """
+    shared = Bag(**settings.__dict__)
+    if settings.scale != 'auto':
+        shared.scale = share(int(settings.scale), index, count)
+    shared.connect_scale = share(int(settings.connect_scale), index, count)
+    shared.exec_scale = share(int(settings.exec_scale), index, count)
+    shared.task_threads = share(int(settings.task_threads), index, count)
+    shared.connect_rate = settings.connect_rate / count
+    shared.connect_burst = share(int(settings.connect_burst), index, count)
+    shared.jump_scale = share(int(settings.jump_scale), index, count)
+    # smaller group limits are kept whole, their groups pinned to one shard
+    shared.group_limits = dict(
+        (key, share(limit, index, count) if limit >= count else limit)
+        for key, limit in settings.group_limits.items())
+    shared.schedule = 'inventory'
+    shared.history = None
+    shared.batch = None
+    shared.max_failures = 0
+    shared.max_failure_rate = 0.0
+    return shared
+
+@implementer(IHalfCloseableProtocol)
+class ShardHosts(LineReceiver):
+    """
+    The hosts of a shard, sent by the parent on stdin as one JSON line each.
+    Iterating yields Deferreds, like a Lookahead stage, which fire with None
+    once the parent says the hosts have ended or closes the stream.
+
+    The parent may also send a reason to cancel the run, even after the
+    hosts have ended.
+    """
+    delimiter = b'\n'
+
+    def __init__(self):
+        self.hosts = deque()
+        self.closed = False
+        self.waiter = None
+        self.runner = None
+        self.lost = defer.Deferred()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.hosts:
+            return defer.succeed(self.hosts.popleft())
+        if self.closed:
+            return defer.succeed(None)
+        self.waiter = defer.Deferred()
+        return self.waiter.addCallback(lambda _: self.next())
+
+    def lineReceived(self, line):
+        message = json.loads(line)
+        if 'cancel' in message:
+            self.runner.cancel(message['cancel'])
+        elif 'end' in message:
+            self.readConnectionLost()
+        else:
+            self.hosts.append(HostString(str(message['host']), message['labels']))
+            self.wake()
+
+    def readConnectionLost(self):
+        self.closed = True
+        self.wake()
+
+    def writeConnectionLost(self):
+        pass
+
+    def connectionLost(self, reason):
+        self.readConnectionLost()
+        self.lost.callback(None)
+
+    def wake(self):
+        if self.waiter is not None:
+            d, self.waiter = self.waiter, None
+            d.callback(None)
+
+class ShardApp(PlaitApp):
+    """
+    Runs one shard of a `--processes` or `--relay` run: takes hosts from the
+    parent on stdin and streams the runner's events back as JSON lines on
+    stdout, for the parent to emit as its own.
+    """
+
+    def __init__(self):
+        super(ShardApp, self).__init__()
+        # interrupts reach the parent alone, which cancels its shards
+        os.setpgrp()
+        self.hosts = ShardHosts()
+        self.stdio = stdio.StandardIO(self.hosts)
+
+    def emit(self, event, worker=None, **fields):
+        fields['event'] = event
+        if worker is not None:
+            fields['worker'] = id(worker)
+        line = json.dumps(fields) + '\n'
+        if isInIOThread():
+            self.write(line)
+        else:
+            reactor.callFromThread(self.write, line)
+
+    def write(self, line):
+        self.stdio.write(line)
+
+    def run(self, runner):
+        self.hosts.runner = runner
+        @defer.inlineCallbacks
+        def _(_):
+            yield runner.run()
+            self.emit('stats', lines=runner.stats())
+            # let the last events drain before the reactor stops
+            self.stdio.loseConnection()
+            yield self.hosts.lost
+        task.react(_)
+
+    # main thread IO, such as from coroutine tasks
+
+    def main_stdout(self, sender, data=None):
+        self.emit('stdout', data=pack(data))
+
+    def main_stderr(self, sender, data=None):
+        self.emit('stderr', data=pack(data))
+
+    # runner event handlers
+
+    def on_worker_start(self, worker):
+        labels = getattr(worker.host_string, 'labels', {})
+        self.emit('worker_start', worker, host=str(worker.host_string),
+                  labels=labels)
+
+    def on_worker_retry(self, worker, delay=None):
+        self.emit('worker_retry', worker, delay=delay)
+
+    def on_worker_connect(self, worker):
+        self.emit('worker_connect', worker)
+
+    def on_worker_stdout(self, worker, data=None):
+        self.emit('worker_stdout', worker, data=pack(data))
+
+    def on_worker_stderr(self, worker, data=None):
+        self.emit('worker_stderr', worker, data=pack(data))
+
+    def on_task_start(self, worker, task=None):
+        self.emit('task_start', worker, tag=task.tag)
+
+    def on_task_finish(self, worker, task=None, result=None):
+        if result and not isinstance(result, basestring):
+            result = str(result)
+        self.emit('task_finish', worker, tag=task.tag,
+                  result=pack(result) if result else None)
+
+    def on_task_failure(self, worker, task=None, failure=None):
+        self.emit('task_failure', worker, tag=task.tag, failure=pack(str(failure)))
+
+    def on_worker_failure(self, worker, failure=None):
+        self.emit('worker_failure', worker, failure=text(failure))
+
+    def on_worker_finish(self, worker):
+        self.emit('worker_finish', worker)
+
+    def on_worker_straggler(self, worker, elapsed=None, median=None, action=None):
+        self.emit('worker_straggler', worker, elapsed=elapsed, median=median,
+                  action=action)
+
+class RemoteWorker(object):
+    """
+    Stands in for a worker running in a shard, for the handlers of the
+    parent's app.
+    """
+
+    def __init__(self, host_string, shard):
+        self.host_string = host_string
+        self.user, self.host, self.port = parse_host_string(host_string)
+        self.shard = shard
+
+    @property
+    def label(self):
+        return "{}@{}".format(self.user, self.host)
+
+class RemoteTask(object):
+    def __init__(self, tag):
+        self.tag = tag
+
+class Shard(protocol.Protocol):
+    """
+    The parent's end of the stream to a shard of the hosts, run by a child
+    process or a relay. Events read from it are emitted as signals from
+    RemoteWorkers.
+    """
+
+    def __init__(self, runner, index, name):
+        self.runner = runner
+        self.index = index
+        self.name = name
+        self.buffer = ''
+        self.workers = dict() # worker id in the child: worker
+        self.started = dict() # worker id in the child: time connected
+        self.assigned = Counter() # hosts sent and not yet finished
+        self.outstanding = 0
+        self.sent = 0
+        self.alive = False
+        self.ending = False
+        self.stats = []
+        self.lost = None # why the shard ended without finishing
+        self.ended = defer.Deferred()
+
+    def send(self, host_string):
+        labels = getattr(host_string, 'labels', {})
+        line = json.dumps(dict(host=str(host_string), labels=labels))
+        self.transport.write(line + '\n')
+        self.assigned[str(host_string)] += 1
+        self.outstanding += 1
+        self.sent += 1
+
+    def cancel(self, reason):
+        self.transport.write(json.dumps(dict(cancel=reason)) + '\n')
+
+    def end(self):
+        """
+        Tell the child there are no more hosts to come.
+        """
+        if self.alive and not self.ending:
+            self.ending = True
+            self.transport.write(json.dumps(dict(end=True)) + '\n')
+
+    def connectionMade(self):
+        self.alive = True
+        self.transport.write(json.dumps(self.runner.header(self)) + '\n')
+
+    def dataReceived(self, data):
+        self.buffer += data
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # not an event, such as a message from a failed startup
+                sys.stderr.write(line + '\n')
+                continue
+            handler = getattr(self, 'on_' + event.pop('event'), None)
+            if handler:
+                handler(**event)
+
+    def extReceived(self, dataType, data):
+        # a relay's stderr
+        sys.stderr.write(data)
+
+    def connectionLost(self, reason):
+        if self.ended.called:
+            return
+        self.alive = False
+        self.runner.shardEnded(self, reason)
+        self.ended.callback(None)
+
+    def relay(self, name, worker, **kwargs):
+        """
+        Emit a worker's event, unless it is from a worker already finished,
+        such as a detached straggler.
+        """
+        worker = self.workers.get(worker)
+        if worker is not None:
+            signal(name).send(worker, **kwargs)
+
+    def finish(self, worker, failed):
+        """
+        Forget a worker whose host has finished, and tell the runner.
+        """
+        started = self.started.pop(worker, None)
+        worker = self.workers.pop(worker, None)
+        if worker is None:
+            return
+        host = str(worker.host_string)
+        self.assigned[host] -= 1
+        if not self.assigned[host]:
+            del self.assigned[host]
+        self.outstanding -= 1
+        # with its labels, for the runner to find its groups
+        self.runner.hostFinished(worker.host_string, failed, started)
+
+    # child event handlers
+
+    def on_worker_start(self, worker=None, host=None, labels=None):
+        self.workers[worker] = RemoteWorker(HostString(str(host), labels), self)
+        signal('worker_start').send(self.workers[worker])
+
+    def on_worker_retry(self, worker=None, delay=None):
+        self.relay('worker_retry', worker, delay=delay)
+        self.workers.pop(worker, None)
+        self.started.pop(worker, None)
+
+    def on_worker_connect(self, worker=None):
+        if worker in self.workers:
+            self.started[worker] = time.time()
+        self.relay('worker_connect', worker)
+
+    def on_worker_stdout(self, worker=None, data=None):
+        self.relay('worker_stdout', worker, data=unpack(data))
+
+    def on_worker_stderr(self, worker=None, data=None):
+        self.relay('worker_stderr', worker, data=unpack(data))
+
+    def on_task_start(self, worker=None, tag=None):
+        self.relay('task_start', worker, task=RemoteTask(tag))
+
+    def on_task_finish(self, worker=None, tag=None, result=None):
+        result = unpack(result) if result else None
+        self.relay('task_finish', worker, task=RemoteTask(tag), result=result)
+
+    def on_task_failure(self, worker=None, tag=None, failure=None):
+        self.relay('task_failure', worker, task=RemoteTask(tag),
+                   failure=unpack(failure))
+        self.finish(worker, True)
+
+    def on_worker_failure(self, worker=None, failure=None):
+        self.relay('worker_failure', worker, failure=ShardError(failure))
+        self.finish(worker, True)
+
+    def on_worker_finish(self, worker=None):
+        self.relay('worker_finish', worker)
+        self.finish(worker, False)
+
+    def on_worker_straggler(self, worker=None, elapsed=None, median=None,
+                            action=None):
+        self.relay('worker_straggler', worker, elapsed=elapsed, median=median,
+                   action=action)
+
+    def on_stdout(self, data=None):
+        sys.stdout.write(unpack(data))
+
+    def on_stderr(self, data=None):
+        sys.stderr.write(unpack(data))
+
+    def on_stats(self, lines=None):
+        self.stats = lines
+
+class ShardedRunner(object):
+    """
+    Shards the hosts across `count` child processes, each running a
+    PlaitRunner with its own reactor, so the CPU-bound work of SSH is spread
+    over several cores.
+
+    The children are started with `plait relay`, and sent the command line
+    of this run. Hosts are sent to whichever shard has the fewest
+    unfinished, at most `window` ahead. The parallelism limits are split
+    between the shards, as are group limits of at least one host per shard.
+    Smaller group limits can't be split, so the unfinished hosts of each
+    such group are kept together on one shard, which enforces the limit.
+    History, longest-first scheduling and failing fast are handled here for
+    the whole run.
+
+    The shards' events are emitted here as the usual runner signals, from
+    RemoteWorkers, so apps work unchanged.
+    """
+
+    kind = "processes"
+    command = "from plait.cli import main; main()"
+    # least hosts sent ahead of a shard
+    window = 10
+    # hosts to finish before --max-failure-rate applies
+    min_failure_samples = 10
+
+    def __init__(self, hosts, settings, count, argv):
+        self.hosts = hosts
+        self.argv = argv
+        self.count = count
+        if settings.scale != 'auto' and int(settings.scale):
+            self.window = max(self.window, 2 * int(settings.scale) // count)
+        else:
+            self.window = 1000
+        self.shards = []
+        self.connected = False
+        self.history = None
+        if settings.history:
+            self.history = History(settings.history)
+        self.schedule = None
+        if settings.schedule == 'longest-first':
+            limits = [int(n) for n in (settings.scale, settings.exec_scale)
+                      if n != 'auto' and int(n)]
+            slots = min(limits) if limits else 0
+            self.schedule = LongestFirst(self.hosts, self.history, slots)
+            self.hosts = self.schedule
+        self.hosts = iter(self.hosts)
+        self.aside = [] # hosts waiting for room on their shard
+        self.exhausted = False
+        self.groups = None
+        pinned = dict((key, limit) for key, limit in settings.group_limits.items()
+                      if limit < count)
+        if pinned:
+            rules = [GroupRule(key, pattern)
+                     for key, pattern in settings.group_rules]
+            self.groups = GroupLimits(pinned, rules)
+        self.pinned = dict() # group: shard its unfinished hosts are on
+        self.held = Counter() # group: its unfinished hosts
+        self.started = self.finished = None
+        # fail-fast
+        self.max_failures = int(settings.max_failures)
+        self.max_failure_rate = float(settings.max_failure_rate)
+        self.completed = 0
+        self.failures = 0
+        self.cancelled = None
+
+    def makeShard(self, index):
+        return Shard(self, index, "shard {}".format(index))
+
+    def endpoint(self, shard):
+        """
+        Endpoint which starts the shard.
+        """
+        args = [sys.executable, '-c', self.command, 'relay']
+        return ProcessEndpoint(reactor, sys.executable, args, env=os.environ,
+                               childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def connect(self, shard):
+        d = connectProtocol(self.endpoint(shard), shard)
+        return d.addErrback(shard.connectionLost)
+
+    def header(self, shard):
+        """
+        The first line sent to a shard: the command line to run its hosts
+        with, which shard it is and the plaitfile, if it needs one.
+        """
+        return dict(argv=self.argv, index=shard.index, count=self.count,
+                    plaitfile=None)
+
+    def groupsOf(self, host_string):
+        """
+        The groups of a host which are kept together on one shard.
+        """
+        return self.groups.groups(host_string) if self.groups else []
+
+    def pinnedShards(self, host_string):
+        """
+        The live shards with unfinished hosts of the same pinned groups as
+        a host.
+        """
+        return set(self.pinned[group] for group in self.groupsOf(host_string)
+                   if group in self.pinned and self.pinned[group].alive)
+
+    def shardFor(self, host_string):
+        """
+        The shard a host should go to, or None if it has to wait.
+
+        Hosts go to the shard with unfinished hosts of their pinned groups,
+        if any, and otherwise to whichever has the fewest unfinished. A host
+        whose groups are on different shards waits until all but one of
+        them have finished there.
+        """
+        live = [shard for shard in self.shards if shard.alive]
+        if not live:
+            return None
+        pinned = self.pinnedShards(host_string)
+        if len(pinned) > 1:
+            return None
+        if pinned:
+            return pinned.pop()
+        return min(live, key=lambda shard: shard.outstanding)
+
+    def place(self, host_string):
+        """
+        Send a host to its shard, if that has room. Returns whether the
+        host has been dealt with.
+        """
+        try:
+            shard = self.shardFor(host_string)
+        except ShardError as e:
+            self.reject(host_string, e)
+            return True
+        if shard is None:
+            if not any(shard.alive for shard in self.shards):
+                self.cancel("Every shard has been lost.")
+            return False
+        if shard.outstanding >= self.window:
+            return False
+        for group in self.groupsOf(host_string):
+            if self.pinned.get(group) is not shard:
+                # its hosts had finished, or were on a lost shard
+                self.pinned[group] = shard
+                self.held[group] = 0
+            self.held[group] += 1
+        shard.send(host_string)
+        return True
+
+    def feed(self):
+        """
+        Send hosts to the shards while they have room. A host which can't
+        go yet, because its shard is full or its groups are on different
+        shards, is set aside so the hosts behind it can go to others, up to
+        `window` of them.
+        """
+        if not self.connected:
+            return
+        for host_string in list(self.aside):
+            if self.cancelled:
+                return
+            if self.place(host_string):
+                self.aside.remove(host_string)
+        while not (self.exhausted or self.cancelled) and len(self.aside) < self.window:
+            live = [shard for shard in self.shards if shard.alive]
+            if live and all(shard.outstanding >= self.window for shard in live):
+                break
+            host_string = next(self.hosts, None)
+            if host_string is None:
+                self.exhausted = True
+            elif not self.place(host_string):
+                self.aside.append(host_string)
+        if self.exhausted and not self.aside:
+            for shard in self.shards:
+                shard.end()
+
+    def reject(self, host_string, failure):
+        """
+        Report a host no shard can take.
+        """
+        worker = RemoteWorker(host_string, None)
+        signal('worker_start').send(worker)
+        signal('worker_failure').send(worker, failure=failure)
+        self.tally(True)
+
+    def hostFinished(self, host_string, failed, started):
+        for group in self.groupsOf(host_string):
+            if self.held[group]:
+                self.held[group] -= 1
+                if not self.held[group]:
+                    del self.held[group], self.pinned[group]
+        if not self.cancelled:
+            if self.history and started:
+                self.history.record(host_string, time.time() - started)
+            self.tally(failed)
+        self.feed()
+
+    def shardEnded(self, shard, reason):
+        """
+        Fail the hosts a shard took with it, if it ended before they
+        finished.
+        """
+        status = reason.value
+        if getattr(status, 'signal', None):
+            why = "killed by signal {}".format(status.signal)
+        elif getattr(status, 'exitCode', None) is not None:
+            why = "exited with code {}".format(status.exitCode)
+        else:
+            why = reason.getErrorMessage().rstrip('.')
+        if not shard.stats:
+            shard.lost = why
+        msg = "Lost {}: {}.".format(shard.name, why)
+        for worker in list(shard.workers):
+            shard.relay('worker_failure', worker, failure=ShardError(msg))
+            shard.finish(worker, True)
+        if self.cancelled:
+            # like the hosts left in the inventory, these never started
+            shard.assigned.clear()
+        # hosts sent but never started
+        for host_string in list(shard.assigned.elements()):
+            shard.workers[host_string] = RemoteWorker(host_string, shard)
+            signal('worker_start').send(shard.workers[host_string])
+            shard.relay('worker_failure', host_string, failure=ShardError(msg))
+            shard.finish(host_string, True)
+        self.feed()
+
+    def tally(self, failed):
+        """
+        Count a host's outcome, cancelling the run once there have been too
+        many failures.
+        """
+        self.completed += 1
+        if failed:
+            self.failures += 1
+        if self.max_failures and self.failures >= self.max_failures:
+            self.cancel("{} hosts failed.".format(self.failures))
+        elif self.max_failure_rate and self.completed >= self.min_failure_samples:
+            rate = float(self.failures) / self.completed
+            if rate > self.max_failure_rate:
+                msg = "{:.0%} of {} hosts failed."
+                self.cancel(msg.format(rate, self.completed))
+
+    def cancel(self, reason):
+        """
+        Stop sending hosts and have every shard cancel its run.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = reason
+        signal('runner_cancel').send(self, reason=reason)
+        for shard in self.shards:
+            if shard.alive:
+                shard.cancel(reason)
+                shard.end()
+
+    def interrupt(self, signum, frame):
+        """
+        SIGINT handler which cancels the run, so that a partial report can
+        still be given. A second interrupt stops Plait at once.
+        """
+        if self.cancelled:
+            reactor.sigInt(signum, frame)
+        else:
+            reactor.callFromThread(self.cancel, "Interrupted.")
+
+    @defer.inlineCallbacks
+    def run(self):
+        """
+        Start the shards, feed them hosts and wait for them all to end.
+        """
+        self.started = time.time()
+        signal('runner_start').send(self)
+        interrupted = os_signal.signal(os_signal.SIGINT, self.interrupt)
+        self.shards = [self.makeShard(index) for index in range(self.count)]
+        yield defer.DeferredList([self.connect(shard) for shard in self.shards])
+        self.connected = True
+        self.feed()
+        yield defer.DeferredList([shard.ended for shard in self.shards])
+        os_signal.signal(os_signal.SIGINT, interrupted)
+        self.finished = time.time()
+        if self.history:
+            self.history.save()
+        signal('runner_finish').send(self)
+
+    def stats(self):
+        """
+        Lines of run statistics suitable for the summary report, followed
+        by those of each shard.
+        """
+        stats = []
+        if self.cancelled:
+            stats.append("cancelled: {}".format(self.cancelled))
+        line = "{}: {}, hosts sent {}"
+        sent = "/".join(str(shard.sent) for shard in self.shards)
+        stats.append(line.format(self.kind, len(self.shards), sent))
+        if self.schedule and self.finished:
+            stats.append(self.schedule.stats(self.finished - self.started))
+        for shard in self.shards:
+            if shard.lost:
+                stats.append("{}: lost, {}".format(shard.name, shard.lost))
+            for line in shard.stats:
+                stats.append("{}: {}".format(shard.name, line))
+        return stats
+
+class RelayRunner(ShardedRunner):
+    """
+    Hands shards of the hosts to relays: copies of Plait started with
+    `relay_command` over SSH on intermediate hosts, such as the bastions in
+    front of each datacenter. Each relay connects to its hosts itself and
+    streams their events back over its one connection. The plaitfile is
+    sent along with the command line.
+
+    `relays` are (name, host_string) pairs, and a relay on host `local` is
+    started as a child process instead. With `relay_by`, hosts go to the
+    relay named by their label for that key, and hosts without a relay
+    fail.
+    """
+
+    kind = "relays"
+
+    def __init__(self, hosts, settings, relays, argv, plaitfile=None,
+                 relay_command="plait relay", relay_by=None):
+        super(RelayRunner, self).__init__(hosts, settings, len(relays), argv)
+        self.relays = relays
+        self.plaitfile = plaitfile
+        self.relay_command = relay_command
+        self.relay_by = relay_by
+        self.keys = settings.keys
+        self.agent = settings.agent_endpoint
+        self.timeout = int(settings.timeout)
+        self.named = dict() # name: shard
+
+    def makeShard(self, index):
+        name, host_string = self.relays[index]
+        self.named[name] = Shard(self, index, "relay {}".format(name))
+        return self.named[name]
+
+    def endpoint(self, shard):
+        name, host_string = self.relays[shard.index]
+        if host_string == 'local':
+            return super(RelayRunner, self).endpoint(shard)
+        user, host, port = parse_host_string(host_string)
+        return WorkerEndpoint.newConnection(
+            reactor, self.relay_command.encode('utf8'), user, host, port,
+            keys=self.keys, agentEndpoint=self.agent,
+            knownHosts=None, ui=QuietConsoleUI())
+
+    def connect(self, shard):
+        d = timeout(self.timeout, connectProtocol(self.endpoint(shard), shard))
+        def failed(failure):
+            if failure.check(TimeoutError):
+                msg = "connection timed out after {} seconds".format(self.timeout)
+                failure = Failure(ShardError(msg))
+            shard.connectionLost(failure)
+        return d.addErrback(failed)
+
+    def header(self, shard):
+        header = super(RelayRunner, self).header(shard)
+        header['plaitfile'] = self.plaitfile
+        return header
+
+    def shardFor(self, host_string):
+        if not self.relay_by:
+            return super(RelayRunner, self).shardFor(host_string)
+        name = getattr(host_string, 'labels', {}).get(self.relay_by)
+        shard = self.named.get(name)
+        if shard is None:
+            raise ShardError("No relay for {}={}.".format(self.relay_by, name))
+        if not shard.alive:
+            raise ShardError("Relay {} has been lost.".format(name))
+        if self.pinnedShards(host_string) - set([shard]):
+            # its groups are running on another relay
+            return None
+        return shard
@@ -0,0 +1,222 @@
+import uuid
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+
+from plait.errors import TimeoutError
+from plait.utils import command_result
+
+def frame(command, sentinel):
+    """
+    Shell code running `command` in a subshell, followed by sentinel lines on
+    stdout and stderr which mark the end of its output. The stdout sentinel
+    carries the exit status of the command.
+
+    Each sentinel is preceded by a newline so that it starts a line of its
+    own even if the command's output did not end with one.
+    """
+    script = ("( {command}\n"
+              ") </dev/null\n"
+              "printf '\\n%s %d\\n' {sentinel} $?\n"
+              "printf '\\n%s\\n' {sentinel} >&2\n")
+    return script.format(command=command, sentinel=sentinel)
+
+class ShellCommand(object):
+    """
+    A command written to a ShellProtocol and the output received for it.
+    """
+    def __init__(self, command, sentinel, spooling, timeout=0):
+        self.command = command
+        self.marker = "\n" + sentinel
+        self.spooling = spooling
+        self.timeout = timeout
+        self.expiry = None # call closing the shell once time is up
+        self.timed_out = False
+        self.status = None
+        self.done = dict(stdout=False, stderr=False)
+        self.deferred = Deferred()
+
+    @property
+    def complete(self):
+        return all(self.done.values())
+
+    def write(self, stream, data):
+        if stream == 'stdout':
+            self.spooling.dataReceived(data)
+        else:
+            self.spooling.extReceived(None, data)
+
+    def stop(self):
+        if self.expiry is not None and self.expiry.active():
+            self.expiry.cancel()
+
+    def result(self):
+        stdout, stderr = self.spooling.flush()
+        failed = self.status != 0
+        return command_result(self.command, stdout, stderr, failed)
+
+class ShellProtocol(Protocol):
+    """
+    Runs commands through a single long-lived remote shell.
+
+    Commands are written to the shell as soon as they are queued, without
+    waiting for the results of those before them. Each is framed by unique
+    sentinels so that its stdout, stderr and exit status can be picked back
+    out of the shell's output streams. Results fire in the order the commands
+    were queued.
+
+    Commands queued before the shell's channel is open are held until it is
+    and then written as a single script.
+
+    A command's timeout starts once those queued before it have finished,
+    when it reaches the head of the queue. If it runs out, the shell is
+    closed, failing the commands queued behind it too.
+    """
+    def __init__(self, spooling):
+        self.spooling = spooling # factory for command output protocols
+        self.token = uuid.uuid4().hex
+        self.count = 0
+        self.commands = deque() # commands awaiting results
+        self.unsent = [] # scripts queued before the channel opened
+        self.eof = False # whether to close input once the channel opens
+        self.carry = dict(stdout="", stderr="") # unparsed output
+        self.closed = False
+
+    def execute(self, command, timeout=0):
+        """
+        Queue a command, returning a Deferred which fires with its result, or
+        fails with TimeoutError if it runs for more than `timeout` seconds.
+        """
+        if self.closed:
+            raise RuntimeError("Remote shell has exited.")
+        self.count += 1
+        sentinel = "__plait_{}_{}__".format(self.token, self.count)
+        shell_command = ShellCommand(command, sentinel, self.spooling(), timeout)
+        self.commands.append(shell_command)
+        script = frame(command.encode('utf8'), sentinel)
+        if self.transport is None:
+            self.unsent.append(script)
+        else:
+            self.transport.write(script)
+            self.time()
+        return shell_command.deferred
+
+    def finish(self):
+        """
+        Close the shell's input once queued commands are written, so that it
+        exits after running them.
+        """
+        if self.transport is None:
+            self.eof = True
+        else:
+            self.transport.closeStdin()
+
+    def close(self):
+        """
+        Close the shell's channel, failing the commands still queued on it.
+        """
+        if self.transport is None:
+            self.connectionLost(Failure(ConnectionDone("Remote shell closed.")))
+        else:
+            self.transport.loseConnection()
+
+    def connectionMade(self):
+        # queued scripts go out together
+        self.transport.write("".join(self.unsent))
+        self.unsent = []
+        self.time()
+        if self.eof:
+            self.finish()
+
+    def connectionFailed(self, failure):
+        """
+        The shell's channel could not be opened.
+        """
+        self.connectionLost(failure)
+
+    def connectionLost(self, reason):
+        self.closed = True
+        while self.commands:
+            shell_command = self.commands.popleft()
+            shell_command.stop()
+            if shell_command.timed_out:
+                shell_command.deferred.errback(TimeoutError(shell_command.timeout))
+            else:
+                shell_command.deferred.errback(reason)
+
+    def time(self):
+        """
+        Start the timeout of the command at the head of the queue, which is
+        the one running.
+        """
+        if not self.commands or self.closed:
+            return
+        head = self.commands[0]
+        if head.timeout and head.expiry is None:
+            head.expiry = reactor.callLater(head.timeout, self.expire, head)
+
+    def expire(self, shell_command):
+        shell_command.timed_out = True
+        self.close()
+
+    def dataReceived(self, data):
+        self.feed('stdout', data)
+
+    def extReceived(self, fd, data):
+        self.feed('stderr', data)
+
+    def head(self, stream):
+        """
+        The earliest command whose output on `stream` is not yet complete.
+        """
+        for shell_command in self.commands:
+            if not shell_command.done[stream]:
+                return shell_command
+
+    def feed(self, stream, data):
+        """
+        Hand newly received bytes to the commands they belong to.
+
+        Only the new bytes plus a tail shorter than a sentinel are ever
+        searched, so parsing stays linear in the size of the output.
+        """
+        buf = self.carry[stream] + data
+        while buf:
+            shell_command = self.head(stream)
+            if shell_command is None:
+                break
+            marker = shell_command.marker
+            index = buf.find(marker)
+            if index == -1:
+                # hold back a tail which may be the start of the marker
+                cut = max(0, len(buf) - len(marker) + 1)
+                shell_command.write(stream, buf[:cut])
+                buf = buf[cut:]
+                break
+            shell_command.write(stream, buf[:index])
+            end = buf.find("\n", index + len(marker))
+            if end == -1:
+                # wait for the rest of the sentinel line
+                buf = buf[index:]
+                break
+            status = buf[index + len(marker):end].strip()
+            if status:
+                shell_command.status = int(status)
+            shell_command.done[stream] = True
+            buf = buf[end + 1:]
+            self.resolve()
+        self.carry[stream] = buf
+
+    def resolve(self):
+        """
+        Fire the results of commands whose output is complete.
+        """
+        while self.commands and self.commands[0].complete:
+            shell_command = self.commands.popleft()
+            shell_command.stop()
+            shell_command.deferred.callback(shell_command.result())
+        self.time()
@@ -1,5 +1,6 @@
 import sys
 import codecs
+import tempfile
 from threading import current_thread
 from collections import defaultdict
 from StringIO import StringIO
@@ -11,7 +12,7 @@ from twisted.internet.threads import blockingCallFromThread as blockingCFT
 
 import blinker
 
-from plait.utils import clean_utf8
+from plait.utils import clean_utf8, SpilledString
 
 class SignalFile(object):
     """
@@ -50,6 +51,87 @@ class ThreadedSignalFile(SignalFile):
         t = thread_name()
         self.softspaces[t] = value
 
+class ChunkBuffer(object):
+    """
+    Append-only byte buffer. Writes are kept as a list of chunks which are
+    only joined when the value is requested, so filling the buffer costs
+    time linear in the number of bytes written.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def getvalue(self):
+        """
+        Contents of the buffer, which are kept joined for next time.
+        """
+        value = "".join(self.chunks)
+        self.chunks = [value] if value else []
+        return value
+
+    def flush(self):
+        """
+        Take the contents of the buffer, leaving it empty.
+        """
+        value = "".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return value
+
+class SpillBuffer(ChunkBuffer):
+    """
+    ChunkBuffer that moves its contents to a temporary file once they grow
+    past `threshold` bytes. All further writes go straight to the file.
+
+    Flushing a spilled buffer gives a SpilledString backed by the file in
+    place of an ordinary string.
+    """
+    def __init__(self, threshold, prefix="plait-", dir=None):
+        super(SpillBuffer, self).__init__()
+        self.threshold = threshold
+        self.prefix = prefix
+        self.dir = dir
+        self.file = None
+
+    def write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+            self.size += len(data)
+            return
+        super(SpillBuffer, self).write(data)
+        if self.size > self.threshold:
+            self.spill()
+
+    def spill(self):
+        """
+        Move buffered chunks to a new temporary file.
+        """
+        self.file = tempfile.NamedTemporaryFile(prefix=self.prefix, dir=self.dir)
+        for chunk in self.chunks:
+            self.file.write(chunk)
+        self.chunks = []
+
+    def getvalue(self):
+        if self.file is not None:
+            return SpilledString(self.file)
+        return super(SpillBuffer, self).getvalue()
+
+    def flush(self):
+        if self.file is None:
+            return super(SpillBuffer, self).flush()
+        value = SpilledString(self.file)
+        self.file = None
+        self.size = 0
+        return value
+
 class LineSpool(object):
     """
     File wrapper that only writes to the child file in whole
@@ -57,27 +139,28 @@ class LineSpool(object):
     """
     def __init__(self, target):
         self.target = target # child file
-        self.spool = "" # internal buffer
+        self.spool = ChunkBuffer() # partial line
 
     def write(self, data):
         """
         Take in bytes. Write any fully formed lines to child.
+
+        Only the newly arrived bytes are scanned for newlines.
         """
-        self.spool += data
-        while self.spool:
-            try:
-                line, self.spool = self.spool.split('\n', 1)
-            except ValueError as e:
-                return
-            else:
-                self.target.write(line + "\n")
+        if '\n' not in data:
+            self.spool.write(data)
+            return
+        lines = data.split('\n')
+        lines[0] = self.spool.flush() + lines[0]
+        for line in lines[:-1]:
+            self.target.write(line + "\n")
+        self.spool.write(lines[-1])
 
     def flush(self):
         """
         Write any spooled bytes to child file.
         """
-        self.target.write(self.spool)
-        self.spool = ""
+        self.target.write(self.spool.flush())
 
 class SignalProtocol(Protocol):
     """
@@ -107,25 +190,30 @@ class SpoolingProtocol(Protocol):
     """
     File that spools all writes to in-memory buffers in addition to
     normal handling which is flushable.
+
+    With a `spill_threshold` each buffer moves to a temporary file, named
+    with `prefix`, once it holds more than that many bytes.
     """
-    def __init__(self):
-        self.outbuf = ""
-        self.errbuf = ""
+    def __init__(self, spill_threshold=0, prefix="plait-", dir=None):
+        if spill_threshold:
+            self.outbuf = SpillBuffer(spill_threshold, prefix, dir)
+            self.errbuf = SpillBuffer(spill_threshold, prefix, dir)
+        else:
+            self.outbuf = ChunkBuffer()
+            self.errbuf = ChunkBuffer()
 
     def dataReceived(self, data):
-        self.outbuf += clean_utf8(data)
+        self.outbuf.write(clean_utf8(data))
 
     def extReceived(self, fd, data):
-        self.errbuf += clean_utf8(data)
+        self.errbuf.write(clean_utf8(data))
 
     def flush(self):
-        _out, self.outbuf = self.outbuf, ""
-        _err, self.errbuf = self.errbuf, ""
-        return _out, _err
+        return self.outbuf.flush(), self.errbuf.flush()
 
 class SpoolingSignalProtocol(Protocol):
     def __init__(self, *args, **kwargs):
-        self.spooling = SpoolingProtocol()
+        self.spooling = kwargs.pop('spooling', None) or SpoolingProtocol()
         self.signaling = SignalProtocol(*args, **kwargs)
         self.finished = None
 
@@ -0,0 +1,136 @@
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
+
+from blinker import signal
+
+from plait.errors import HostTimeoutError, StragglerError
+
+class Stragglers(object):
+    """
+    Watches hosts running their tasks, for ones that run past their
+    deadline or take much longer than the rest of the fleet.
+
+    A host whose tasks have run for more than `factor` times the median
+    time of recently finished hosts, and at least `minimum` seconds, is a
+    straggler. Stragglers are only flagged once `samples` hosts have
+    finished. Depending on `action`, a straggler is then:
+
+      - warn   : reported, and left to finish
+      - cancel : disconnected and failed
+      - detach : failed without waiting for it, leaving it running
+
+    A host running for more than `host_timeout` seconds is disconnected
+    and failed whatever the action.
+
+    Each straggler is emitted as a `worker_straggler` signal.
+    """
+
+    # seconds between checks
+    interval = 1.0
+    # finished hosts the median is taken over
+    window = 1000
+
+    def __init__(self, action='warn', factor=3.0, minimum=10.0, samples=5,
+                 host_timeout=0):
+        self.action = action
+        self.factor = factor
+        self.minimum = minimum
+        self.samples = samples
+        self.host_timeout = host_timeout
+        self.running = dict() # worker: (started, outcome, deadline call)
+        self.durations = deque(maxlen=self.window)
+        self.flagged = set() # workers already reported as stragglers
+        self.stragglers = [] # (host_string, seconds, median, action)
+        self.timeouts = 0
+        self.loop = task.LoopingCall(self.check)
+
+    def watch(self, worker, work):
+        """
+        Fires with the outcome of `work`, a worker's running tasks, unless
+        the worker is cut off first.
+        """
+        outcome = defer.Deferred()
+        deadline = None
+        if self.host_timeout:
+            deadline = reactor.callLater(self.host_timeout, self.expire, worker)
+        self.running[worker] = (time.time(), outcome, deadline)
+        if not self.loop.running:
+            self.loop.start(self.interval, now=False)
+        work.addBoth(self.settle, worker)
+        return outcome
+
+    def settle(self, result, worker):
+        if worker not in self.running:
+            # cut off already, so the outcome was decided
+            return
+        started, outcome, deadline = self.running.pop(worker)
+        self.flagged.discard(worker)
+        if deadline and deadline.active():
+            deadline.cancel()
+        self.durations.append(time.time() - started)
+        self.idle()
+        if isinstance(result, Failure):
+            outcome.errback(result)
+        else:
+            outcome.callback(result)
+
+    def cut(self, worker, exception, disconnect):
+        started, outcome, deadline = self.running.pop(worker)
+        self.flagged.discard(worker)
+        if deadline and deadline.active():
+            deadline.cancel()
+        self.idle()
+        if disconnect:
+            worker.abort()
+        outcome.errback(exception)
+
+    def idle(self):
+        if not self.running and self.loop.running:
+            self.loop.stop()
+
+    def expire(self, worker):
+        self.timeouts += 1
+        msg = "Host timed out after {:g} seconds.".format(self.host_timeout)
+        self.cut(worker, HostTimeoutError(msg), True)
+
+    def median(self):
+        durations = sorted(self.durations)
+        return durations[len(durations) // 2]
+
+    def check(self):
+        if len(self.durations) < self.samples:
+            return
+        median = self.median()
+        limit = max(self.minimum, median * self.factor)
+        now = time.time()
+        for worker, (started, outcome, deadline) in self.running.items():
+            elapsed = now - started
+            if elapsed < limit or worker in self.flagged:
+                continue
+            self.flagged.add(worker)
+            self.stragglers.append((worker.host_string, elapsed, median, self.action))
+            signal('worker_straggler').send(worker, elapsed=elapsed, median=median,
+                                            action=self.action)
+            if self.action != 'warn':
+                msg = "Straggler {} after {:.1f}s, fleet median {:.1f}s."
+                verb = "cancelled" if self.action == 'cancel' else "detached"
+                msg = msg.format(verb, elapsed, median)
+                self.cut(worker, StragglerError(msg), self.action == 'cancel')
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def stats(self):
+        """
+        Summary of the stragglers, followed by one line for each.
+        """
+        line = "stragglers: {} ({}), {} host timeouts"
+        lines = [line.format(len(self.stragglers), self.action, self.timeouts)]
+        for host_string, elapsed, median, action in self.stragglers:
+            line = "  {} {:.1f}s, fleet median {:.1f}s, {}"
+            lines.append(line.format(host_string, elapsed, median, action))
+        return lines
@@ -5,15 +5,19 @@ from functools import partial
 from threading import local, current_thread
 
 from twisted.internet.threads import blockingCallFromThread as blockingCFT
-from twisted.internet import threads, reactor
+from twisted.internet import threads, reactor, defer
 
 from plait.thread import deferToDaemonThread
+from plait.errors import TaskError
 
 class NoSuchTaskError(Exception): pass
 
 class Task(object):
     """
-    Executes a function with the given arguments in a thread.
+    Executes a function with the given arguments in a thread. The thread is
+    taken from the worker's TaskPool when it has one.
+
+    Coroutine tasks are instead driven directly on the reactor thread.
     """
     def __init__(self, worker, task_name, task_func, args, kwargs):
         self.worker = worker
@@ -24,7 +28,12 @@ class Task(object):
         self.has_output = False
 
     def run(self):
-        return deferToDaemonThread(self.uid, self.func, self.worker, *self.args, **self.kwargs)
+        if getattr(self.func, 'is_async', False):
+            return self.func(self.uid, self.worker, *self.args, **self.kwargs)
+        pool = getattr(self.worker, 'pool', None)
+        if pool is None:
+            return deferToDaemonThread(self.uid, self.func, self.worker, *self.args, **self.kwargs)
+        return pool.deferToThread(self.uid, self.func, self.worker, *self.args, **self.kwargs)
 
     @property
     def uid(self):
@@ -36,9 +45,76 @@ class Task(object):
         kwargs = " ".join("{}={}".format(k, v) for k, v in self.kwargs.items())
         return " ".join([self.name, args, kwargs]).strip()
 
+class CommandTask(Task):
+    """
+    Executes a single shell command directly on the reactor, with no task
+    function or thread involved. The command's stderr is reported as task
+    output and a failing command fails the task, with its stdout reported
+    as output too rather than lost.
+    """
+    def __init__(self, worker, command):
+        super(CommandTask, self).__init__(worker, command, None, [], {})
+        self.command = command
+
+    def run(self):
+        d = self.worker.execFromThread(self.command)
+        d.addCallback(self.finished)
+        return d.addErrback(lambda failure: failure.value)
+
+    def finished(self, result):
+        if result.failed and result.stdout:
+            self.worker.stdout(self.uid, data=str(result.stdout))
+        if result.stderr:
+            self.worker.stderr(self.uid, data=str(result.stderr))
+        if result.failed:
+            return TaskError("Command failed: {}".format(self.command))
+        return result
+
 thread_locals = local()
 
+def bind(name, worker, gen):
+    """
+    Wrap the generator of a coroutine task so that each time it is resumed
+    the task's worker is made current and the reactor thread takes on the
+    name of the task, just as if it were running in its own Task thread.
+    """
+    thread = current_thread()
+    value, exc_info = None, None
+    while True:
+        thread_name, thread.name = thread.name, name
+        thread_locals.worker = worker
+        try:
+            if exc_info:
+                yielded = gen.throw(*exc_info)
+            else:
+                yielded = gen.send(value)
+        except StopIteration as e:
+            defer.returnValue(getattr(e, 'value', None))
+        finally:
+            thread.name = thread_name
+        try:
+            value, exc_info = (yield yielded), None
+        except:
+            value, exc_info = None, sys.exc_info()
+
+def coroutine(f):
+    """
+    Turn a generator function into a task which runs on the reactor thread.
+    Deferreds it yields, such as those returned by `plait.api.run`, are
+    waited upon without blocking, in the style of `inlineCallbacks`.
+    """
+    def w(name, worker, *args, **kwargs):
+        d = defer.inlineCallbacks(bind)(name, worker, f(*args, **kwargs))
+        return d.addErrback(lambda failure: failure.value)
+    w.is_task = True
+    w.is_async = True
+    return w
+
 def task(f):
+    if getattr(f, 'is_task', False):
+        return f
+    if inspect.isgeneratorfunction(f):
+        return coroutine(f)
     def w(worker, *args, **kwargs):
         thread_locals.worker = worker
         try:
@@ -1,7 +1,10 @@
+import time
+from Queue import Queue
+from threading import Thread, Lock, current_thread
+
 from twisted.internet import reactor
 from twisted.python import failure
 from twisted.internet import defer
-from threading import Thread
 
 def deferToDaemonThread(name, f, *args, **kw):
     """Run function in thread and return result as Deferred."""
@@ -24,3 +27,103 @@ def deferToDaemonThread(name, f, *args, **kw):
     thread.start()
     d.thread = thread
     return d
+
+class TaskPool(object):
+    """
+    Bounded pool of daemon threads that Tasks are executed in.
+
+    Threads are started lazily, up to `size`, and are reused once the
+    function they were running returns. Work submitted while every thread
+    is busy waits in a FIFO queue. A `size` of 0 leaves the pool unbounded,
+    in which case a new thread is started whenever none are idle.
+
+    Plait routes the standard IO of a Task by the name of the thread it is
+    running in, so a pooled thread takes on the name given for each piece of
+    work while running it and reverts to its own name afterwards.
+    """
+
+    def __init__(self, size=0, name="plait-task"):
+        self.size = size
+        self.name = name
+        self.queue = Queue()
+        self.lock = Lock()
+        self.threads = []
+        self.idle = 0 # threads waiting for work
+        self.waiting = 0 # work waiting for a thread
+        self.active = 0 # work currently running
+        # queueing metrics
+        self.submitted = 0
+        self.completed = 0
+        self.peak_active = 0
+        self.peak_backlog = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def startThread(self):
+        name = "{}-{}".format(self.name, len(self.threads))
+        thread = Thread(target=self.work, name=name)
+        thread.setDaemon(1)
+        self.threads.append(thread)
+        self.idle += 1
+        thread.start()
+
+    def deferToThread(self, name, f, *args, **kw):
+        """
+        Run function in a pooled thread named `name` for the duration of the
+        call and return result as Deferred.
+        """
+        d = defer.Deferred()
+        with self.lock:
+            self.submitted += 1
+            self.waiting += 1
+            if self.waiting > self.idle:
+                if not self.size or len(self.threads) < self.size:
+                    self.startThread()
+            backlog = self.waiting - self.idle
+            self.peak_backlog = max(self.peak_backlog, backlog)
+        self.queue.put((name, d, f, args, kw, time.time()))
+        return d
+
+    def work(self):
+        """
+        Thread main loop. Pull work from the queue and give its results to
+        the Deferred handed out for it.
+        """
+        thread = current_thread()
+        idle_name = thread.name
+        while True:
+            name, d, f, args, kw, queued = self.queue.get()
+            waited = time.time() - queued
+            with self.lock:
+                self.idle -= 1
+                self.waiting -= 1
+                self.active += 1
+                self.peak_active = max(self.peak_active, self.active)
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            thread.name = name
+            try:
+                result = f(*args, **kw)
+            except:
+                reactor.callFromThread(d.errback, failure.Failure())
+            else:
+                reactor.callFromThread(d.callback, result)
+            finally:
+                thread.name = idle_name
+                with self.lock:
+                    self.active -= 1
+                    self.idle += 1
+                    self.completed += 1
+
+    def stats(self):
+        """
+        Summary of the pool's queueing metrics.
+        """
+        size = self.size or "unbounded"
+        mean_wait = self.total_wait / self.submitted if self.submitted else 0.0
+        line = ("task threads: {} started ({}), {} tasks, "
+                "peak active {}, peak backlog {}, "
+                "wait avg {:.3f}s max {:.3f}s")
+        return line.format(len(self.threads), size, self.submitted,
+                           self.peak_active, self.peak_backlog,
+                           mean_wait, self.max_wait)
@@ -0,0 +1,334 @@
+import os, shutil, tempfile, itertools, pipes
+
+from twisted.internet import defer, reactor, error, task
+from twisted.internet.protocol import ProcessProtocol
+from twisted.conch.endpoints import SSHCommandClientEndpoint, _CommandChannel
+from twisted.conch.endpoints import _CommandTransport, _NewConnectionHelper
+from twisted.internet.endpoints import HostnameEndpoint, connectProtocol
+from twisted.conch.ssh.common import NS
+
+from plait.errors import TransportError
+from plait.utils import QuietConsoleUI, parse_host_string, timeout
+
+# default channel does send ext bytes to protocol (stderr)
+class WorkerChannel(_CommandChannel):
+    def extReceived(self, dataType, data):
+        if hasattr(self._protocol, 'extReceived'):
+            self._protocol.extReceived(dataType, data)
+
+    # the parts of IProcessTransport which commands use, so their protocols
+    # work the same over a channel or a local `ssh` process
+
+    def closeStdin(self):
+        self.conn.sendEOF(self)
+
+    def signalProcess(self, signalID):
+        # not every server supports signals
+        self.conn.sendRequest(self, b'signal', NS(signalID))
+
+# connects with HostnameEndpoint rather than TCP4ClientEndpoint, so that
+# host names go through the reactor's resolver and IPv6 hosts are reachable
+class WorkerConnectionHelper(_NewConnectionHelper):
+    # Jump to tunnel through, if any
+    jump = None
+
+    def makeEndpoint(self):
+        if self.jump:
+            return self.jump.endpoint(self.hostname, self.port)
+        return HostnameEndpoint(self.reactor, self.hostname, self.port)
+
+    def secureConnection(self):
+        protocol = _CommandTransport(self)
+        d = connectProtocol(self.makeEndpoint(), protocol)
+        d.addCallback(lambda ignored: protocol.connectionReady)
+        return d
+
+# endpoint that utilizes channel above
+class WorkerEndpoint(SSHCommandClientEndpoint):
+    commandConnected = defer.Deferred()
+
+    @classmethod
+    def newConnection(cls, reactor, command, username, hostname, port=None,
+                      keys=None, password=None, agentEndpoint=None,
+                      knownHosts=None, ui=None, jump=None):
+        helper = WorkerConnectionHelper(
+            reactor, hostname, port, command, username, keys, password,
+            agentEndpoint, knownHosts, ui)
+        helper.jump = jump
+        return cls(helper, command)
+
+    def _executeCommand(self, connection, protocolFactory):
+        commandConnected = defer.Deferred()
+        def disconnectOnFailure(passthrough):
+            immediate =  passthrough.check(defer.CancelledError)
+            self._creator.cleanupConnection(connection, immediate)
+            return passthrough
+        commandConnected.addErrback(disconnectOnFailure)
+        channel = WorkerChannel(
+            self._creator, self._command, protocolFactory, commandConnected)
+        connection.openChannel(channel)
+        return commandConnected
+
+class ConchTransport(object):
+    """
+    Connects a worker to its host with Twisted Conch, and runs each command
+    over a channel of its own on the one connection.
+
+    Transports connect, run commands connected to a protocol, answer
+    whether they are still connected, keep idle connections alive and
+    disconnect. The transports of a run are made by calling its transport
+    factory with each worker, which for Conch is this class.
+    """
+    name = "conch"
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.protocol = None # session holding the connection open
+        self.connecting = None
+
+    @property
+    def connection(self):
+        """
+        The SSH connection shared by every channel to the remote host.
+        """
+        return self.protocol.transport.conn
+
+    def makeConnectEndpoint(self):
+        """
+        Endpoint for initial SSH host connection.
+        """
+        worker = self.worker
+        return WorkerEndpoint.newConnection(
+            reactor, b"cat",
+            worker.user, worker.host, worker.port,
+            keys=worker.keys, agentEndpoint=None,
+            knownHosts=None, ui=QuietConsoleUI(),
+            jump=worker.jumps and worker.jumps.jumpFor(worker.host_string))
+
+    @defer.inlineCallbacks
+    def connect(self):
+        self.connecting = self.makeConnectEndpoint().connect(self.worker)
+        self.protocol = yield timeout(self.worker.timeout, self.connecting)
+
+    def execute(self, command, protocol):
+        """
+        Run `command`, connecting `protocol` to it. Fires with the protocol.
+        """
+        endpoint = WorkerEndpoint.existingConnection(self.connection, command)
+        return connectProtocol(endpoint, protocol)
+
+    @property
+    def alive(self):
+        # Conch leaves the channels of a lost connection open, so this also
+        # asks the transport under it
+        channel = self.protocol.transport
+        transport = channel.conn.transport.transport
+        if not transport.connected or transport.disconnecting:
+            return False
+        return channel in channel.conn.channelsToRemoteChannel
+
+    def keepalive(self):
+        """
+        Fires once the server answers a keepalive request. Any answer, even
+        a refusal, shows the connection is alive.
+        """
+        return self.connection.sendGlobalRequest(
+            b'keepalive@openssh.com', b'', wantReply=True)
+
+    def disconnect(self):
+        if self.protocol is not None:
+            self.connection.transport.loseConnection()
+        elif self.connecting is not None:
+            self.connecting.cancel()
+
+class SSHProcess(ProcessProtocol):
+    """
+    Connects a protocol to a local `ssh` process as a channel would: stdout
+    to dataReceived, stderr to extReceived and its exit to connectionLost.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.started = defer.Deferred()
+
+    def connectionMade(self):
+        self.protocol.makeConnection(self.transport)
+        self.started.callback(self.protocol)
+
+    def outReceived(self, data):
+        self.protocol.dataReceived(data)
+
+    def errReceived(self, data):
+        self.protocol.extReceived(1, data)
+
+    def processEnded(self, reason):
+        self.protocol.connectionLost(reason)
+
+class SSHMaster(ProcessProtocol):
+    """
+    The `ssh` process holding the connection to a host open for the
+    commands multiplexed over its control socket.
+    """
+
+    def __init__(self):
+        self.stderr = ""
+        self.status = None
+        self.ended = defer.Deferred()
+
+    @property
+    def running(self):
+        return self.status is None
+
+    def errReceived(self, data):
+        self.stderr = (self.stderr + data)[-4096:]
+
+    def processEnded(self, reason):
+        self.status = reason.value
+        self.ended.callback(None)
+
+    def stop(self):
+        if self.running:
+            try:
+                self.transport.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
+
+    def error(self):
+        lines = self.stderr.strip().splitlines()
+        msg = "ssh exited with code {}".format(self.status.exitCode)
+        if lines:
+            msg += ": " + lines[-1]
+        return TransportError(msg)
+
+class OpenSSHTransport(object):
+    """
+    Connects a worker to its host with the system `ssh`, which brings
+    OpenSSH's faster handshakes and ciphers, and honours `ssh_config`.
+
+    A master process holds the connection open, and each command runs in
+    an `ssh` process multiplexed over it through a control socket, as with
+    ControlMaster. The master is stopped when the worker is done with it,
+    rather than persisting after the run.
+    """
+    name = "openssh"
+    # seconds between looks for the control socket of a connecting master
+    poll = 0.02
+
+    def __init__(self, worker, openssh):
+        self.worker = worker
+        self.openssh = openssh
+        self.path = openssh.controlPath()
+        self.master = None
+
+    def argv(self, *flags):
+        """
+        `ssh` command line to the host, with extra flags.
+        """
+        worker = self.worker
+        argv = self.openssh.argv(worker.user, worker.port, '-S', self.path)
+        jump = worker.jumps and worker.jumps.jumpFor(worker.host_string)
+        if jump:
+            user, host, port = parse_host_string(jump.host_string)
+            proxy = self.openssh.argv(user, port, '-W', '%h:%p', host)
+            argv += ['-o', 'ProxyCommand=' + " ".join(map(pipes.quote, proxy))]
+        return argv + list(flags) + [worker.host]
+
+    def spawn(self, protocol, argv):
+        return reactor.spawnProcess(protocol, argv[0], argv, env=os.environ)
+
+    def connect(self):
+        self.master = SSHMaster()
+        wait = int(self.worker.timeout)
+        self.spawn(self.master, self.argv(
+            '-M', '-N', '-o', 'ControlMaster=yes', '-o', 'ControlPersist=no',
+            '-o', 'ConnectTimeout={}'.format(wait)))
+        self.openssh.masters.add(self)
+        self.master.ended.addCallback(lambda _: self.openssh.masters.discard(self))
+        return timeout(self.worker.timeout, self.ready())
+
+    def ready(self):
+        """
+        Fires once the master has authenticated, which is when it opens
+        its control socket, or fails if it exits first.
+        """
+        def check():
+            if os.path.exists(self.path):
+                loop.stop()
+                d.callback(None)
+            elif not self.master.running:
+                loop.stop()
+                d.errback(self.master.error())
+        def cancel(d):
+            loop.stop()
+            self.master.stop()
+        d = defer.Deferred(cancel)
+        loop = task.LoopingCall(check)
+        loop.start(self.poll, now=False)
+        return d
+
+    def execute(self, command, protocol):
+        """
+        Run `command`, connecting `protocol` to it. Fires with the protocol.
+        """
+        process = SSHProcess(protocol)
+        self.spawn(process, self.argv('-T', '-o', 'ControlMaster=no') + [command])
+        return process.started
+
+    @property
+    def alive(self):
+        return self.master.running and os.path.exists(self.path)
+
+    def keepalive(self):
+        # the master keeps its connection alive as `ssh_config` says, with
+        # ServerAliveInterval
+        return defer.succeed(None)
+
+    def disconnect(self):
+        if self.master is not None:
+            self.master.stop()
+
+class OpenSSH(object):
+    """
+    Makes the OpenSSHTransports of a run, which keep their control sockets
+    in a private temporary directory. `options` are passed to `ssh` with
+    `-o`, and `identity` with `-i`.
+    """
+
+    def __init__(self, identity=None, options=(), ssh="ssh"):
+        self.identity = identity
+        self.options = options
+        self.ssh = ssh
+        self.directory = None
+        self.names = itertools.count()
+        self.masters = set() # transports with a master running
+
+    def __call__(self, worker):
+        return OpenSSHTransport(worker, self)
+
+    def argv(self, user, port, *flags):
+        """
+        `ssh` command line with the run's options, for a user and port.
+        """
+        argv = [self.ssh, '-o', 'BatchMode=yes', '-p', str(port), '-l', user]
+        if self.identity:
+            argv += ['-i', self.identity]
+        for option in self.options:
+            argv += ['-o', option]
+        return argv + list(flags)
+
+    def controlPath(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="plait-ssh-")
+            # masters outlive plait unless stopped, such as on SIGTERM
+            reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+        return os.path.join(self.directory, str(next(self.names)))
+
+    def close(self):
+        """
+        Stop every master, closing their connections.
+        """
+        for transport in list(self.masters):
+            transport.disconnect()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
@@ -1,9 +1,10 @@
-import getpass, sys
+import getpass, sys, os, mmap, random
 from functools import partial
 
 from twisted.conch.client.knownhosts import ConsoleUI
-from twisted.internet.defer import succeed, Deferred, CancelledError
-from twisted.internet import reactor, defer
+from twisted.conch.error import HostKeyChanged
+from twisted.internet.defer import succeed, CancelledError
+from twisted.internet import reactor, defer, error
 
 from blessings import Terminal
 
@@ -42,6 +43,93 @@ class AttributeString(str):
         return str(self)
 
 
+class SpilledString(object):
+    """
+    Read-only, string-like view of command output that was spilled to a
+    temporary file. The file is memory-mapped so only the parts that are
+    actually used are read into memory.
+
+    Indexing, slicing, `len` and `in` work as they do on a string, while
+    iterating yields lines like a file does. Any other string method is
+    applied to the full contents.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.file.flush()
+        self.size = os.fstat(file.fileno()).st_size
+        self.map = None
+        if self.size:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def stdout(self):
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def __nonzero__(self):
+        return self.size > 0
+
+    def __getitem__(self, index):
+        if self.map is None:
+            return ""[index]
+        return self.map[index]
+
+    def __contains__(self, text):
+        return self.map is not None and self.map.find(text) != -1
+
+    def __iter__(self):
+        start = 0
+        while start < self.size:
+            end = self.map.find("\n", start)
+            end = self.size if end == -1 else end + 1
+            yield self.map[start:end]
+            start = end
+
+    def __str__(self):
+        return self[:]
+
+    def __eq__(self, other):
+        return str(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(str(self), name)
+
+
+def command_result(command, stdout, stderr, failed, timed_out=False):
+    """
+    Result object for a remote command, given its output.
+    """
+    if isinstance(stdout, SpilledString):
+        result = stdout
+    else:
+        result = AttributeString(stdout)
+    result.stderr = stderr
+    result.failed = failed
+    result.succeeded = not failed
+    result.timed_out = timed_out
+    result.command = command
+    return result
+
+
+def parse_size(size):
+    """
+    Parse a byte count with an optional K, M or G suffix: e.g. 64M
+    """
+    size = str(size).strip().upper()
+    units = dict(K=1024, M=1024 ** 2, G=1024 ** 3)
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def parse_host_string(host_string):
     if '@' in host_string:
         user, host_string = host_string.split('@', 1)
@@ -135,30 +223,36 @@ def timeout(t, original):
     timeout = reactor.callLater(t, late)
     return d
 
-def retry(times, func, *args, **kwargs):
-    """retry a defer function
+class Backoff(object):
+    """
+    Exponential backoff with full jitter between connection attempts, plus
+    a circuit breaker for failures that trying again won't fix.
 
-    @param times: how many times to retry
-    @param func: defer function
+    The delay before attempt N+1 is drawn uniformly from zero up to
+    `delay * factor ** (N - 1)`, capped at `maximum`, so that hosts which
+    failed together don't retry in lockstep.
     """
-    errorList = []
-    deferred = Deferred()
-
-    def run():
-        # run target function
-        d = func(*args, **kwargs)
-        # call outgoing deferred or errback
-        d.addCallbacks(deferred.callback, error)
-
-    def error(error):
-        # add new error to list
-        errorList.append(error)
-        # retry if under quota
-        if len(errorList) < times:
-            run()
-        # otherwise errback outgoing deferred
-        else:
-            deferred.errback(errorList[-1])
-    run()
-    return deferred
 
+    # fast failures which mean the host is down or misconfigured
+    fatal = (error.ConnectionRefusedError,
+             error.NoRouteError,
+             error.DNSLookupError,
+             HostKeyChanged)
+
+    def __init__(self, delay=1.0, factor=2.0, maximum=60.0, jitter=True):
+        self.delay = delay
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def delayFor(self, attempt):
+        """
+        Seconds to wait after the given failed attempt, counting from 1.
+        """
+        delay = min(self.maximum, self.delay * self.factor ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def isFatal(self, failure):
+        return failure.check(*self.fatal) is not None
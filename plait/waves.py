@@ -0,0 +1,33 @@
+import itertools, math
+
+class Waves(object):
+    """
+    Sizes of the waves hosts are run in, from a spec such as "10" (waves of
+    10 hosts), "1,10,100" (1 host, then 10, then 100 at a time until the
+    hosts run out) or "5%" (5% of `total` hosts at a time).
+    """
+
+    def __init__(self, spec, total=None):
+        self.spec = spec
+        if spec.endswith('%'):
+            if total is None:
+                raise ValueError("Percentage waves need the number of hosts.")
+            percent = float(spec[:-1])
+            if not 0 < percent <= 100:
+                raise ValueError("Wave percentage out of range: {}".format(spec))
+            self.sizes = [max(1, int(math.ceil(total * percent / 100)))]
+        else:
+            self.sizes = [int(size) for size in spec.split(',')]
+        if any(size < 1 for size in self.sizes):
+            raise ValueError("Wave sizes must be positive: {}".format(spec))
+
+    @staticmethod
+    def isRelative(spec):
+        return spec.endswith('%')
+
+    def __iter__(self):
+        """
+        Wave sizes, the last of which repeats forever.
+        """
+        sizes = itertools.chain(self.sizes, itertools.repeat(self.sizes[-1]))
+        return iter(sizes)
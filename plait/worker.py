@@ -3,51 +3,42 @@ import sys
 from twisted.internet import defer, reactor, error
 from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
-from twisted.conch.endpoints import SSHCommandClientEndpoint, _CommandChannel
 from twisted.internet.protocol import Factory, Protocol
 
 from blinker import signal
 
-from plait.task import Task
+from plait.task import Task, CommandTask
 from plait.spool import SpoolingSignalProtocol, SpoolingProtocol
-from plait.errors import TimeoutError, TaskError
-from plait.utils import parse_host_string, QuietConsoleUI, timeout, AttributeString
-
-# default channel does send ext bytes to protocol (stderr)
-class WorkerChannel(_CommandChannel):
-    def extReceived(self, dataType, data):
-        if hasattr(self._protocol, 'extReceived'):
-            self._protocol.extReceived(dataType, data)
-
-# endpoint that utilizes channel above
-class WorkerEndpoint(SSHCommandClientEndpoint):
-    commandConnected = defer.Deferred()
-    def _executeCommand(self, connection, protocolFactory):
-        commandConnected = defer.Deferred()
-        def disconnectOnFailure(passthrough):
-            immediate =  passthrough.check(defer.CancelledError)
-            self._creator.cleanupConnection(connection, immediate)
-            return passthrough
-        commandConnected.addErrback(disconnectOnFailure)
-        channel = WorkerChannel(
-            self._creator, self._command, protocolFactory, commandConnected)
-        connection.openChannel(channel)
-        return commandConnected
+from plait.shell import ShellProtocol
+from plait.transport import ConchTransport
+from plait.errors import TimeoutError, TaskError, CancelledRunError
+from plait.utils import parse_host_string, command_result
 
 class PlaitWorker(Factory):
     """
     Executes a sequence of tasks against a remote host.
 
-    When run, an initial SSH connection is established to the remote host.
-    For efficiency's sake, all subsequent remote operations reuse the
-    same connection and execute over a new channel.
+    When run, an initial SSH connection is established to the remote host
+    through the worker's transport. For efficiency's sake, all subsequent
+    remote operations reuse the same connection and execute over a new
+    channel. Each channel gets its own protocol instance, so several
+    operations may run at once.
+
+    With `persistent_shell`, operations instead share one long-lived shell
+    channel per host, which saves opening a channel and starting a shell
+    for every operation.
 
     Each task is executed in a daemon thread which will be killed when the
-    main thread exits. When the task runs a remote operation it blocks on
+    main thread exits. Threads come from a bounded TaskPool shared by all
+    workers of a run, so the number of hosts in flight does not dictate the
+    number of threads. When the task runs a remote operation it blocks on
     a call on the worker inside the main reactor thread where the network
     operations are negotiated. The result is then returned to the thread
     and it resumes execution.
 
+    Coroutine tasks skip the thread entirely. They run on the reactor thread
+    and yield the Deferreds of their remote operations instead of blocking.
+
     There are a number of signals emitted for workers:
 
       - timeout        : seconds
@@ -61,8 +52,16 @@ class PlaitWorker(Factory):
 
     """
 
-    def __init__(self, tasks, keys, agent, known_hosts, timeout, all_tasks=False):
+    # sshd's MaxSessions defaults to 10, one of which holds the connection
+    max_channels = 9
+
+    def __init__(self, tasks, keys, agent, known_hosts, timeout, all_tasks=False,
+                 pool=None, spill_threshold=0, spill_dir=None,
+                 persistent_shell=False, command_timeout=0, jumps=None,
+                 warm=None, transport=None):
         self.proto = None
+        self.transport = None
+        self.makeTransport = transport or ConchTransport
         self.host_string = None
         self.user = None
         self.host = None
@@ -73,44 +72,61 @@ class PlaitWorker(Factory):
         self.known_hosts = None
         self.timeout = timeout
         self.all_tasks = all_tasks
+        self.pool = pool
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.persistent_shell = persistent_shell
+        self.command_timeout = command_timeout
+        self.jumps = jumps
+        self.warm = warm
+        self.cancelled = False
+        self.shell = None
+        self.batch = None
         self.lines = 0
         self.tasks_by_uid = dict()
+        self.channels = defer.DeferredSemaphore(self.max_channels)
 
     def __str__(self):
         return self.host_string
 
     def buildProtocol(self, addr):
         # construct protocol and wire up io signals
-        self.protocol = SpoolingSignalProtocol('stdout', 'stderr', sender=self.host_string)
-        return self.protocol
-
-    def makeConnectEndpoint(self):
-        """
-        Endpoint for initial SSH host connection.
-        """
-        return WorkerEndpoint.newConnection(
-            reactor, b"cat",
-            self.user, self.host, self.port,
-            keys=self.keys, agentEndpoint=None,
-            knownHosts=None, ui=QuietConsoleUI())
+        return SpoolingSignalProtocol('stdout', 'stderr',
+                                      sender=self.host_string,
+                                      spooling=self.makeSpooling())
 
-    def makeCommandEndpoint(self, command):
+    def makeSpooling(self):
         """
-        Endpoint for remotely executing operations.
+        Buffers for command output, which spill to per-host temporary files
+        past the spill threshold.
         """
-        return WorkerEndpoint.existingConnection(
-            self.protocol.transport.conn, command.encode('utf8'))
+        prefix = "plait-{}-".format(self.host)
+        return SpoolingProtocol(self.spill_threshold, prefix, self.spill_dir)
 
     @defer.inlineCallbacks
     def connect(self, host_string):
         """
-        Establish initial SSH connection to remote host.
+        Establish initial SSH connection to remote host, or take one kept
+        open by the warm pool, if any.
         """
         self.parse_host_string(host_string)
-        endpoint = self.makeConnectEndpoint()
-        yield timeout(self.timeout, endpoint.connect(self))
+        self.transport = self.warm and self.warm.take(host_string)
+        if self.transport is None:
+            self.transport = self.makeTransport(self)
+            yield self.transport.connect()
+            if self.warm is not None:
+                self.warm.keep(host_string, self.transport)
         signal('worker_connect').send(self)
 
+    def abort(self):
+        """
+        Drop the connection to the remote host, failing the operations in
+        progress, and run no further tasks.
+        """
+        self.cancelled = True
+        if self.transport is not None:
+            self.transport.disconnect()
+
     def parse_host_string(self, host_string):
         self.host_string = host_string
         self.user, self.host, self.port = parse_host_string(host_string)
@@ -137,14 +153,36 @@ class PlaitWorker(Factory):
         signal('task_start').send(self, task=task)
         return task.run()
 
+    def makeTask(self, name, func, args, kwargs):
+        """
+        Tasks without a function are ad-hoc shell commands.
+        """
+        if func is None:
+            return CommandTask(self, name)
+        return Task(self, name, func, args, kwargs)
+
     @defer.inlineCallbacks
     def run(self):
         """
-        Execute each task in a Task thread.
+        Execute each task in a Task thread, or on the reactor if it is a
+        coroutine task.
         """
+        try:
+            yield self.runTasks()
+        finally:
+            if self.warm is None:
+                self.transport.disconnect()
+            elif self.shell is not None:
+                # the connection outlives the worker, so its shell must not
+                self.shell.finish()
+
+    @defer.inlineCallbacks
+    def runTasks(self):
         # execute each task in sequence
         for name, func, args, kwargs in self.tasks:
-            task = Task(self, name, func, args, kwargs)
+            if self.cancelled:
+                break
+            task = self.makeTask(name, func, args, kwargs)
             self.tasks_by_uid[task.uid] = task
             result = yield self.runTask(task)
             # tasks will return an Exception is there was a failure
@@ -164,23 +202,107 @@ class PlaitWorker(Factory):
             else:
                 signal('task_finish').send(self, task=task, result=result)
 
+    def execFromThread(self, command, timeout=None):
+        """
+        API for tasks to execute ssh commands. Commands still running after
+        `timeout` seconds, the worker's command timeout by default, are
+        stopped and fail.
+        """
+        if self.cancelled:
+            return defer.fail(CancelledRunError("Host was cancelled."))
+        if timeout is None:
+            timeout = self.command_timeout
+        if self.persistent_shell:
+            return self.execShell(command, timeout)
+        return self.channels.run(self.execChannel, command, timeout)
+
+    def openShell(self, command=b"/bin/sh"):
+        """
+        Start a remote shell which commands can be queued on. Their output
+        is signalled as it arrives, as for commands over their own channel.
+        """
+        shell = ShellProtocol(lambda: self.buildProtocol(None))
+        d = self.transport.execute(command, shell)
+        d.addErrback(shell.connectionFailed)
+        return shell
+
+    def execShell(self, command, timeout=0):
+        """
+        Execute a command through the worker's persistent shell, which is
+        started or restarted as needed.
+
+        A command's timeout starts once the commands queued before it have
+        finished. A command which times out can only be stopped by closing
+        the shell, which also fails the commands queued behind it.
+        """
+        if self.shell is None or self.shell.closed:
+            self.shell = self.openShell()
+        def expired(failure):
+            failure.trap(TimeoutError)
+            return self.timedOut(command, timeout)
+        return self.shell.execute(command, timeout).addErrback(expired)
+
+    def timedOut(self, command, timeout, stdout="", stderr=""):
+        msg = "Command timed out after {:g} seconds.\n".format(timeout)
+        if stderr and not str(stderr).endswith("\n"):
+            msg = "\n" + msg
+        stderr = "{}{}".format(stderr, msg)
+        return command_result(command, stdout, stderr, True, timed_out=True)
+
+    def expireChannel(self, channel):
+        """
+        Stop a command which has run out of time, by asking the server to
+        kill it, which not every server supports, and closing its channel.
+        """
+        try:
+            channel.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+        channel.loseConnection()
+
     @defer.inlineCallbacks
-    def execFromThread(self, command):
+    def execChannel(self, command, timeout=0):
         """
-        API for tasks to execute ssh commands.
+        Execute a command over a new channel with its own protocol.
         """
-        ep = self.makeCommandEndpoint(command)
-        yield ep.connect(self)
+        protocol = yield self.transport.execute(command.encode('utf8'),
+                                                self.buildProtocol(None))
+        expiry = None
+        if timeout:
+            expiry = reactor.callLater(timeout, self.expireChannel, protocol.transport)
         failed = False
         try:
-            yield self.protocol.finished
+            yield protocol.finished
         except error.ProcessTerminated as e:
             failed = True
         # flush output from proto accumulated during execution
-        stdout, stderr = self.protocol.flush()
-        result = AttributeString(stdout)
-        result.stderr = stderr
-        result.failed = failed
-        result.succeeded = not failed
-        result.command = command
-        defer.returnValue(result)
+        stdout, stderr = protocol.flush()
+        if expiry is not None:
+            if expiry.called:
+                defer.returnValue(self.timedOut(command, timeout, stdout, stderr))
+            expiry.cancel()
+        defer.returnValue(command_result(command, stdout, stderr, failed))
+
+    def execBatchFromThread(self, commands):
+        """
+        API for tasks to execute a batch of ssh commands as a single script
+        over a single channel. Fires with the list of their results.
+        """
+        return self.channels.run(self.execBatch, commands)
+
+    def execBatch(self, commands):
+        shell = self.openShell()
+        results = map(shell.execute, commands)
+        shell.finish()
+        d = defer.gatherResults(results, consumeErrors=True)
+        return d.addErrback(lambda failure: failure.value.subFailure)
+
+    def execManyFromThread(self, commands, timeout=None):
+        """
+        API for tasks to execute several ssh commands concurrently.
+        """
+        if timeout is None:
+            timeout = self.command_timeout
+        execute = lambda command: self.channels.run(self.execChannel, command, timeout)
+        d = defer.gatherResults(map(execute, commands), consumeErrors=True)
+        return d.addErrback(lambda failure: failure.value.subFailure)
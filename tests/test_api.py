@@ -0,0 +1,71 @@
+import gc
+
+from twisted.trial import unittest
+from twisted.internet import defer, error
+
+from plait import api
+from plait.api import RemoteCallError, batch, run
+from plait.task import coroutine, thread_locals
+from plait.utils import command_result
+
+class BatchWorker(object):
+    """
+    Answers each batch with the results it was given.
+    """
+    def __init__(self, shipped):
+        self.batch = None
+        self.shipped = shipped
+        self.commands = None
+
+    def execBatchFromThread(self, commands):
+        self.commands = commands
+        return self.shipped
+
+def result(command, failed=False):
+    return command_result(command, "out", "err" if failed else "", failed)
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        # as from a coroutine task
+        self.patch(api, 'isInIOThread', lambda: True)
+
+    def use(self, shipped):
+        self.worker = BatchWorker(shipped)
+        thread_locals.worker = self.worker
+        self.addCleanup(delattr, thread_locals, 'worker')
+
+    def test_results_from_the_reactor(self):
+        self.use(defer.succeed([result("a"), result("b")]))
+        with batch() as b:
+            first = run("a")
+            run("b")
+        self.assertEqual(self.worker.commands, ["a", "b"])
+        self.assertEqual(self.successResultOf(first).command, "a")
+        results = self.successResultOf(b.deferred)
+        self.assertEqual([r.command for r in results], ["a", "b"])
+
+    def test_checked_failure_reported_by_batch(self):
+        self.use(defer.succeed([result("a"), result("b", failed=True)]))
+        with batch() as b:
+            run("a")
+            run("b", fail=True)
+        self.failureResultOf(b.deferred, RemoteCallError)
+        # the command's own Deferred isn't left holding the failure
+        gc.collect()
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_shipping_failure_reported_by_batch(self):
+        self.use(defer.fail(error.ConnectionLost()))
+        with batch() as b:
+            run("a")
+            run("b")
+        self.failureResultOf(b.deferred, error.ConnectionLost)
+        gc.collect()
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_coroutines_not_decorated(self):
+        def task():
+            yield run("a")
+        self.assertRaises(TypeError, batch, task)
+        self.assertRaises(TypeError, batch(), coroutine(task))
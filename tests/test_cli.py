@@ -0,0 +1,36 @@
+from twisted.trial import unittest
+
+from plait.cli import getConnectRate, getProcesses, getRelays
+from plait.errors import StartupError
+
+class ConnectRateTest(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual(getConnectRate("50/s"), 50)
+        self.assertEqual(getConnectRate("600/m"), 10)
+        self.assertEqual(getConnectRate("36"), 36)
+        self.assertEqual(getConnectRate("0"), 0)
+
+    def test_invalid(self):
+        for rate in ("fast", "5/d", "-1/s"):
+            self.assertRaises(StartupError, getConnectRate, rate)
+
+class ShardCountTest(unittest.TestCase):
+
+    def limits(self, scale="0", connect_scale=0, exec_scale=0):
+        return dict(batch=None, scale=scale, connect_scale=connect_scale,
+                    exec_scale=exec_scale)
+
+    def test_processes_capped_by_host_limits(self):
+        self.assertEqual(getProcesses(4, relay=(), **self.limits()), 4)
+        self.assertEqual(getProcesses(4, relay=(), **self.limits("2")), 2)
+        self.assertEqual(getProcesses(4, relay=(), **self.limits("auto", exec_scale=3)), 3)
+        self.assertEqual(getProcesses(4, relay=(), **self.limits("8", connect_scale=1)), 1)
+
+    def test_relays_refuse_smaller_limits(self):
+        relay = ("a=local", "b=root@bastion:22")
+        self.assertEqual(getRelays(relay, **self.limits("2")),
+                         [("a", "local"), ("b", "root@bastion:22")])
+        for limits in (self.limits("1"), self.limits(connect_scale=1),
+                       self.limits("auto", exec_scale=1)):
+            self.assertRaises(StartupError, getRelays, relay, **limits)
@@ -0,0 +1,65 @@
+from twisted.trial import unittest
+
+from plait.group import (GroupLimits, GroupRule, GroupedQueue, HostString,
+                         parse_inventory_line)
+from plait.runner import HostQueue
+
+def rack(host_string, label):
+    return HostString(host_string, {'rack': label})
+
+class GroupLimitsTest(unittest.TestCase):
+
+    def test_inventory_labels(self):
+        host_string = parse_inventory_line("root@web1:22 dc=east rack=r12")
+        self.assertEqual(host_string, "root@web1:22")
+        self.assertEqual(host_string.labels, {'dc': 'east', 'rack': 'r12'})
+
+    def test_groups_with_limits(self):
+        limits = GroupLimits({'rack': 1})
+        host_string = HostString("web1", {'rack': 'r1', 'dc': 'east'})
+        self.assertEqual(limits.groups(host_string), [('rack', 'r1')])
+
+    def test_rules_fill_missing_labels(self):
+        rules = [GroupRule('rack', r'^(r\d+)-'), GroupRule('net', '/24')]
+        limits = GroupLimits({'rack': 1, 'net': 1}, rules)
+        self.assertEqual(sorted(limits.groups("root@r7-web:22")), [('rack', 'r7')])
+        self.assertEqual(limits.groups("10.1.2.3"), [('net', '10.1.2.0/24')])
+        labelled = HostString("r7-web", {'rack': 'r9'})
+        self.assertEqual(limits.groups(labelled), [('rack', 'r9')])
+
+class GroupedQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limits = GroupLimits({'rack': 1})
+
+    def queue(self, hosts, window=10):
+        return GroupedQueue(HostQueue(hosts), self.limits, window)
+
+    def take(self, queue):
+        entry = self.successResultOf(queue.next())
+        return entry and entry[0][0]
+
+    def test_idle_groups_overtake_busy_ones(self):
+        queue = self.queue([rack("a", "r1"), rack("b", "r1"), rack("c", "r2")])
+        self.assertEqual(self.take(queue), "a")
+        self.assertEqual(self.take(queue), "c")
+        self.assertEqual(queue.overtaken, 1)
+        waiting = queue.next()
+        self.assertNoResult(waiting)
+        queue.finished([('rack', 'r1')])
+        entry, groups = self.successResultOf(waiting)
+        self.assertEqual((entry[0], groups), ("b", [('rack', 'r1')]))
+        self.assertEqual(self.limits.peaks, {'rack': 1})
+
+    def test_window_bounds_lookahead(self):
+        queue = self.queue([rack(name, "r1") for name in "abcdef"], window=2)
+        self.assertEqual(self.take(queue), "a")
+        self.assertNoResult(queue.next())
+        self.assertEqual(len(queue.pending), 2)
+        self.assertEqual(queue.peak_pending, 2)
+
+    def test_ends_when_hosts_run_out(self):
+        queue = self.queue(["x", "y"])
+        self.assertEqual(self.take(queue), "x")
+        self.assertEqual(self.take(queue), "y")
+        self.assertIdentical(self.successResultOf(queue.next()), None)
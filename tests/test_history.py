@@ -0,0 +1,65 @@
+import json
+
+from twisted.trial import unittest
+
+from plait.history import History, LongestFirst, makespan
+
+class MakespanTest(unittest.TestCase):
+
+    def test_unbounded(self):
+        self.assertEqual(makespan([3, 1, 2], 0), 3)
+        self.assertEqual(makespan([], 0), 0.0)
+
+    def test_first_free_slot(self):
+        self.assertEqual(makespan([1, 1, 4], 2), 5)
+        self.assertEqual(makespan([4, 1, 1], 2), 4)
+
+    def test_more_slots_than_jobs(self):
+        self.assertEqual(makespan([2, 5], 10), 5)
+        self.assertEqual(makespan([], 4), 0.0)
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def test_missing_or_corrupt_file(self):
+        self.assertEqual(History(self.path).durations, {})
+        with open(self.path, 'w') as fobj:
+            fobj.write("{not json")
+        self.assertEqual(History(self.path).durations, {})
+
+    def test_save_smooths_durations(self):
+        history = History(self.path)
+        history.record("web1", 10.0)
+        history.save()
+        history = History(self.path)
+        self.assertEqual(history.duration("web1"), 10.0)
+        history.record("web1", 20.0)
+        history.record("web2", 4.0)
+        history.save()
+        with open(self.path) as fobj:
+            self.assertEqual(json.load(fobj), {"web1": 15.0, "web2": 4.0})
+
+    def test_save_merges_concurrent_runs(self):
+        first, second = History(self.path), History(self.path)
+        first.record("web1", 1.0)
+        first.save()
+        second.record("web2", 2.0)
+        second.save()
+        self.assertEqual(History(self.path).durations, {"web1": 1.0, "web2": 2.0})
+
+    def test_unknown_hosts_take_the_median(self):
+        history = History(self.path)
+        history.durations = {"a": 1.0, "b": 5.0, "c": 9.0}
+        estimates = history.estimates(["a", "new", "c", "b"])
+        self.assertEqual(estimates, [("a", 1.0), ("new", 5.0), ("c", 9.0), ("b", 5.0)])
+
+    def test_longest_first(self):
+        history = History(self.path)
+        history.durations = {"a": 1.0, "b": 1.0, "c": 4.0}
+        schedule = LongestFirst(["a", "b", "c"], history, 2)
+        self.assertEqual(list(schedule), ["c", "a", "b"])
+        self.assertEqual(schedule.inventory, 5.0)
+        self.assertEqual(schedule.predicted, 4.0)
+        self.assertEqual(schedule.known, 3)
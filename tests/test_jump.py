@@ -0,0 +1,94 @@
+from twisted.trial import unittest
+
+from plait.group import GroupLimits, GroupedQueue, HostString
+from plait.jump import Jump, JumpLink, JumpPool, JumpRule
+from plait.runner import HostQueue
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.transport = self
+        self.connected = True
+
+class JumpLinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connecting = []
+        self.patch(JumpLink, 'connect', lambda link: self.connecting.append(link))
+        self.jump = Jump("root@bastion:22", [], None, 10, channels=2)
+
+    def test_reserves_tunnels_before_connecting(self):
+        first, second, third = [self.jump.link() for _ in range(3)]
+        self.assertEqual(len(self.connecting), 2)
+        self.assertEqual([link.tunnels for link in self.jump.links], [2, 1])
+        link = self.jump.links[0]
+        link.connected(FakeConnection())
+        self.assertIs(self.successResultOf(first), link)
+        self.assertIs(self.successResultOf(second), link)
+        self.assertNoResult(third)
+        self.assertEqual(self.jump.connections, 1)
+
+    def test_release_makes_room(self):
+        self.jump.link()
+        self.jump.link()
+        link = self.jump.links[0]
+        link.connected(FakeConnection())
+        link.release()
+        self.successResultOf(self.jump.link())
+        self.assertEqual(self.jump.links, [link])
+        self.assertEqual(link.tunnels, 2)
+
+    def test_failed_connection_releases_reservations(self):
+        first, second = self.jump.link(), self.jump.link()
+        link = self.jump.links[0]
+        link.failed(ValueError("refused"))
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+        self.assertEqual(link.tunnels, 0)
+        self.assertEqual(self.jump.links, [])
+        self.assertEqual(self.jump.failures, 1)
+
+    def test_dead_links_are_replaced(self):
+        self.jump.link()
+        link = self.jump.links[0]
+        connection = FakeConnection()
+        link.connected(connection)
+        connection.connected = False
+        self.jump.link()
+        self.assertEqual(len(self.jump.links), 1)
+        self.assertIsNot(self.jump.links[0], link)
+
+class JumpPoolTest(unittest.TestCase):
+
+    def test_label_overrides_default(self):
+        pool = JumpPool("root@bastion:22", [], None, 10, limit=3)
+        labelled = HostString("web1", {'jump': "root@edge:22"})
+        self.assertEqual(pool.jumpFor("web2").host_string, "root@bastion:22")
+        self.assertEqual(pool.jumpFor(labelled).host_string, "root@edge:22")
+        self.assertIs(pool.jumpFor("web3"), pool.jumpFor("web2"))
+        self.assertEqual(pool.jumpFor("web2").stage.limit, 3)
+
+    def test_no_jump(self):
+        self.assertIsNone(JumpPool(None, [], None, 10).jumpFor("web1"))
+
+class JumpRuleTest(unittest.TestCase):
+
+    def test_groups(self):
+        limits = GroupLimits({'jump': 1}, [JumpRule("root@bastion:22")])
+        labelled = HostString("web1", {'jump': "root@edge:22"})
+        self.assertEqual(limits.groups("web2"), [('jump', "root@bastion:22")])
+        self.assertEqual(limits.groups(labelled), [('jump', "root@edge:22")])
+        limits = GroupLimits({'jump': 1}, [JumpRule(None)])
+        self.assertEqual(limits.groups("web2"), [])
+
+    def test_busy_jump_host_is_overtaken(self):
+        limits = GroupLimits({'jump': 1}, [JumpRule("root@bastion:22")])
+        hosts = ["web1", "web2", HostString("web3", {'jump': "root@edge:22"})]
+        queue = GroupedQueue(HostQueue(hosts), limits, 10)
+        first = self.successResultOf(queue.next())
+        second = self.successResultOf(queue.next())
+        self.assertEqual([first[0][0], second[0][0]], ["web1", "web3"])
+        waiting = queue.next()
+        self.assertNoResult(waiting)
+        queue.finished(first[1])
+        self.assertEqual(self.successResultOf(waiting)[0][0], "web2")
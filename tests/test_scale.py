@@ -0,0 +1,186 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from blinker import signal
+
+from plait import scale
+from plait.scale import AdjustableSemaphore, ScaleController, Stage, TokenBucket
+
+class FakeTime(object):
+    """
+    Stands in for the time module, telling the time of a Clock.
+    """
+    def __init__(self, clock):
+        self.time = clock.seconds
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.patch(scale, 'reactor', self.clock)
+        self.patch(scale, 'time', FakeTime(self.clock))
+
+class AdjustableSemaphoreTest(unittest.TestCase):
+
+    def test_raising_limit_wakes_waiters(self):
+        semaphore = AdjustableSemaphore(1)
+        first, second, third = [semaphore.acquire() for i in range(3)]
+        self.assertTrue(first.called)
+        self.assertFalse(second.called)
+        semaphore.setLimit(3)
+        self.assertTrue(second.called)
+        self.assertTrue(third.called)
+
+    def test_lowering_limit_waits_for_debt(self):
+        semaphore = AdjustableSemaphore(3)
+        for i in range(3):
+            semaphore.acquire()
+        semaphore.setLimit(1)
+        waiting = semaphore.acquire()
+        semaphore.release()
+        semaphore.release()
+        self.assertFalse(waiting.called)
+        semaphore.release()
+        self.assertTrue(waiting.called)
+
+    def test_cancel_leaves_queue(self):
+        semaphore = AdjustableSemaphore(1)
+        semaphore.acquire()
+        d = semaphore.acquire()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(semaphore.waiting, [])
+
+class ScaleControllerTest(ClockTestCase):
+
+    def setUp(self):
+        super(ScaleControllerTest, self).setUp()
+        self.controller = ScaleController()
+        self.changes = []
+        def changed(sender, limit=None, reason=None):
+            self.changes.append((limit, reason))
+        signal('scale_change').connect(changed, sender=self.controller)
+        self.addCleanup(signal('scale_change').disconnect, changed)
+        self.controller.last_tick = self.clock.seconds()
+
+    def tick(self, lag=0.0):
+        self.clock.advance(self.controller.interval + lag)
+        self.controller.tick()
+
+    def demand(self, hosts=1000):
+        for i in range(hosts):
+            self.controller.semaphore.acquire()
+
+    def test_grows_with_demand(self):
+        self.demand(ScaleController.initial + 1)
+        self.tick()
+        self.assertEqual(self.controller.limit, 24)
+        self.assertEqual(self.changes, [(24, "demand")])
+
+    def test_idle_keeps_limit(self):
+        self.tick()
+        self.assertEqual(self.controller.limit, 16)
+        self.assertEqual(self.changes, [])
+
+    def test_timeouts_halve_limit(self):
+        self.controller.connected(0.1)
+        self.controller.timedout()
+        self.tick()
+        self.assertEqual(self.changes, [(8, "timeouts")])
+        self.assertEqual(self.controller.decreases, {"timeouts": 1})
+
+    def test_reactor_lag_halves_limit(self):
+        self.tick(lag=1.0)
+        self.assertEqual(self.changes, [(8, "reactor lag")])
+
+    def test_latency_against_baseline(self):
+        for latency in (0.1, 0.2):
+            self.controller.connected(latency)
+            self.tick()
+        self.assertEqual(self.changes, [])
+        self.assertAlmostEqual(self.controller.baseline, 0.125)
+        self.controller.connected(0.4)
+        self.tick()
+        self.assertEqual(self.changes, [(8, "latency")])
+
+    def test_baseline_recovers_after_fast_phase(self):
+        self.demand()
+        for i in range(3):
+            self.controller.connected(0.05)
+            self.tick()
+        for i in range(20):
+            self.controller.connected(0.3)
+            self.tick()
+        self.assertEqual(self.controller.decreases, {"latency": 2})
+        self.assertTrue(self.controller.limit > ScaleController.initial)
+        self.assertAlmostEqual(self.controller.baseline, 0.3, places=2)
+
+    def test_never_below_minimum(self):
+        self.controller.semaphore.setLimit(1)
+        self.tick(lag=1.0)
+        self.assertEqual(self.controller.limit, 1)
+        self.assertEqual(self.changes, [])
+
+class StageTest(ClockTestCase):
+
+    def test_limit_and_waits(self):
+        stage = Stage("connect", 1)
+        first, second = defer.Deferred(), defer.Deferred()
+        done = [stage.run(lambda: first), stage.run(lambda: second)]
+        self.assertEqual((stage.active, stage.waiting), (1, 1))
+        self.clock.advance(2)
+        first.callback("a")
+        self.assertEqual((stage.active, stage.waiting), (1, 0))
+        second.callback("b")
+        self.assertEqual([self.successResultOf(d) for d in done], ["a", "b"])
+        self.assertEqual((stage.peak_active, stage.peak_waiting), (1, 1))
+        self.assertEqual(stage.max_wait, 2)
+        self.assertEqual(stage.total_wait, 2)
+
+    def test_failure_frees_slot(self):
+        stage = Stage("exec", 1)
+        self.failureResultOf(stage.run(defer.fail, ValueError()), ValueError)
+        self.assertEqual(self.successResultOf(stage.run(defer.succeed, 1)), 1)
+
+    def test_unbounded_never_waits(self):
+        stage = Stage("exec")
+        pending = [defer.Deferred() for i in range(3)]
+        for d in pending:
+            stage.run(lambda d=d: d)
+        self.assertEqual((stage.peak_active, stage.peak_waiting), (3, 0))
+        self.assertIn("3 hosts (unbounded)", stage.stats())
+
+class TokenBucketTest(ClockTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, burst=3)
+        acquired = [bucket.acquire() for i in range(5)]
+        self.assertEqual([d.called for d in acquired], [True] * 3 + [False] * 2)
+        self.clock.advance(0.5)
+        self.assertEqual([d.called for d in acquired], [True] * 4 + [False])
+        self.clock.advance(0.5)
+        self.assertTrue(acquired[4].called)
+        self.assertEqual(bucket.granted, 5)
+        self.assertEqual(bucket.delayed, 2)
+        self.assertEqual(bucket.max_wait, 1.0)
+
+    def test_refills_up_to_burst(self):
+        bucket = TokenBucket(10, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        self.clock.advance(60)
+        acquired = [bucket.acquire() for i in range(3)]
+        self.assertEqual([d.called for d in acquired], [True, True, False])
+
+    def test_newcomers_queue_behind_waiters(self):
+        bucket = TokenBucket(1)
+        bucket.acquire()
+        waiting = bucket.acquire()
+        self.clock.advance(0.9)
+        newcomer = bucket.acquire()
+        self.clock.advance(0.1)
+        self.assertTrue(waiting.called)
+        self.assertFalse(newcomer.called)
+        self.clock.advance(1)
+        self.assertTrue(newcomer.called)
@@ -0,0 +1,126 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from plait.group import HostString
+from plait.jump import JumpPool
+from plait.serve import PlaitServer, WarmPool, WarmView
+from plait.utils import Bag
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.alive = True
+        self.disconnected = False
+        self.keepalives = []
+
+    def keepalive(self):
+        d = defer.Deferred()
+        self.keepalives.append(d)
+        return d
+
+    def disconnect(self):
+        self.alive = False
+        self.disconnected = True
+
+class WarmPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.warm = WarmPool(interval=30.0)
+        self.transport = FakeTransport()
+        self.warm.keep('web1', self.transport)
+
+    def test_take(self):
+        self.assertIs(self.warm.take('web1'), self.transport)
+        self.assertIsNone(self.warm.take('web2'))
+        self.assertEqual((self.warm.reused, self.warm.opened), (1, 1))
+
+    def test_take_drops_closed(self):
+        self.transport.alive = False
+        self.assertIsNone(self.warm.take('web1'))
+        self.assertEqual(self.warm.transports, {})
+        self.assertEqual(self.warm.dropped, 1)
+
+    def test_answered_keepalive_keeps(self):
+        self.warm.keepalive()
+        self.transport.keepalives[0].callback(None)
+        self.warm.keepalive()
+        self.assertEqual(len(self.transport.keepalives), 2)
+        self.assertIn('web1', self.warm.transports)
+        self.assertEqual(self.warm.keepalives, 2)
+
+    def test_failed_keepalive_keeps(self):
+        # a refused request still shows the connection is up
+        self.warm.keepalive()
+        self.transport.keepalives[0].errback(ValueError())
+        self.warm.keepalive()
+        self.assertIn('web1', self.warm.transports)
+
+    def test_unanswered_keepalive_drops(self):
+        self.warm.keepalive()
+        self.warm.keepalive()
+        self.assertEqual(self.warm.transports, {})
+        self.assertEqual(self.warm.pending, set())
+        self.assertTrue(self.transport.disconnected)
+        self.assertEqual(self.warm.dropped, 1)
+
+    def test_closed_connection_drops(self):
+        self.transport.alive = False
+        self.warm.keepalive()
+        self.assertEqual(self.warm.transports, {})
+        self.assertFalse(self.transport.disconnected)
+        self.assertEqual(self.transport.keepalives, [])
+
+    def test_loop(self):
+        clock = task.Clock()
+        self.warm.loop.clock = clock
+        self.warm.start()
+        self.assertEqual(self.transport.keepalives, [])
+        clock.advance(30)
+        clock.advance(30)
+        self.assertTrue(self.transport.disconnected)
+        self.warm.close()
+        self.assertFalse(self.warm.loop.running)
+
+    def test_close(self):
+        self.warm.close()
+        self.assertEqual(self.warm.transports, {})
+        self.assertTrue(self.transport.disconnected)
+
+def settings(**kwargs):
+    defaults = dict(transport='conch', identity=None, ssh_options=[])
+    defaults.update(kwargs)
+    return Bag(**defaults)
+
+class WarmViewTest(unittest.TestCase):
+
+    def test_keys(self):
+        warm = WarmPool()
+        jumps = JumpPool(None, [], None, 10)
+        conch = WarmView(warm, settings(), jumps)
+        openssh = WarmView(warm, settings(transport='openssh'), jumps)
+        transport = FakeTransport()
+        conch.keep("root@web1:22", transport)
+        self.assertIs(conch.take("root@web1:22"), transport)
+        self.assertIsNone(openssh.take("root@web1:22"))
+        jumped = HostString("root@web1:22", {'jump': "root@bastion:22"})
+        self.assertIsNone(conch.take(jumped))
+        jumps.default = "root@bastion:22"
+        self.assertIsNone(conch.take("root@web1:22"))
+
+class FakeCloseable(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class PlaitServerTest(unittest.TestCase):
+
+    def test_close(self):
+        server = PlaitServer("/nonexistent", None)
+        server.jumps = {None: FakeCloseable(), "id_rsa": FakeCloseable()}
+        server.openssh = {(None, ()): FakeCloseable()}
+        server.close()
+        closed = server.jumps.values() + server.openssh.values()
+        self.assertTrue(all(each.closed for each in closed))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import json
+
+from twisted.trial import unittest
+
+from blinker import signal
+
+from plait.group import HostString
+from plait.errors import ShardError
+from plait.shard import (RelayRunner, Shard, ShardedRunner, pack,
+                         shareSettings, unpack)
+from plait.utils import Bag
+
+def roundtrip(data):
+    return unpack(json.loads(json.dumps(pack(data))))
+
+class PackTest(unittest.TestCase):
+
+    def test_bytes_survive_json(self):
+        for data in ["plain\n", "caf\xc3\xa9", "\xff\xfe\x00\x80", ""]:
+            self.assertEqual(roundtrip(data), data)
+
+    def test_unicode_as_utf8(self):
+        self.assertEqual(roundtrip(u"caf\xe9"), "caf\xc3\xa9")
+
+class ShardEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shard = Shard(None, 0, "test")
+        self.received = []
+        def stdout(worker, data=None):
+            self.received.append((str(worker.host_string), data))
+        signal('worker_stdout').connect(stdout)
+        self.addCleanup(signal('worker_stdout').disconnect, stdout)
+
+    def event(self, event, **fields):
+        fields['event'] = event
+        return json.dumps(fields) + '\n'
+
+    def test_output_through_events(self):
+        stream = (self.event('worker_start', worker=7, host="web1",
+                             labels={'rack': 'r1'}) +
+                  self.event('worker_stdout', worker=7, data=pack("\xff out\n")))
+        # events may arrive split anywhere
+        for start in range(0, len(stream), 5):
+            self.shard.dataReceived(stream[start:start + 5])
+        self.assertEqual(self.received, [("web1", "\xff out\n")])
+        self.assertEqual(self.shard.workers[7].host_string.labels, {'rack': 'r1'})
+        self.assertEqual(self.shard.buffer, '')
+
+    def test_events_of_unknown_workers_dropped(self):
+        self.shard.dataReceived(self.event('worker_stdout', worker=3, data=pack("x")))
+        self.assertEqual(self.received, [])
+
+class FakeShard(object):
+    def __init__(self, name):
+        self.name = name
+        self.alive = True
+        self.outstanding = 0
+        self.sent = []
+        self.ended = False
+
+    def send(self, host_string):
+        self.sent.append(str(host_string))
+        self.outstanding += 1
+
+    def end(self):
+        self.ended = True
+
+def settings(**kwargs):
+    values = dict(scale='4', connect_scale='0', exec_scale='0', task_threads='4',
+                  connect_rate=0.0, connect_burst='1', jump_scale='0',
+                  history=None, schedule='inventory', group_limits={},
+                  group_rules=[], max_failures='0', max_failure_rate='0',
+                  keys=[], agent_endpoint=None, timeout='10')
+    values.update(kwargs)
+    return Bag(**values)
+
+class ShardedRunnerTest(unittest.TestCase):
+
+    def runner(self, hosts, count=2, **kwargs):
+        runner = ShardedRunner(hosts, settings(**kwargs), count, [])
+        runner.shards = [FakeShard(index) for index in range(count)]
+        runner.connected = True
+        return runner
+
+    def finish(self, runner, shard, host_string):
+        shard.outstanding -= 1
+        runner.hostFinished(host_string, False, None)
+
+    def test_groups_kept_together(self):
+        r1, dc_a = HostString("h1", {'rack': 'r1'}), HostString("h2", {'dc': 'a'})
+        both = HostString("h3", {'dc': 'a', 'rack': 'r1'})
+        other = HostString("h4")
+        runner = self.runner([r1, dc_a, both, other],
+                             group_limits={'rack': 1, 'dc': 1})
+        first, second = runner.shards
+        runner.feed()
+        # h3's groups run on both shards, so it waits without holding up h4
+        self.assertEqual((first.sent, second.sent), (["h1", "h4"], ["h2"]))
+        self.assertEqual(runner.aside, [both])
+        self.assertFalse(first.ended)
+        self.finish(runner, first, r1)
+        self.assertEqual(second.sent, ["h2", "h3"])
+        self.assertTrue(first.ended and second.ended)
+
+    def test_full_shard_does_not_stall_others(self):
+        hosts = [HostString("r1-{}".format(n), {'rack': 'r1'}) for n in range(3)]
+        hosts.append(HostString("free"))
+        runner = self.runner(hosts, group_limits={'rack': 1})
+        runner.window = 2
+        runner.feed()
+        first, second = runner.shards
+        self.assertEqual(first.sent, ["r1-0", "r1-1"])
+        self.assertEqual(second.sent, ["free"])
+
+    def test_large_limits_shared_not_pinned(self):
+        runner = self.runner([], count=3, group_limits={'rack': 4, 'dc': 2})
+        self.assertEqual(runner.groups.limits, {'dc': 2})
+        shares = [shareSettings(settings(group_limits={'rack': 4, 'dc': 2}), index, 3)
+                  for index in range(3)]
+        self.assertEqual([s.group_limits['rack'] for s in shares], [2, 1, 1])
+        self.assertEqual([s.group_limits['dc'] for s in shares], [2, 2, 2])
+
+    def test_every_shard_lost(self):
+        runner = self.runner(["h1"])
+        for shard in runner.shards:
+            shard.alive = False
+        runner.feed()
+        self.assertEqual(runner.cancelled, "Every shard has been lost.")
+
+class RelayRunnerTest(unittest.TestCase):
+
+    def runner(self, relay_by=None, **kwargs):
+        relays = [("east", "root@bastion-east:22"), ("west", "local")]
+        runner = RelayRunner([], settings(**kwargs), relays, [], relay_by=relay_by)
+        runner.shards = [runner.makeShard(index) for index in range(2)]
+        for shard in runner.shards:
+            shard.alive = True
+        return runner
+
+    def test_least_loaded_without_relay_by(self):
+        runner = self.runner()
+        runner.named["east"].outstanding = 3
+        self.assertIdentical(runner.shardFor(HostString("web1")), runner.named["west"])
+
+    def test_relay_by_label(self):
+        runner = self.runner(relay_by='dc')
+        host_string = HostString("web1", {'dc': 'east'})
+        self.assertIdentical(runner.shardFor(host_string), runner.named["east"])
+
+    def test_relay_by_unknown_or_lost(self):
+        runner = self.runner(relay_by='dc')
+        self.assertRaises(ShardError, runner.shardFor, HostString("web1", {'dc': 'north'}))
+        self.assertRaises(ShardError, runner.shardFor, HostString("web1"))
+        runner.named["west"].alive = False
+        self.assertRaises(ShardError, runner.shardFor, HostString("web1", {'dc': 'west'}))
+
+    def test_relay_by_waits_for_groups_elsewhere(self):
+        runner = self.runner(relay_by='dc', group_limits={'app': 1})
+        runner.pinned[('app', 'db')] = runner.named["east"]
+        runner.held[('app', 'db')] = 1
+        host_string = HostString("db2", {'dc': 'west', 'app': 'db'})
+        self.assertIdentical(runner.shardFor(host_string), None)
@@ -0,0 +1,183 @@
+import subprocess
+
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.failure import Failure
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionDone
+
+from blinker import signal
+
+from plait import shell
+from plait.errors import TimeoutError
+from plait.shell import ShellProtocol, frame
+from plait.spool import SpoolingProtocol
+from plait.worker import PlaitWorker
+
+def run_sh(script):
+    process = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return process.communicate(script)
+
+class FrameTest(unittest.TestCase):
+
+    def test_sentinels_follow_output(self):
+        stdout, stderr = run_sh(frame("echo out; echo err >&2; exit 3", "__s__"))
+        self.assertEqual(stdout, "out\n\n__s__ 3\n")
+        self.assertEqual(stderr, "err\n\n__s__\n")
+
+    def test_command_cannot_read_script(self):
+        # the rest of the script mustn't be swallowed as the command's input
+        script = frame("cat", "__a__") + frame("echo next", "__b__")
+        stdout, stderr = run_sh(script)
+        self.assertEqual(stdout, "\n__a__ 0\nnext\n\n__b__ 0\n")
+
+class ShellProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shell = ShellProtocol(SpoolingProtocol)
+        self.transport = StringTransport()
+
+    def connect(self):
+        self.shell.makeConnection(self.transport)
+
+    def results(self, *commands):
+        results = []
+        for command in commands:
+            self.shell.execute(command).addCallback(results.append)
+        return results
+
+    def replay(self, chunk=None):
+        """
+        Feed the shell the output /bin/sh gives for the scripts written to
+        it, `chunk` bytes at a time.
+        """
+        stdout, stderr = run_sh(self.transport.value())
+        for stream, data in (('stdout', stdout), ('stderr', stderr)):
+            size = chunk or len(data) or 1
+            for start in range(0, len(data), size):
+                self.shell.feed(stream, data[start:start + size])
+
+    def test_results_in_order(self):
+        self.connect()
+        results = self.results(u"echo one", u"echo two >&2; false")
+        self.replay()
+        self.assertEqual([r.stdout for r in results], ["one\n", ""])
+        self.assertEqual(str(results[1].stderr), "two\n")
+        self.assertEqual([r.failed for r in results], [False, True])
+        self.assertEqual([r.succeeded for r in results], [True, False])
+
+    def test_output_without_newline(self):
+        self.connect()
+        results = self.results(u"printf abc")
+        self.replay()
+        self.assertEqual(results[0].stdout, "abc")
+
+    def test_sentinels_split_across_reads(self):
+        self.connect()
+        results = self.results(u"echo one", u"printf two", u"exit 4")
+        self.replay(chunk=1)
+        self.assertEqual([r.stdout for r in results], ["one\n", "two", ""])
+        self.assertEqual([r.failed for r in results], [False, False, True])
+
+    def test_queued_until_connected(self):
+        results = self.results(u"echo early")
+        self.assertEqual(self.transport.value(), "")
+        self.connect()
+        self.replay()
+        self.assertEqual(results[0].stdout, "early\n")
+
+    def test_close_fails_queued_commands(self):
+        d = self.shell.execute(u"echo never")
+        self.shell.close()
+        self.assertTrue(self.shell.closed)
+        self.failureResultOf(d, ConnectionDone)
+        self.assertRaises(RuntimeError, self.shell.execute, u"echo late")
+
+    def test_lost_connection_fails_pending(self):
+        self.connect()
+        d = self.shell.execute(u"echo lost")
+        self.shell.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+
+class ShellTransport(object):
+    """
+    Connects each command's protocol to a StringTransport.
+    """
+    def __init__(self):
+        self.transport = StringTransport()
+
+    def execute(self, command, protocol):
+        protocol.makeConnection(self.transport)
+        return defer.succeed(protocol)
+
+class WorkerShellTest(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = PlaitWorker([], None, None, None, 10)
+        self.worker.parse_host_string("root@web1:22")
+        self.worker.transport = ShellTransport()
+        self.lines = []
+        for name in ('stdout', 'stderr'):
+            def received(sender, data=None, name=name):
+                self.lines.append((sender, name, data))
+            signal(name).connect(received, sender="root@web1:22")
+            self.addCleanup(signal(name).disconnect, received)
+
+    def test_output_signalled_like_channels(self):
+        shell = self.worker.openShell()
+        results = []
+        shell.execute(u"echo out; echo err >&2").addCallback(results.append)
+        stdout, stderr = run_sh(self.worker.transport.transport.value())
+        shell.dataReceived(stdout)
+        shell.extReceived(1, stderr)
+        self.assertEqual(results[0].stdout, "out\n")
+        self.assertEqual(self.lines, [("root@web1:22", 'stdout', "out\n"),
+                                      ("root@web1:22", 'stderr', "err\n")])
+    def test_timed_out_result(self):
+        clock = task.Clock()
+        self.patch(shell, 'reactor', clock)
+        d = self.worker.execShell(u"sleep 60", timeout=3)
+        clock.advance(3)
+        self.worker.shell.connectionLost(Failure(ConnectionDone()))
+        result = self.successResultOf(d)
+        self.assertTrue(result.failed)
+        self.assertTrue(result.timed_out)
+
+class ShellTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(shell, 'reactor', self.clock)
+        self.shell = ShellProtocol(SpoolingProtocol)
+        self.transport = StringTransport()
+        self.shell.makeConnection(self.transport)
+
+    def finish(self, count):
+        """
+        Feed the shell the sentinels of its next `count` commands.
+        """
+        for shell_command in list(self.shell.commands)[:count]:
+            self.shell.feed('stdout', shell_command.marker + " 0\n")
+            self.shell.feed('stderr', shell_command.marker + "\n")
+
+    def test_timeout_starts_at_head_of_queue(self):
+        slow = self.shell.execute(u"sleep 5")
+        quick = self.shell.execute(u"true", timeout=2)
+        self.clock.advance(4)
+        self.finish(1)
+        self.successResultOf(slow)
+        self.assertNoResult(quick)
+        self.clock.advance(1)
+        self.finish(1)
+        self.assertEqual(self.successResultOf(quick).failed, False)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_expiry_closes_shell(self):
+        stuck = self.shell.execute(u"sleep 60", timeout=2)
+        behind = self.shell.execute(u"true")
+        self.clock.advance(2)
+        self.assertTrue(self.transport.disconnecting)
+        self.shell.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(stuck, TimeoutError)
+        self.failureResultOf(behind, ConnectionDone)
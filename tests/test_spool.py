@@ -0,0 +1,39 @@
+import os
+
+from twisted.trial import unittest
+
+from plait.spool import SpoolingProtocol
+from plait.utils import SpilledString
+
+class SpillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = self.mktemp()
+        os.mkdir(self.dir)
+
+    def test_small_output_stays_in_memory(self):
+        spooling = SpoolingProtocol(16, dir=self.dir)
+        spooling.dataReceived("short\n")
+        stdout, stderr = spooling.flush()
+        self.assertEqual((stdout, stderr), ("short\n", ""))
+        self.assertNotIsInstance(stdout, SpilledString)
+
+    def test_large_output_spills(self):
+        spooling = SpoolingProtocol(16, prefix="plait-web1-", dir=self.dir)
+        spooling.dataReceived("line one\n")
+        spooling.dataReceived("line two\n")
+        spooling.dataReceived("line three\n")
+        stdout, stderr = spooling.flush()
+        self.assertIsInstance(stdout, SpilledString)
+        self.assertEqual(len(stdout), 29)
+        self.assertEqual(list(stdout), ["line one\n", "line two\n", "line three\n"])
+        self.assertIn("two", stdout)
+        self.assertEqual(stdout[5:8], "one")
+        self.assertEqual(stdout.splitlines()[-1], "line three")
+
+    def test_buffer_reusable_after_flush(self):
+        spooling = SpoolingProtocol(4, dir=self.dir)
+        spooling.dataReceived("spilled")
+        spooling.flush()
+        spooling.dataReceived("ok")
+        self.assertEqual(spooling.flush()[0], "ok")
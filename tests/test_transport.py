@@ -0,0 +1,236 @@
+import os
+
+from twisted.internet import defer, error
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from plait.errors import TransportError
+from plait.jump import JumpPool
+from plait.transport import ConchTransport, OpenSSH, SSHMaster, SSHProcess
+from plait.utils import Bag
+
+def worker(jump=None):
+    return Bag(user="root", host="web1", port=2222, host_string="root@web1:2222",
+               jumps=JumpPool(jump, [], None, 10), timeout=10)
+
+def ended(code):
+    return Failure(error.ProcessTerminated(exitCode=code))
+
+class FakeProcess(object):
+
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+class OpenSSHTest(unittest.TestCase):
+
+    def setUp(self):
+        self.openssh = OpenSSH("/keys/id_rsa", ["Compression=yes"])
+        self.openssh.directory = self.mktemp()
+        os.mkdir(self.openssh.directory)
+        self.spawned = []
+
+    def transport(self, jump=None):
+        transport = self.openssh(worker(jump))
+        transport.spawn = lambda protocol, argv: self.spawned.append((protocol, argv))
+        return transport
+
+    def test_argv(self):
+        self.assertEqual(self.openssh.argv("root", 22, '-N'),
+                         ['ssh', '-o', 'BatchMode=yes', '-p', '22', '-l', 'root',
+                          '-i', '/keys/id_rsa', '-o', 'Compression=yes', '-N'])
+
+    def test_control_paths(self):
+        first, second = self.transport(), self.transport()
+        self.assertNotEqual(first.path, second.path)
+        self.assertEqual(os.path.dirname(first.path), self.openssh.directory)
+
+    def test_transport_argv(self):
+        transport = self.transport()
+        argv = transport.argv('-T')
+        self.assertEqual(argv[-4:], ['-S', transport.path, '-T', 'web1'])
+        self.assertIn('2222', argv)
+        self.assertFalse([arg for arg in argv if 'ProxyCommand' in arg])
+
+    def test_jump_proxy_command(self):
+        argv = self.transport("admin@bastion:2200").argv()
+        proxy = argv[argv.index('-o', argv.index('-S')) + 1]
+        self.assertEqual(proxy, "ProxyCommand=ssh -o BatchMode=yes -p 2200 "
+                                "-l admin -i /keys/id_rsa -o Compression=yes "
+                                "-W %h:%p bastion")
+        self.assertEqual(argv[-1], 'web1')
+
+    def test_execute(self):
+        transport = self.transport()
+        protocol = object()
+        transport.execute("uname -s", protocol)
+        process, argv = self.spawned[0]
+        self.assertIs(process.protocol, protocol)
+        self.assertEqual(argv[-3:], ['ControlMaster=no', 'web1', 'uname -s'])
+
+    def connect(self, transport):
+        d = transport.connect()
+        # as the master does once it has authenticated
+        open(transport.path, 'w').close()
+        return d
+
+    @defer.inlineCallbacks
+    def test_connect_tracks_master(self):
+        transport = self.transport()
+        yield self.connect(transport)
+        master, argv = self.spawned[0]
+        self.assertIn('-M', argv)
+        self.assertIn('ConnectTimeout=10', argv)
+        self.assertTrue(transport.alive)
+        self.assertEqual(self.openssh.masters, set([transport]))
+        master.processEnded(ended(255))
+        self.assertFalse(transport.alive)
+        self.assertEqual(self.openssh.masters, set())
+
+    def test_ready_once_socket_exists(self):
+        transport = self.transport()
+        transport.master = SSHMaster()
+        d = transport.ready()
+        open(transport.path, 'w').close()
+        return d
+
+    def test_ready_fails_if_master_exits(self):
+        transport = self.transport()
+        transport.master = SSHMaster()
+        d = transport.ready()
+        transport.master.errReceived("Permission denied (publickey).\n")
+        transport.master.processEnded(ended(255))
+        d = self.assertFailure(d, TransportError)
+        d.addCallback(lambda e: self.assertEqual(
+            str(e), "ssh exited with code 255: Permission denied (publickey)."))
+        return d
+
+    def test_cancel_ready_stops_master(self):
+        transport = self.transport()
+        transport.master = SSHMaster()
+        transport.master.transport = FakeProcess()
+        d = transport.ready()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(transport.master.transport.signals, ['TERM'])
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        transport = self.transport()
+        yield self.connect(transport)
+        master = self.spawned[0][0]
+        master.transport = FakeProcess()
+        directory = self.openssh.directory
+        self.openssh.close()
+        self.assertEqual(master.transport.signals, ['TERM'])
+        self.assertFalse(os.path.exists(directory))
+
+class SSHMasterTest(unittest.TestCase):
+
+    def test_error_without_stderr(self):
+        master = SSHMaster()
+        master.processEnded(ended(255))
+        self.assertFalse(master.running)
+        self.assertEqual(str(master.error()), "ssh exited with code 255")
+
+    def test_stderr_is_bounded(self):
+        master = SSHMaster()
+        master.errReceived("x" * 5000)
+        master.errReceived("\nConnection refused\n")
+        self.assertEqual(len(master.stderr), 4096)
+        master.processEnded(ended(255))
+        self.assertEqual(str(master.error()),
+                         "ssh exited with code 255: Connection refused")
+
+    def test_stop_after_exit(self):
+        master = SSHMaster()
+        master.transport = FakeProcess()
+        master.processEnded(ended(0))
+        master.stop()
+        self.assertEqual(master.transport.signals, [])
+
+class FakeProtocol(object):
+
+    def __init__(self):
+        self.events = []
+
+    def makeConnection(self, transport):
+        self.events.append(('connected', transport))
+
+    def dataReceived(self, data):
+        self.events.append(('out', data))
+
+    def extReceived(self, dataType, data):
+        self.events.append(('err', data))
+
+    def connectionLost(self, reason):
+        self.events.append(('lost', reason.value.exitCode))
+
+class SSHProcessTest(unittest.TestCase):
+
+    def test_routes_process_to_protocol(self):
+        protocol = FakeProtocol()
+        process = SSHProcess(protocol)
+        process.transport = FakeProcess()
+        process.connectionMade()
+        process.outReceived("one\n")
+        process.errReceived("two\n")
+        process.processEnded(ended(1))
+        self.assertIs(self.successResultOf(process.started), protocol)
+        self.assertEqual(protocol.events, [('connected', process.transport),
+                                           ('out', "one\n"), ('err', "two\n"),
+                                           ('lost', 1)])
+
+class FakeConnection(object):
+    """
+    A Conch connection, its transport and the TCP transport under it.
+    """
+
+    def __init__(self):
+        self.transport = self
+        self.connected = True
+        self.disconnecting = False
+        self.channelsToRemoteChannel = {}
+        self.requests = []
+        self.lost = False
+
+    def sendGlobalRequest(self, request, data, wantReply=False):
+        self.requests.append((request, wantReply))
+        return defer.succeed(None)
+
+    def loseConnection(self):
+        self.lost = True
+
+class ConchTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = ConchTransport(worker())
+        self.conn = FakeConnection()
+        channel = Bag(conn=self.conn)
+        self.conn.channelsToRemoteChannel[channel] = 0
+        self.transport.protocol = Bag(transport=channel)
+
+    def test_alive(self):
+        self.assertTrue(self.transport.alive)
+        self.conn.disconnecting = True
+        self.assertFalse(self.transport.alive)
+
+    def test_closed_channel_is_dead(self):
+        self.conn.channelsToRemoteChannel.clear()
+        self.assertFalse(self.transport.alive)
+
+    def test_keepalive(self):
+        self.successResultOf(self.transport.keepalive())
+        self.assertEqual(self.conn.requests, [(b'keepalive@openssh.com', True)])
+
+    def test_disconnect(self):
+        self.transport.disconnect()
+        self.assertTrue(self.conn.lost)
+
+    def test_disconnect_while_connecting(self):
+        transport = ConchTransport(worker())
+        transport.connecting = defer.Deferred()
+        transport.disconnect()
+        self.failureResultOf(transport.connecting, defer.CancelledError)
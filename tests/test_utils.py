@@ -0,0 +1,46 @@
+from twisted.trial import unittest
+from twisted.internet import error
+from twisted.python.failure import Failure
+
+from plait import utils
+from plait.utils import Backoff, parse_size
+
+class ParseSizeTest(unittest.TestCase):
+
+    def test_plain_bytes(self):
+        self.assertEqual(parse_size("4096"), 4096)
+        self.assertEqual(parse_size(0), 0)
+
+    def test_suffixes(self):
+        self.assertEqual(parse_size("64K"), 64 * 1024)
+        self.assertEqual(parse_size("64m"), 64 * 1024 ** 2)
+        self.assertEqual(parse_size(" 2G "), 2 * 1024 ** 3)
+
+    def test_fractions(self):
+        self.assertEqual(parse_size("1.5K"), 1536)
+
+    def test_garbage(self):
+        self.assertRaises(ValueError, parse_size, "")
+        self.assertRaises(ValueError, parse_size, "lots")
+        self.assertRaises(ValueError, parse_size, "12T")
+
+class BackoffTest(unittest.TestCase):
+
+    def test_exponential_without_jitter(self):
+        backoff = Backoff(delay=1.0, factor=2.0, maximum=10.0, jitter=False)
+        delays = [backoff.delayFor(attempt) for attempt in range(1, 6)]
+        self.assertEqual(delays, [1.0, 2.0, 4.0, 8.0, 10.0])
+
+    def test_full_jitter(self):
+        self.patch(utils.random, 'uniform', lambda low, high: (low, high))
+        backoff = Backoff(delay=0.5, factor=3.0, maximum=60.0)
+        self.assertEqual(backoff.delayFor(1), (0, 0.5))
+        self.assertEqual(backoff.delayFor(3), (0, 4.5))
+        self.assertEqual(backoff.delayFor(10), (0, 60.0))
+
+    def test_fatal_failures(self):
+        backoff = Backoff()
+        self.assertTrue(backoff.isFatal(Failure(error.ConnectionRefusedError())))
+        self.assertTrue(backoff.isFatal(Failure(error.DNSLookupError())))
+        self.assertFalse(backoff.isFatal(Failure(error.TimeoutError())))
+        self.assertFalse(backoff.isFatal(Failure(error.ConnectionLost())))
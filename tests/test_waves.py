@@ -0,0 +1,33 @@
+import itertools
+
+from twisted.trial import unittest
+
+from plait.waves import Waves
+
+def first(waves, count):
+    return list(itertools.islice(waves, count))
+
+class WavesTest(unittest.TestCase):
+
+    def test_fixed_size(self):
+        self.assertEqual(first(Waves("10"), 3), [10, 10, 10])
+
+    def test_last_size_repeats(self):
+        self.assertEqual(first(Waves("1,10,100"), 5), [1, 10, 100, 100, 100])
+
+    def test_percentage_of_total(self):
+        self.assertEqual(first(Waves("5%", total=200), 2), [10, 10])
+        # rounds up, and never below one host
+        self.assertEqual(first(Waves("5%", total=30), 1), [2])
+        self.assertEqual(first(Waves("1%", total=3), 1), [1])
+
+    def test_relative(self):
+        self.assertTrue(Waves.isRelative("25%"))
+        self.assertFalse(Waves.isRelative("25"))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Waves, "5%")
+        self.assertRaises(ValueError, Waves, "0%", total=10)
+        self.assertRaises(ValueError, Waves, "150%", total=10)
+        self.assertRaises(ValueError, Waves, "10,0")
+        self.assertRaises(ValueError, Waves, "ten")